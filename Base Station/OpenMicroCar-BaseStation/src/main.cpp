@@ -33,6 +33,96 @@
 
   NecCodeData received_data;
 
+// Binary wire protocol, see Server/protocol.py. Fixed 6 byte frames:
+// version, opcode, device id, payload, sequence (uint16, little endian).
+  const uint8_t PROTOCOL_VERSION = 0xB1;
+  const int FRAME_SIZE = 6;
+  const uint8_t OP_HELLO_ACK = 0x01;
+  const uint8_t OP_BS_SEEN = 0x11;
+  const uint8_t OP_PING = 0x81;
+  const uint8_t OP_PONG = 0x12;
+  const unsigned long HELLO_TIMEOUT = 500; // milliseconds to wait for the server to accept binary frames
+  // The HELLO ack carries the server's heartbeat interval in 10 ms units; see the car firmware.
+  const unsigned long HEARTBEAT_UNIT_MS = 10;
+  const unsigned long HEARTBEAT_MISSES = 5;
+  const unsigned long MIN_SERVER_TIMEOUT = 1000; // milliseconds
+  unsigned long serverTimeout = 0; // milliseconds; 0 while the server is not sending heartbeats
+  unsigned long lastServerContact = 0;
+
+  bool binaryProtocol = false;
+  uint16_t txSequence = 0;
+
+void negotiateProtocol() {
+  binaryProtocol = false;
+  serverTimeout = 0;
+  client.print("HELLO:proto=bin1\n");
+
+  // An older server ignores the HELLO line and we stay on the ASCII protocol.
+  // ASCII pings sent before the server read the HELLO are skipped: a pong to them would not be understood any more.
+  unsigned long start = millis();
+  while (millis() - start < HELLO_TIMEOUT) {
+    if (!client.available()) {
+      delay(1);
+    } else if (client.peek() == PROTOCOL_VERSION) {
+      if (client.available() < FRAME_SIZE) {
+        delay(1);
+        continue;
+      }
+      uint8_t frame[FRAME_SIZE];
+      client.read(frame, FRAME_SIZE);
+      binaryProtocol = (frame[1] == OP_HELLO_ACK);
+      if (binaryProtocol && frame[3] > 0) {
+        serverTimeout = max(MIN_SERVER_TIMEOUT, frame[3] * HEARTBEAT_UNIT_MS * HEARTBEAT_MISSES);
+      }
+      break;
+    } else {
+      client.readStringUntil('\n');
+    }
+  }
+  Serial.println(binaryProtocol ? "Using binary protocol." : "Using ASCII protocol.");
+}
+
+void reportBaseStationSeen(uint8_t irAddress) {
+  if (binaryProtocol) {
+    uint8_t frame[FRAME_SIZE] = {PROTOCOL_VERSION, OP_BS_SEEN, 0, irAddress,
+                                 (uint8_t)(txSequence & 0xFF), (uint8_t)(txSequence >> 8)};
+    txSequence++;
+    client.write(frame, FRAME_SIZE);
+  } else {
+    client.printf("BS_SEEN:%02X\n", irAddress);
+  }
+}
+
+// The server only sends pings to a base station; answer each one so it can measure round-trip time.
+void handleServerMessages() {
+  if (client.available()) {
+    lastServerContact = millis();
+  } else if (serverTimeout > 0 && millis() - lastServerContact > serverTimeout) {
+    Serial.println("No heartbeat from the server. Reconnecting.");
+    client.stop();
+    return;
+  }
+  if (binaryProtocol) {
+    while (client.available() >= FRAME_SIZE) {
+      if (client.peek() != PROTOCOL_VERSION) {
+        client.read(); // Out of sync, drop a byte and look for the next frame start
+        continue;
+      }
+      uint8_t frame[FRAME_SIZE];
+      client.read(frame, FRAME_SIZE);
+      if (frame[1] == OP_PING) {
+        frame[1] = OP_PONG;
+        client.write(frame, FRAME_SIZE);
+      }
+    }
+  } else if (client.available()) {
+    String server_command = client.readStringUntil('\n');
+    if (server_command.length() == 4 && strtol(server_command.substring(0, 2).c_str(), NULL, 16) == OP_PING) {
+      client.printf("PONG:%s\n", server_command.substring(2, 4).c_str());
+    }
+  }
+}
+
 NecCodeData decodeNecCode(uint32_t necCode) { // Convert the Nec encoded address and data to integers
   NecCodeData decodedData;
   decodedData.address = (necCode >> 24) & 0xFF;
@@ -76,7 +166,7 @@ void loop() {
       if (results.decode_type == NEC) {
         received_data = decodeNecCode(results.value);
         
-        client.printf("BS_SEEN:%02X\n", received_data.address);
+        reportBaseStationSeen(received_data.address);
         Serial.printf("Received: %02X%02X\n", received_data.address, received_data.command);
       } else {
         // If it's not NEC, you can print a message to the console
@@ -85,6 +175,7 @@ void loop() {
       // Resume receiving the next IR signal
       irrecv.resume();
     }
+    handleServerMessages();
   } else { // If we are not connected to the server
     Serial.print("Connecting to server at ");
     Serial.print(serverIp);
@@ -94,6 +185,8 @@ void loop() {
     // Try to connect to the server
     if (client.connect(serverIp, serverPort)) {
       Serial.println("Connected to server!");
+      negotiateProtocol();
+      lastServerContact = millis();
     } else {
       Serial.println("Connection failed. Retrying in 1 seconds...");
       // Wait before retrying
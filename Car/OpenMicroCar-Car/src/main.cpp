@@ -1,4 +1,5 @@
 #include <WiFi.h>
+#include <WiFiUdp.h>
 #include <IRremoteESP8266.h>
 #include <IRrecv.h>
 #include <IRsend.h>
@@ -23,6 +24,7 @@ IPAddress gateway(192, 168, 77, 1);
 IPAddress subnet(255, 255, 255, 0);
 
 WiFiClient client;
+WiFiUDP driveUdp;
 
 // --- Car and IR Configuration ---
 const long CAR_IR_ADDRESS = 0x01; 
@@ -41,10 +43,84 @@ const int IR_BROADCAST_INTERVAL = 500; // milliseconds
 
 int shoot_timer = 0;
 
+// --- Binary Wire Protocol ---
+// Fixed 6 byte frames: version, opcode, device id, payload, sequence (uint16, little endian).
+// Server commands use the command address as the opcode and the command value as the payload.
+const uint8_t PROTOCOL_VERSION = 0xB1;
+const int FRAME_SIZE = 6;
+const uint8_t OP_HELLO_ACK = 0x01;
+const uint8_t OP_CAR_SEEN = 0x10;
+const uint8_t OP_PING = 0x81;
+const uint8_t OP_PONG = 0x12;
+const unsigned long HELLO_TIMEOUT = 500; // milliseconds to wait for the server to accept binary frames
+// The HELLO ack carries the server's heartbeat interval in 10 ms units. Silence for HEARTBEAT_MISSES intervals, and
+// at least MIN_SERVER_TIMEOUT, means the server is gone. A server that sends no heartbeats (payload 0), or only
+// speaks ASCII, gets no failsafe.
+const unsigned long HEARTBEAT_UNIT_MS = 10;
+const unsigned long HEARTBEAT_MISSES = 5;
+const unsigned long MIN_SERVER_TIMEOUT = 1000; // milliseconds
+unsigned long serverTimeout = 0; // milliseconds; 0 while the server is not sending heartbeats
+unsigned long lastServerContact = 0;
+
+// --- UDP Drive Commands ---
+// Offered in the HELLO line. A server started with --udp-drive then sends drive frames as datagrams to this port,
+// numbered so a late or repeated one is ignored. Everything else still arrives over TCP.
+const uint8_t OP_DRIVE = 0x02;
+const uint16_t DRIVE_UDP_PORT = 5001;
+bool haveDriveSequence = false;
+uint16_t lastDriveSequence = 0;
+
+bool binaryProtocol = false;
+uint16_t txSequence = 0;
+
 // --- Functions ---
+void runServerCommand(long command_address, long command_value);
+
+void negotiateProtocol() {
+  binaryProtocol = false;
+  serverTimeout = 0;
+  client.print("HELLO:proto=bin1,udp=" + String(DRIVE_UDP_PORT) + "\n");
+
+  // An older server ignores the HELLO line and we stay on the ASCII protocol.
+  // The server may send ASCII commands and pings before it reads the HELLO. Commands are applied, but pings are
+  // skipped because an ASCII pong would reach a server that has already switched to binary frames.
+  unsigned long start = millis();
+  while (millis() - start < HELLO_TIMEOUT) {
+    if (!client.available()) {
+      delay(1);
+    } else if (client.peek() == PROTOCOL_VERSION) {
+      if (client.available() < FRAME_SIZE) {
+        delay(1);
+        continue;
+      }
+      uint8_t frame[FRAME_SIZE];
+      client.read(frame, FRAME_SIZE);
+      binaryProtocol = (frame[1] == OP_HELLO_ACK);
+      if (binaryProtocol && frame[3] > 0) {
+        serverTimeout = max(MIN_SERVER_TIMEOUT, frame[3] * HEARTBEAT_UNIT_MS * HEARTBEAT_MISSES);
+      }
+      break;
+    } else {
+      String line = client.readStringUntil('\n');
+      line.trim();
+      if (line.length() == 4) {
+        long command_address = strtol(line.substring(0, 2).c_str(), NULL, 16);
+        long command_value = strtol(line.substring(2, 4).c_str(), NULL, 16);
+        if (command_address != OP_PING) {
+          runServerCommand(command_address, command_value);
+        }
+      }
+    }
+  }
+  Serial.println(binaryProtocol ? "Using binary protocol." : "Using ASCII protocol.");
+}
+
 void connectToServer() {
   if (client.connect(serverIp, serverPort)) {
     Serial.println("Connected to server!");
+    negotiateProtocol();
+    lastServerContact = millis();
+    haveDriveSequence = false; // the server numbers drive frames afresh for each connection
   } else {
     Serial.println("Connection failed. Retrying in 5 seconds...");
     delay(5000);
@@ -60,8 +136,121 @@ void sendData(String data) {
   }
 }
 
+void reportCarSeen(uint8_t irAddress) {
+  if (binaryProtocol) {
+    uint8_t frame[FRAME_SIZE] = {PROTOCOL_VERSION, OP_CAR_SEEN, (uint8_t)CAR_IR_ADDRESS, irAddress,
+                                 (uint8_t)(txSequence & 0xFF), (uint8_t)(txSequence >> 8)};
+    txSequence++;
+    if (client.connected()) {
+      client.write(frame, FRAME_SIZE);
+    } else {
+      Serial.println("Client not connected. Data not sent.");
+      connectToServer(); // Try to reconnect
+    }
+  } else {
+    char message[16];
+    sprintf(message, "CAR_SEEN:%02X\n", irAddress);
+    sendData(message);
+  }
+}
+
+// The server probes round-trip time with pings; answer straight away so the measurement stays honest.
+void answerPing(uint8_t payload, uint8_t sequenceLow, uint8_t sequenceHigh) {
+  if (binaryProtocol) {
+    uint8_t frame[FRAME_SIZE] = {PROTOCOL_VERSION, OP_PONG, (uint8_t)CAR_IR_ADDRESS, payload, sequenceLow, sequenceHigh};
+    client.write(frame, FRAME_SIZE);
+  } else {
+    char message[16];
+    sprintf(message, "PONG:%02X\n", payload);
+    sendData(message);
+  }
+}
+
+void runServerCommand(long command_address, long command_value) {
+  if (command_address == 0x80) { 
+    if (command_value == 0x01) {
+      is_disabled = true;
+      Serial.println("SERVER COMMAND: Car has been disabled!");
+    } else if (command_value == 0x02) {
+      is_disabled = false;
+      Serial.println("SERVER COMMAND: Car has been re-enabled!");
+    }
+  } else if (command_address == 0x02) {
+    if (command_value == 0x01) {
+      digitalWrite(FL_PIN, 1);
+      digitalWrite(FR_PIN, 1);
+      digitalWrite(BL_PIN, 0);
+      digitalWrite(BR_PIN, 0);
+    } else if (command_value == 0x02) {
+      digitalWrite(FL_PIN, 0);
+      digitalWrite(FR_PIN, 0);
+      digitalWrite(BL_PIN, 1);
+      digitalWrite(BR_PIN, 1);
+    } else if (command_value == 0x03) {
+      digitalWrite(FL_PIN, 0);
+      digitalWrite(FR_PIN, 1);
+      digitalWrite(BL_PIN, 1);
+      digitalWrite(BR_PIN, 0);
+    } else if (command_value == 0x04) {
+      digitalWrite(FL_PIN, 1);
+      digitalWrite(FR_PIN, 0);
+      digitalWrite(BL_PIN, 0);
+      digitalWrite(BR_PIN, 1);
+    } else if (command_value == 0x05) {
+      digitalWrite(FL_PIN, 0);
+      digitalWrite(FR_PIN, 0);
+      digitalWrite(BL_PIN, 0);
+      digitalWrite(BR_PIN, 0);
+    }
+  } else if (command_address == 0x03) {
+    if (command_value == 0x01) {
+      shoot_timer = millis();
+    }
+  }
+}
+
+// Drive datagrams may arrive late, twice or not at all; only one newer than the last applied one is used.
+void handleDriveDatagrams() {
+  while (driveUdp.parsePacket() > 0) {
+    uint8_t frame[FRAME_SIZE];
+    int length = driveUdp.read(frame, FRAME_SIZE);
+    if (length != FRAME_SIZE || driveUdp.remoteIP() != client.remoteIP()) {
+      continue;
+    }
+    if (frame[0] != PROTOCOL_VERSION || frame[1] != OP_DRIVE) {
+      continue;
+    }
+    lastServerContact = millis();
+    uint16_t sequence = frame[4] | (frame[5] << 8);
+    if (haveDriveSequence && (int16_t)(sequence - lastDriveSequence) <= 0) {
+      continue; // stale: a newer drive command has already been applied
+    }
+    haveDriveSequence = true;
+    lastDriveSequence = sequence;
+    runServerCommand(OP_DRIVE, frame[3]);
+  }
+}
+
 void handleServerCommands() {
+  handleDriveDatagrams();
   if (client.available()) {
+    lastServerContact = millis();
+  }
+  if (binaryProtocol) {
+    while (client.available() >= FRAME_SIZE) {
+      uint8_t frame[FRAME_SIZE];
+      if (client.peek() != PROTOCOL_VERSION) {
+        client.read(); // Out of sync, drop a byte and look for the next frame start
+        continue;
+      }
+      client.read(frame, FRAME_SIZE);
+      if (frame[1] == OP_PING) {
+        answerPing(frame[3], frame[4], frame[5]);
+      } else {
+        runServerCommand(frame[1], frame[3]);
+      }
+    }
+  } else if (client.available()) {
     String server_command = client.readStringUntil('\n');
     Serial.print("Received server command: ");
     Serial.println(server_command);
@@ -69,46 +258,10 @@ void handleServerCommands() {
     if (server_command.length() == 4) {
       long command_address = strtol(server_command.substring(0, 2).c_str(), NULL, 16);
       long command_value = strtol(server_command.substring(2, 4).c_str(), NULL, 16);
-
-      if (command_address == 0x80) { 
-        if (command_value == 0x01) {
-          is_disabled = true;
-          Serial.println("SERVER COMMAND: Car has been disabled!");
-        } else if (command_value == 0x02) {
-          is_disabled = false;
-          Serial.println("SERVER COMMAND: Car has been re-enabled!");
-        }
-      } else if (command_address == 0x02) {
-        if (command_value == 0x01) {
-          digitalWrite(FL_PIN, 1);
-          digitalWrite(FR_PIN, 1);
-          digitalWrite(BL_PIN, 0);
-          digitalWrite(BR_PIN, 0);
-        } else if (command_value == 0x02) {
-          digitalWrite(FL_PIN, 0);
-          digitalWrite(FR_PIN, 0);
-          digitalWrite(BL_PIN, 1);
-          digitalWrite(BR_PIN, 1);
-        } else if (command_value == 0x03) {
-          digitalWrite(FL_PIN, 0);
-          digitalWrite(FR_PIN, 1);
-          digitalWrite(BL_PIN, 1);
-          digitalWrite(BR_PIN, 0);
-        } else if (command_value == 0x04) {
-          digitalWrite(FL_PIN, 1);
-          digitalWrite(FR_PIN, 0);
-          digitalWrite(BL_PIN, 0);
-          digitalWrite(BR_PIN, 1);
-        } else if (command_value == 0x05) {
-          digitalWrite(FL_PIN, 0);
-          digitalWrite(FR_PIN, 0);
-          digitalWrite(BL_PIN, 0);
-          digitalWrite(BR_PIN, 0);
-        }
-      } else if (command_address == 0x03) {
-        if (command_value == 0x01) {
-          shoot_timer = millis();
-        }
+      if (command_address == OP_PING) {
+        answerPing(command_value, 0, 0);
+      } else {
+        runServerCommand(command_address, command_value);
       }
     }
   }
@@ -145,6 +298,8 @@ void setup() {
   irsend.begin();
   Serial.println("IR system enabled.");
 
+  driveUdp.begin(DRIVE_UDP_PORT);
+
   connectToServer();
 }
 
@@ -181,18 +336,11 @@ void loop() {
   if (irrecv.decode(&results)) {
     // The IRremoteESP8266 library returns protocol types slightly differently
     if (results.decode_type == NEC) {
-      long seenIrAddress = results.value;
+      uint8_t seenIrAddress = (results.value >> 24) & 0xFF; // Address byte of the NEC code, see NECCode()
       Serial.print("Received NEC Address: ");
       Serial.println(seenIrAddress, HEX);
 
-      char hex_buffer[3];
-      sprintf(hex_buffer, "%02X", seenIrAddress);
-      
-      String message = "CAR_SEEN:";
-      message += hex_buffer;
-      message += "\n";
-      
-      sendData(message);
+      reportCarSeen(seenIrAddress);
     }
     irrecv.resume();
   }
@@ -207,6 +355,13 @@ void loop() {
     // Car is disabled, stop motors, etc.
   }
   
+  // --- Failsafe: stop if the server has gone quiet, then reconnect ---
+  if (client.connected() && serverTimeout > 0 && millis() - lastServerContact > serverTimeout) {
+    Serial.println("No heartbeat from the server. Stopping and reconnecting.");
+    runServerCommand(0x02, 0x05); // stop the motors
+    client.stop();
+  }
+
   if (!client.connected()) {
     connectToServer();
   }
@@ -0,0 +1,330 @@
+"""Host several independent arenas from one server.
+
+Each arena is a separate main.py process with its own roster, teams,
+game state, timers, web port and (optionally) journal and snapshot, so
+arenas cannot affect each other and each one gets a CPU core of its own.
+This supervisor owns the device port. It accepts every device
+connection, works out which arena the device belongs to, and passes the
+socket itself to that arena's process over a Unix socket (SCM_RIGHTS),
+so device traffic never goes through the supervisor again. The web port
+serves a lobby that links to each arena's own web port.
+
+    python arenas.py arenas.json
+    python arenas.py arenas.json --identity hello -- --log-level info
+
+In 'ip' identity mode a device's arena is the one whose roster lists its
+IP address. In 'hello' mode the device names it in its HELLO line:
+HELLO:role=car,id=7,team=1,arena=north. Arguments after -- go to every
+arena process. Arenas that exit are restarted, and with a data_dir they
+come back with their snapshot and journal. SIGHUP reads the config again
+and passes the new rosters to every arena (see roster.py).
+
+The config file:
+
+    {
+      "data_dir": "arena-data",
+      "arenas": {
+        "north": {
+          "web_port": 8001,
+          "teams": {"1": "Red", "2": "Blue"},
+          "cars": {"192.168.77.51": {"id": 1, "ir_address": 1, "team": 1}},
+          "base_stations": {"192.168.77.11": {"id": 1, "team": 1}}
+        }
+      }
+    }
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from flask import Flask, jsonify, redirect, render_template_string, request, abort
+from protocol import HELLO_PREFIX, parse_hello
+from roster import Roster
+
+HOST = '0.0.0.0'
+PORT = 5000
+WEB_PORT = 8000
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+HELLO_TIMEOUT = 2.0 # seconds a device has to send its HELLO line in 'hello' identity mode
+HELLO_MAX_BYTES = 256
+HANDOFF_MARKER = b'H' # every handoff message carries at least this byte, so the descriptor is never sent alone
+HANDOFF_MAX_BYTES = 1 + HELLO_MAX_BYTES
+RESTART_DELAY = 1.0 # seconds before an arena process that exited is started again
+SHUTDOWN_TIMEOUT = 5.0 # seconds an arena process gets to close its journal after SIGINT
+
+class ArenaConfig:
+    def __init__(self, name, entry):
+        self.name = name
+        if not isinstance(entry, dict):
+            raise ValueError(f"arena {name} must be a JSON object, not {type(entry).__name__}")
+        web_port = entry.get('web_port')
+        if not isinstance(web_port, int) or isinstance(web_port, bool) or not 0 < web_port <= 0xFFFF:
+            raise ValueError(f"arena {name} needs a web_port from 1 to 65535, not {web_port!r}")
+        self.web_port = web_port
+        try:
+            self.roster = Roster.from_config(entry, source=f"arena {name}")
+        except ValueError as e:
+            raise ValueError(f"arena {name}: {e}") from None
+
+    def ips(self):
+        return list(self.roster.cars_by_ip) + list(self.roster.base_stations_by_ip)
+
+def load_arenas(path):
+    """(arenas by name, data_dir) from the config file. Raises ValueError if it cannot be used."""
+    with open(path) as config_file:
+        config = json.load(config_file)
+    if not isinstance(config, dict) or not isinstance(config.get('arenas', {}), dict):
+        raise ValueError(f"{path} must be a JSON object with an arenas object in it")
+    arenas = {name: ArenaConfig(name, entry) for name, entry in config.get('arenas', {}).items()}
+    if not arenas:
+        raise ValueError(f"{path} defines no arenas")
+    owners = {}
+    for arena in arenas.values():
+        for ip in arena.ips():
+            if owners.setdefault(ip, arena.name) != arena.name:
+                raise ValueError(f"{ip} is in the rosters of both {owners[ip]} and {arena.name}")
+    ports = [arena.web_port for arena in arenas.values()]
+    if len(set(ports)) != len(ports):
+        raise ValueError("every arena needs its own web_port")
+    return arenas, config.get('data_dir')
+
+def send_handoff(channel, conn, initial):
+    socket.send_fds(channel, [HANDOFF_MARKER + initial], [conn.fileno()])
+
+def receive_handoff(channel):
+    # (socket, bytes already read from it), or (None, b'') once the supervisor has gone away.
+    while True:
+        message, fds, _, _ = socket.recv_fds(channel, HANDOFF_MAX_BYTES, 1)
+        if not message:
+            return None, b''
+        if fds:
+            return socket.socket(fileno=fds[0]), message[len(HANDOFF_MARKER):]
+
+class ArenaWorker:
+    """One arena's main.py process, and the channel its device sockets are handed over on."""
+
+    def __init__(self, arena, config_path, data_dir, worker_args):
+        self.arena = arena
+        self.config_path = os.path.abspath(config_path)
+        self.data_dir = data_dir
+        self.worker_args = worker_args
+        self.process = None
+        self.channel = None
+        self.lock = threading.Lock()
+        self.started_at = None
+        self.restarts = 0
+        self.handoffs = 0
+
+    def start(self):
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        command = [sys.executable, os.path.join(SERVER_DIR, 'main.py'), '--arena', self.arena.name,
+                   '--arena-config', self.config_path, '--handoff-fd', str(child.fileno()),
+                   '--web-port', str(self.arena.web_port)]
+        if self.data_dir:
+            os.makedirs(self.data_dir, exist_ok=True)
+            base = os.path.join(self.data_dir, self.arena.name)
+            command += ['--journal', f"{base}.omcj", '--snapshot', f"{base}.snapshot"]
+        process = subprocess.Popen(command + self.worker_args, cwd=SERVER_DIR, pass_fds=[child.fileno()],
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+        child.close()
+        with self.lock:
+            if self.channel:
+                self.channel.close()
+            self.process, self.channel = process, parent
+            self.started_at = time.time()
+        threading.Thread(target=self._copy_output, args=(process,), daemon=True).start()
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def hand_off(self, conn, initial):
+        # The arena process now owns the socket; the supervisor's copy is closed either way.
+        try:
+            with self.lock:
+                send_handoff(self.channel, conn, initial)
+                self.handoffs += 1
+            return True
+        except OSError:
+            return False
+        finally:
+            conn.close()
+
+    def stop(self):
+        if self.alive():
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(SHUTDOWN_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+    def status(self):
+        return {'web_port': self.arena.web_port, 'alive': self.alive(), 'pid': self.process.pid if self.process else None,
+                'uptime_s': round(time.time() - self.started_at, 1) if self.alive() else 0,
+                'restarts': self.restarts, 'devices_handed_off': self.handoffs,
+                'cars': len(self.arena.roster.cars_by_ip), 'base_stations': len(self.arena.roster.base_stations_by_ip)}
+
+    def _copy_output(self, process):
+        # Prefix the arena's log lines so interleaved output from several arenas stays readable.
+        for line in process.stdout:
+            sys.stdout.write(f"[{self.arena.name}] {line}")
+        sys.stdout.flush()
+
+class ArenaRouter(threading.Thread):
+    """Accepts device connections and hands each one to its arena's process."""
+
+    def __init__(self, workers, identity_mode, host=HOST, port=PORT):
+        threading.Thread.__init__(self, daemon=True)
+        self.workers = workers
+        self.identity_mode = identity_mode
+        self.update_routes()
+        self.socket = socket.create_server((host, port))
+        self.rejected = 0
+
+    def update_routes(self):
+        # Replaced as a whole, so the accept loop never sees a half-built table.
+        self.ip_to_arena = {ip: name for name, worker in self.workers.items() for ip in worker.arena.ips()}
+
+    def run(self):
+        while True:
+            conn, addr = self.socket.accept()
+            if self.identity_mode == 'hello':
+                # Reading the HELLO line can take a while; do not hold up the next device.
+                threading.Thread(target=self.route_hello, args=(conn, addr), daemon=True).start()
+            else:
+                self.route(conn, addr, self.ip_to_arena.get(addr[0]), b'')
+
+    def route_hello(self, conn, addr):
+        initial = b''
+        conn.settimeout(HELLO_TIMEOUT)
+        try:
+            while b'\n' not in initial and len(initial) < HELLO_MAX_BYTES:
+                chunk = conn.recv(HELLO_MAX_BYTES - len(initial))
+                if not chunk:
+                    break
+                initial += chunk
+        except OSError:
+            pass
+        conn.settimeout(None)
+        line = initial.split(b'\n', 1)[0].strip()
+        arena = parse_hello(line).get('arena') if line.startswith(HELLO_PREFIX) else None
+        self.route(conn, addr, arena, initial)
+
+    def route(self, conn, addr, arena, initial):
+        worker = self.workers.get(arena)
+        if worker is None or not worker.alive() or not worker.hand_off(conn, initial):
+            self.rejected += 1
+            print(f"[ROUTER] No running arena for {addr} (arena: {arena}). Closing connection.", flush=True)
+            conn.close()
+
+lobby = Flask(__name__)
+workers = {}
+
+LOBBY_TEMPLATE = """
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Arenas</title>
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <style>
+        body { font-family: Arial, sans-serif; text-align: center; background-color: #f0f0f0; }
+        .container { max-width: 600px; margin: 50px auto; padding: 20px; border: 1px solid #ccc; background-color: #fff; border-radius: 10px; }
+        ul { list-style-type: none; padding: 0; }
+        li { margin: 10px 0; }
+        a { text-decoration: none; color: #2196F3; font-size: 1.2em; border: 1px solid #2196F3; padding: 10px 20px; border-radius: 5px; display: inline-block; width: 80%; }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <h1>Select an Arena</h1>
+        <ul>
+            {% for name, worker in workers.items() %}
+            <li><a href="/arena/{{ name }}">{{ name }}{% if not worker.alive() %} (restarting){% endif %}</a></li>
+            {% endfor %}
+        </ul>
+    </div>
+</body>
+</html>
+"""
+
+@lobby.route('/')
+def lobby_index():
+    return render_template_string(LOBBY_TEMPLATE, workers=workers)
+
+@lobby.route('/arena/<name>')
+@lobby.route('/arena/<name>/<path:path>')
+def arena_redirect(name, path=''):
+    worker = workers.get(name)
+    if worker is None:
+        abort(404)
+    # Same host the phone reached the lobby on, the arena's own port.
+    return redirect(f"http://{request.host.rsplit(':', 1)[0]}:{worker.arena.web_port}/{path}")
+
+@lobby.route('/api/arenas')
+def arena_status():
+    return jsonify({name: worker.status() for name, worker in workers.items()})
+
+def supervise():
+    while True:
+        time.sleep(RESTART_DELAY)
+        for worker in workers.values():
+            if not worker.alive():
+                print(f"[SUPERVISOR] Arena {worker.arena.name} exited with status {worker.process.returncode}. Restarting.", flush=True)
+                worker.restarts += 1
+                worker.start()
+
+def reload_config(path, router):
+    # On SIGHUP: new rosters for the router and every arena. Added or removed arenas and new web ports need a restart.
+    try:
+        arenas, _ = load_arenas(path)
+    except (OSError, ValueError) as e:
+        print(f"[SUPERVISOR] [ERROR] Keeping the current config: {e}", flush=True)
+        return
+    for name, worker in workers.items():
+        if name in arenas:
+            worker.arena.roster = arenas[name].roster
+            if worker.alive():
+                worker.process.send_signal(signal.SIGHUP)
+    router.update_routes()
+    print(f"[SUPERVISOR] Reloaded the rosters from {path}.", flush=True)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run several OpenMicroCar arenas from one server",
+                                     epilog="Arguments after -- are passed to every arena's main.py.")
+    parser.add_argument('config', help="JSON file listing the arenas and their rosters.")
+    parser.add_argument('--port', type=int, default=PORT, help="TCP port every car and base station connects to.")
+    parser.add_argument('--web-port', type=int, default=WEB_PORT, help="Port for the arena lobby.")
+    parser.add_argument('--identity', choices=['ip', 'hello'], default='ip',
+                        help="Route devices by the IP addresses in the rosters, or by arena= in their HELLO line.")
+    argv = sys.argv[1:]
+    worker_args = []
+    if '--' in argv:
+        argv, worker_args = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+    args = parser.parse_args(argv)
+    args.worker_args = ['--identity', args.identity] + worker_args
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    try:
+        arenas, data_dir = load_arenas(args.config)
+    except (OSError, ValueError) as e:
+        sys.exit(f"Cannot load {args.config}: {e}")
+    for name, arena in arenas.items():
+        workers[name] = ArenaWorker(arena, args.config, data_dir, args.worker_args)
+        workers[name].start()
+    router = ArenaRouter(workers, args.identity, port=args.port)
+    router.start()
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_config(args.config, router))
+    print(f"[SUPERVISOR] {len(workers)} arenas ({', '.join(workers)}). Devices on port {args.port}, lobby on port {args.web_port}.", flush=True)
+    threading.Thread(target=lobby.run, kwargs={'host': HOST, 'port': args.web_port}, daemon=True).start()
+    try:
+        supervise()
+    except KeyboardInterrupt:
+        print("[SUPERVISOR] Shutting down arenas.", flush=True)
+        for worker in workers.values():
+            worker.stop()
@@ -0,0 +1,169 @@
+import asyncio
+import io
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from statestream import KEEPALIVE, KEEPALIVE_INTERVAL
+try:
+    import uvicorn
+except ImportError:
+    # Optional: without uvicorn only the Flask development server is available.
+    uvicorn = None
+
+CONTROL_SOCKET_PATH = re.compile(r'^/ws/control/(\d+)$')
+EVENTS_PATH = '/events'
+WSGI_THREADS = 16 # worker threads for the plain Flask routes; WebSockets do not use them
+
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    for name, value in scope['headers']:
+        name = name.decode('latin-1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        value = value.decode('latin-1')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+def call_wsgi(wsgi_app, environ):
+    # Runs on a worker thread. Returns (status, headers, body); every route here returns a small, complete body.
+    response = {}
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+    result = wsgi_app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], response['headers'], body
+
+class ControlApp:
+    """ASGI front end for the web layer, run in-process on an asyncio loop.
+
+    Control WebSockets are served natively on the event loop, so an idle
+    phone costs a coroutine rather than a thread. So is the /events state
+    stream, which would otherwise hold a pool thread for as long as the
+    page is open. Every other request goes to the existing Flask app on a
+    bounded thread pool. All of them call straight into the server's
+    single GameState; nothing is copied between processes.
+    """
+
+    def __init__(self, flask_app, handle_message, on_open, on_close, state_stream=None, threads=WSGI_THREADS):
+        self.flask_app = flask_app
+        self.state_stream = state_stream
+        self.handle_message = handle_message
+        self.on_open = on_open
+        self.on_close = on_close
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'websocket':
+            match = CONTROL_SOCKET_PATH.match(scope['path'])
+            if match is None:
+                await send({'type': 'websocket.close', 'code': 1008})
+                return
+            await self.control_socket(int(match.group(1)), receive, send)
+        elif scope['type'] == 'http' and scope['path'] == EVENTS_PATH and self.state_stream is not None:
+            await self.events(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+
+    async def http(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        loop = asyncio.get_running_loop()
+        status, headers, content = await loop.run_in_executor(
+            self.executor, call_wsgi, self.flask_app, build_environ(scope, bytes(body)))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': content})
+
+    async def events(self, receive, send):
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        subscriber = self.state_stream.subscribe(on_ready=lambda: loop.call_soon_threadsafe(ready.set))
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')]})
+            while not disconnected.done():
+                ready.clear()
+                messages = subscriber.drain()
+                if messages:
+                    await send({'type': 'http.response.body', 'body': b''.join(messages), 'more_body': True})
+                waiter = asyncio.ensure_future(ready.wait())
+                done, _ = await asyncio.wait({waiter, disconnected}, timeout=KEEPALIVE_INTERVAL,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                if not done:
+                    await send({'type': 'http.response.body', 'body': KEEPALIVE, 'more_body': True})
+        finally:
+            disconnected.cancel()
+            self.state_stream.unsubscribe(subscriber)
+
+    async def control_socket(self, car_id, receive, send):
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+        await send({'type': 'websocket.accept'})
+        self.on_open(car_id)
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'websocket.disconnect':
+                    break
+                text = message.get('text')
+                if text is None:
+                    text = (message.get('bytes') or b'').decode('utf-8', 'replace')
+                await send({'type': 'websocket.send', 'text': self.handle_message(car_id, text)})
+        finally:
+            self.on_close(car_id)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+def create_web_server(app, host, port):
+    # Returns a uvicorn.Server; await its serve() on whichever loop should own the web layer.
+    config = uvicorn.Config(app, host=host, port=port, log_level='warning', access_log=False, lifespan='on')
+    return uvicorn.Server(config)
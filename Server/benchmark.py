@@ -0,0 +1,330 @@
+"""End-to-end command latency, from a web command being sent to the car's socket receiving it.
+
+Each scenario starts a fresh server in a subprocess with --identity hello
+and connects simulated cars to it (see simulator.py). One controller per
+car then presses drive buttons over HTTP (GET /command/<car_id>/<action>)
+or the control WebSocket. Each press is timed until the car's socket
+receives the command. Results are written as JSON so builds can be
+compared:
+
+    python benchmark.py --cars 1,10,50 --output before.json
+    python benchmark.py --cars 1,10,50 --compare before.json
+
+--transports tcp,udp runs every scenario twice: drive commands over the
+car's TCP connection, and as UDP datagrams (server --udp-drive). The
+difference shows up in the tail on a lossy link, so shape loopback first
+and remove the shaping afterwards (needs root and the netem module):
+
+    tc qdisc add dev lo root netem loss 2%
+    python benchmark.py --cars 10 --channels ws --transports tcp,udp --output lossy.json
+    tc qdisc del dev lo root
+
+The loopback qdisc in use is recorded in the report's settings.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime
+from simulator import build_devices, Arena
+from protocol import OP_DRIVE
+try:
+    import websockets
+except ImportError:
+    # Optional: without the websockets client only the HTTP channel can be benchmarked.
+    websockets = None
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+HOST = '127.0.0.1'
+DEVICE_PORT = 5700
+WEB_PORT = 8700
+SERVER_START_TIMEOUT = 15 # seconds for the server subprocess to accept connections
+DELIVERY_TIMEOUT = 1.0 # seconds. A command that has not reached the car by then counts as lost.
+THINK_TIME = 0.05 # seconds between presses, about as fast as a thumb on a phone
+# Alternate directions so every press changes what the car should be doing: (web action, drive payload)
+PRESSES = [('forward', 0x01), ('backward', 0x02)]
+REGRESSION_TOLERANCE = 0.25 # fractional p95 increase over the baseline that fails --compare...
+REGRESSION_FLOOR_MS = 1.0 # ...as long as it is also at least this many milliseconds
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+def summarize_ms(samples):
+    values = sorted(sample * 1000 for sample in samples)
+    if not values:
+        return None
+    return {
+        "p50": round(percentile(values, 0.50), 3),
+        "p95": round(percentile(values, 0.95), 3),
+        "p99": round(percentile(values, 0.99), 3),
+        "max": round(values[-1], 3),
+        "mean": round(sum(values) / len(values), 3),
+    }
+
+class ServerProcess:
+    # The real server, in its own process so the benchmark's client work does not share its GIL.
+    def __init__(self, web_server, device_server, transport='tcp'):
+        self.command = [sys.executable, os.path.join(SERVER_DIR, 'main.py'), '--identity', 'hello',
+                        '--port', str(DEVICE_PORT), '--web-port', str(WEB_PORT), '--web-server', web_server,
+                        '--device-server', device_server, '--ping-interval', '0', '--heartbeat-interval', '0',
+                        '--log-level', 'warning']
+        if transport == 'udp':
+            self.command.append('--udp-drive')
+        self.process = None
+
+    def __enter__(self):
+        self.process = subprocess.Popen(self.command, cwd=SERVER_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        for port in (DEVICE_PORT, WEB_PORT):
+            while True:
+                if self.process.poll() is not None:
+                    raise RuntimeError(f"server exited with code {self.process.returncode}: {' '.join(self.command)}")
+                try:
+                    socket.create_connection((HOST, port), timeout=0.2).close()
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise RuntimeError(f"server did not open port {port} within {SERVER_START_TIMEOUT}s")
+                    time.sleep(0.1)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+class DeliveryTracker:
+    # Resolves a future when a car's socket receives the drive command a controller is waiting for.
+    def __init__(self, cars):
+        self._waiting = {}
+        for car in cars:
+            car.listeners.append(self._on_command)
+
+    def expect(self, car_id, payload):
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[car_id] = (payload, future)
+        return future
+
+    def _on_command(self, device, opcode, payload, sequence, received_at):
+        waiting = self._waiting.get(device.id)
+        if opcode == OP_DRIVE and waiting and waiting[0] == payload and not waiting[1].done():
+            del self._waiting[device.id]
+            waiting[1].set_result(received_at)
+
+class HttpChannel:
+    # Minimal keep-alive HTTP/1.1 client; reconnects whenever the server closes the connection.
+    def __init__(self):
+        self.reader = self.writer = None
+
+    async def press(self, car_id, action, seq):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(HOST, WEB_PORT)
+        self.writer.write(f"GET /command/{car_id}/{action} HTTP/1.1\r\nHost: {HOST}:{WEB_PORT}\r\n\r\n".encode('ascii'))
+        status_line = await self.reader.readline()
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        await self.reader.readexactly(int(headers.get('content-length', 0)))
+        if status_line.startswith(b'HTTP/1.0') or headers.get('connection', '').lower() == 'close':
+            await self.close()
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+            self.reader = self.writer = None
+
+class WebSocketChannel:
+    def __init__(self):
+        self.ws = None
+
+    async def press(self, car_id, action, seq):
+        if self.ws is None:
+            self.ws = await websockets.connect(f"ws://{HOST}:{WEB_PORT}/ws/control/{car_id}", open_timeout=10)
+        await self.ws.send(json.dumps({"type": "press", "action": action, "seq": seq}))
+        await self.ws.recv()
+
+    async def close(self):
+        if self.ws:
+            await self.ws.close()
+
+CHANNELS = {'http': HttpChannel, 'ws': WebSocketChannel}
+
+async def run_controller(channel, car, tracker, stop_at, results):
+    seq = 0
+    try:
+        while time.monotonic() < stop_at:
+            action, payload = PRESSES[seq % len(PRESSES)]
+            seq += 1
+            delivered = tracker.expect(car.id, payload)
+            sent_at = time.perf_counter()
+            await channel.press(car.id, action, seq)
+            results['ack'].append(time.perf_counter() - sent_at)
+            try:
+                results['latency'].append(await asyncio.wait_for(delivered, DELIVERY_TIMEOUT) - sent_at)
+            except asyncio.TimeoutError:
+                results['lost'] += 1
+            await asyncio.sleep(THINK_TIME)
+    finally:
+        await channel.close()
+
+async def wait_for_cars(count):
+    # The cars are registered by the game loop; wait until the server reports all of them.
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        reader, writer = await asyncio.open_connection(HOST, WEB_PORT)
+        writer.write(f"GET /metrics HTTP/1.1\r\nHost: {HOST}\r\nConnection: close\r\n\r\n".encode('ascii'))
+        body = (await reader.read()).decode('utf-8', 'replace')
+        writer.close()
+        if f'omc_connected_devices{{type="car"}} {count}' in body:
+            return
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f"server did not register {count} cars")
+
+async def run_scenario(channel_name, cars_count, binary, duration, transport='tcp'):
+    cars, base_stations = build_devices(cars_count, 0, binary, udp=(transport == 'udp'))
+    arena = Arena(cars, base_stations)
+    tracker = DeliveryTracker(cars)
+    await arena.connect(HOST, DEVICE_PORT)
+    try:
+        await wait_for_cars(cars_count)
+        results = {'latency': [], 'ack': [], 'lost': 0}
+        started = time.monotonic()
+        await asyncio.gather(*(run_controller(CHANNELS[channel_name](), car, tracker, started + duration, results)
+                               for car in cars))
+        elapsed = time.monotonic() - started
+    finally:
+        await arena.close()
+    commands = len(results['ack'])
+    return {
+        "commands": commands,
+        "delivered": len(results['latency']),
+        "lost": results['lost'],
+        "throughput_per_s": round(len(results['latency']) / elapsed, 1),
+        "latency_ms": summarize_ms(results['latency']),
+        "ack_ms": summarize_ms(results['ack']),
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SERVER_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def loopback_qdisc():
+    # e.g. "qdisc netem 8001: root refcnt 2 limit 1000 loss 2%", so results from a shaped link are labelled as such.
+    try:
+        return subprocess.run(['tc', 'qdisc', 'show', 'dev', 'lo'], capture_output=True, text=True,
+                              timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def run_benchmarks(args):
+    report = {
+        "created": datetime.now().isoformat(timespec='seconds'),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {"duration_s": args.duration, "think_time_s": THINK_TIME, "binary": args.binary,
+                     "delivery_timeout_s": DELIVERY_TIMEOUT, "loopback_qdisc": loopback_qdisc()},
+        "scenarios": [],
+    }
+    for web_server in args.web_server:
+        for device_server in args.device_server:
+            for channel in args.channels:
+                for transport in args.transports:
+                    for cars in args.cars:
+                        # TCP keeps the names it had before there was a choice, so older baselines still compare.
+                        name = f"{channel}/{web_server}/{device_server}/{cars}cars" + ("/udp" if transport == 'udp' else "")
+                        scenario = {"name": name, "channel": channel, "transport": transport, "web_server": web_server,
+                                    "device_server": device_server, "cars": cars, "controllers": cars}
+                        # Drive datagrams are binary frames, so UDP cars always negotiate the binary protocol.
+                        binary = args.binary or transport == 'udp'
+                        try:
+                            with ServerProcess(web_server, device_server, transport):
+                                scenario.update(asyncio.run(run_scenario(channel, cars, binary, args.duration, transport)))
+                        except Exception as e:
+                            scenario["error"] = f"{type(e).__name__}: {e}"
+                        report["scenarios"].append(scenario)
+                        print(describe(scenario), flush=True)
+    return report
+
+def describe(scenario):
+    if "error" in scenario:
+        return f"{scenario['name']:<36} ERROR {scenario['error']}"
+    latency = scenario["latency_ms"] or {}
+    return (f"{scenario['name']:<36} {scenario['delivered']:>6} delivered ({scenario['lost']} lost) "
+            f"{scenario['throughput_per_s']:>8.1f}/s  p50 {latency.get('p50')}ms  p95 {latency.get('p95')}ms  "
+            f"p99 {latency.get('p99')}ms")
+
+def compare(report, baseline):
+    # Prints p95 changes per scenario and returns the names of scenarios that regressed or delivered nothing.
+    previous = {scenario["name"]: scenario for scenario in baseline["scenarios"]}
+    regressions = []
+    for scenario in report["scenarios"]:
+        before = previous.get(scenario["name"])
+        if not before or "error" in before or "error" in scenario:
+            continue
+        if not before["latency_ms"]:
+            print(f"{scenario['name']:<36} no baseline latency (nothing was delivered)")
+            continue
+        if not scenario["latency_ms"]:
+            # Not a single command reached a car: worse than any slowdown.
+            print(f"{scenario['name']:<36} p95 {before['latency_ms']['p95']:.3f}ms -> nothing delivered  FAILED")
+            regressions.append(scenario["name"])
+            continue
+        old, new = before["latency_ms"]["p95"], scenario["latency_ms"]["p95"]
+        change = (new - old) / old if old else 0.0
+        regressed = change > REGRESSION_TOLERANCE and new - old >= REGRESSION_FLOOR_MS
+        print(f"{scenario['name']:<36} p95 {old:.3f}ms -> {new:.3f}ms ({change:+.0%}){'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(scenario["name"])
+    return regressions
+
+def parse_list(value, cast=str):
+    return [cast(item) for item in value.split(',') if item]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="End-to-end web command to device socket latency benchmark")
+    parser.add_argument('--cars', type=lambda value: parse_list(value, int), default=[1, 10, 50],
+                        help="Comma-separated car counts; each car gets its own controller.")
+    parser.add_argument('--channels', type=parse_list, default=['http', 'ws'], help="Comma-separated: http, ws.")
+    parser.add_argument('--web-server', type=parse_list, default=['asgi'], help="Comma-separated: dev, asgi.")
+    parser.add_argument('--device-server', type=parse_list, default=['asyncio'], help="Comma-separated: asyncio, threads.")
+    parser.add_argument('--transports', type=parse_list, default=['tcp'],
+                        help="Comma-separated: tcp, udp (drive commands as UDP datagrams; implies --binary for those runs).")
+    parser.add_argument('--binary', action='store_true', help="Simulated cars negotiate the binary protocol.")
+    parser.add_argument('--duration', type=float, default=5, help="Seconds each scenario runs.")
+    parser.add_argument('--output', help="Write the results to this JSON file.")
+    parser.add_argument('--compare', help="Baseline JSON file; exit with status 1 if any scenario's p95 regressed.")
+    args = parser.parse_args()
+    if 'ws' in args.channels and websockets is None:
+        parser.error("the ws channel needs the websockets package (pip install websockets)")
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = run_benchmarks(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f))
+        if regressions:
+            print(f"{len(regressions)} scenario(s) regressed.")
+            sys.exit(1)
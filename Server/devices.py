@@ -0,0 +1,106 @@
+from array import array
+
+# Bits of CarColumns.states
+STATE_DISABLED = 0x01
+STATE_SAFE = 0x02
+STATE_HAS_FLAG = 0x04
+STATE_MOVING = 0x08
+
+class DeviceRegistry:
+    """The registered cars and base stations, with hash indexes for every lookup.
+
+    cars and base_stations map id to device, as GameState always has, and
+    stay the same dict objects for the life of the registry. Next to them
+    are indexes by IP address (simulated devices can share one), by a
+    car's IR address and by a car's team. add() and remove() keep all of
+    them in step, so no lookup scans the arena. Only the game loop
+    changes the registry; other threads may read it.
+    """
+
+    def __init__(self):
+        self.cars = {}
+        self.base_stations = {}
+        self._by_ip = {} # ip -> {(device_type, id): device}
+        self._cars_by_ir_address = {}
+        self._cars_by_team = {} # team id -> {car id: car}
+
+    def add(self, device):
+        # Replaces any device already registered with the same type and id.
+        table = self._table(device)
+        previous = table.get(device.id)
+        if previous is not None:
+            self._unindex(previous)
+        table[device.id] = device
+        self._index(device)
+
+    def remove(self, device):
+        # Only removes device if it is still the one registered for its id, so a late disconnect of a replaced
+        # connection cannot drop its successor. Returns True if it was removed.
+        table = self._table(device)
+        if table.get(device.id) is not device:
+            return False
+        del table[device.id]
+        self._unindex(device)
+        return True
+
+    def devices_at(self, ip):
+        return list(self._by_ip.get(ip, {}).values())
+
+    def car_by_ir_address(self, ir_address):
+        return self._cars_by_ir_address.get(ir_address)
+
+    def cars_on_team(self, team_id):
+        return list(self._cars_by_team.get(team_id, {}).values())
+
+    def columns(self):
+        return CarColumns(list(self.cars.values()))
+
+    def _table(self, device):
+        return self.cars if device.device_type == 'car' else self.base_stations
+
+    def _index(self, device):
+        self._by_ip.setdefault(device.ip, {})[(device.device_type, device.id)] = device
+        if device.device_type == 'car':
+            self._cars_by_ir_address[device.ir_address] = device
+            self._cars_by_team.setdefault(device.team_id, {})[device.id] = device
+
+    def _unindex(self, device):
+        at_ip = self._by_ip.get(device.ip)
+        if at_ip is not None and at_ip.get((device.device_type, device.id)) is device:
+            del at_ip[(device.device_type, device.id)]
+            if not at_ip:
+                del self._by_ip[device.ip]
+        if device.device_type == 'car':
+            if self._cars_by_ir_address.get(device.ir_address) is device:
+                del self._cars_by_ir_address[device.ir_address]
+            team = self._cars_by_team.get(device.team_id)
+            if team is not None and team.get(device.id) is device:
+                del team[device.id]
+
+class CarColumns:
+    """Struct-of-arrays copy of every car's team and state flags, for bulk queries.
+
+    Built in one pass into three compact arrays (id, team, state bits), it
+    answers queries such as "disabled cars on team 2" without touching
+    the car objects again, and several queries can share one build. It is
+    a copy: take a new one after the game state changes.
+    """
+
+    def __init__(self, cars):
+        self.ids = array('H', (car.id for car in cars))
+        self.teams = array('B', (car.team_id for car in cars))
+        self.states = bytearray((STATE_DISABLED if car.is_disabled else 0) | (STATE_SAFE if car.is_safe else 0) |
+                                (STATE_HAS_FLAG if car.has_flag else 0) | (STATE_MOVING if car.is_moving else 0)
+                                for car in cars)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def select(self, team_id=None, all_of=0, none_of=0):
+        # Ids of the cars on team_id (any team if None) with every bit of all_of set and no bit of none_of.
+        mask = all_of | none_of
+        return [car_id for car_id, team, state in zip(self.ids, self.teams, self.states)
+                if (team_id is None or team == team_id) and state & mask == all_of]
+
+    def count(self, team_id=None, all_of=0, none_of=0):
+        return len(self.select(team_id, all_of, none_of))
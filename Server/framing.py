@@ -0,0 +1,136 @@
+import threading
+
+RECV_BUFFER_SIZE = 4096
+MAX_FRAME_LENGTH = 256 # bytes. Anything longer without a newline is treated as garbage and dropped.
+
+class FramingStats:
+    # Totals across every connection, so the game loop can report them without walking each socket.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.reads = 0
+        self.bytes = 0
+        self.frames = 0
+        self.parse_errors = 0
+        self.max_frames_per_read = 0
+
+    def record_read(self, nbytes, frames):
+        with self.lock:
+            self.reads += 1
+            self.bytes += nbytes
+            self.frames += frames
+            if frames > self.max_frames_per_read:
+                self.max_frames_per_read = frames
+
+    def record_parse_error(self):
+        with self.lock:
+            self.parse_errors += 1
+
+    def report(self):
+        with self.lock:
+            frames_per_read = (self.frames / self.reads) if self.reads else 0.0
+            summary = (f"[FRAMING STATS] {self.frames} frames in {self.reads} reads ({self.bytes} bytes), "
+                       f"{frames_per_read:.2f} frames/read (max {self.max_frames_per_read}), {self.parse_errors} parse errors")
+            self.reset()
+        return summary
+
+framing_stats = FramingStats()
+
+class StreamFramer:
+    """Incremental framing over one reusable receive buffer.
+
+    Sockets read straight into get_buffer() (recv_into or
+    asyncio.BufferedProtocol), then buffer_updated() returns every complete
+    frame in that read. A partial frame stays in the buffer until the rest of
+    it arrives, so coalesced and split TCP segments both frame correctly.
+    Frames are newline-terminated lines until use_fixed_frames() switches the
+    connection to fixed-size binary frames that start with a sync byte.
+    """
+
+    def __init__(self, buffer_size=RECV_BUFFER_SIZE, max_frame_length=MAX_FRAME_LENGTH):
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self.max_frame_length = max_frame_length
+        self.frame_size = None
+        self.sync_byte = None
+        self.reads = 0
+        self.frames = 0
+        self.parse_errors = 0
+
+    def get_buffer(self, sizehint=-1):
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif len(self._buffer) - self._end < self.max_frame_length:
+            # Slide the partial frame to the front to make room; it is at most max_frame_length long.
+            remaining = self._end - self._start
+            self._buffer[:remaining] = self._view[self._start:self._end]
+            self._start, self._end = 0, remaining
+        return self._view[self._end:]
+
+    def recv_into(self, sock):
+        nbytes = sock.recv_into(self.get_buffer())
+        return nbytes, (self.buffer_updated(nbytes) if nbytes else [])
+
+    def feed(self, data):
+        # Frames in bytes that were read off the socket before this framer got it (e.g. by the arena router).
+        frames = []
+        view = memoryview(data)
+        while view:
+            buffer = self.get_buffer()
+            count = min(len(buffer), len(view))
+            buffer[:count] = view[:count]
+            frames.extend(self.buffer_updated(count))
+            view = view[count:]
+        return frames
+
+    def use_fixed_frames(self, frame_size, sync_byte):
+        self.frame_size = frame_size
+        self.sync_byte = sync_byte
+
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+        if self.frame_size:
+            frames = self._split_fixed()
+        else:
+            frames = self._split_lines()
+        self.reads += 1
+        self.frames += len(frames)
+        framing_stats.record_read(nbytes, len(frames))
+        return frames
+
+    def _split_lines(self):
+        frames = []
+        while True:
+            newline = self._buffer.find(b'\n', self._start, self._end)
+            if newline < 0:
+                break
+            frame = bytes(self._view[self._start:newline]).strip()
+            self._start = newline + 1
+            if frame:
+                frames.append(frame)
+
+        if self._end - self._start > self.max_frame_length:
+            self._start = self._end
+            self.record_parse_error()
+        return frames
+
+    def _split_fixed(self):
+        frames = []
+        while self._end - self._start >= self.frame_size:
+            if self._buffer[self._start] != self.sync_byte:
+                # Lost sync: skip ahead to the next byte that could start a frame.
+                self.record_parse_error()
+                sync = self._buffer.find(self.sync_byte, self._start + 1, self._end)
+                self._start = sync if sync >= 0 else self._end
+                continue
+            frames.append(bytes(self._view[self._start:self._start + self.frame_size]))
+            self._start += self.frame_size
+        return frames
+
+    def record_parse_error(self):
+        self.parse_errors += 1
+        framing_stats.record_parse_error()
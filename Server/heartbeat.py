@@ -0,0 +1,77 @@
+import threading
+import time
+
+class HeartbeatMonitor(threading.Thread):
+    """Pings every device on a fixed beat and drops the ones that go quiet.
+
+    Every interval seconds each identified device is sent a ping, which
+    it answers straight away, so a healthy device is never silent for
+    much longer than one interval plus its round trip. Any frame from the
+    device counts as a sign of life. A device silent for more than timeout
+    seconds is taken to be gone (power lost, out of range) and its
+    connection is closed, long before TCP would notice. Only a device that
+    has shown it answers pings can be dropped: firmware too old to know
+    them is pinged all the same but never evicted. The pings double
+    as the RTT probes for /api/links, and they let the device detect a
+    dead server the same way.
+
+    devices is a callable returning the identified devices; each has
+    last_seen (time.time() of its last frame), answers_heartbeats(),
+    send_ping() and a connection with close().
+    """
+
+    def __init__(self, interval, timeout, devices, on_evict=None):
+        threading.Thread.__init__(self, name="heartbeat", daemon=True)
+        self.interval = interval
+        self.timeout = timeout
+        self.devices = devices
+        self.on_evict = on_evict # called with (device, seconds silent)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.sent = 0
+        self.evicted = 0
+        self.longest_silence = 0.0 # of the devices that were not evicted, to see how close healthy ones come to timeout
+        self.eviction_silence_max = 0.0
+
+    def run(self):
+        next_beat = time.monotonic()
+        while True:
+            self.beat(time.time())
+            next_beat += self.interval
+            delay = next_beat - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_beat = time.monotonic() # fell behind; do not try to catch up with a burst
+
+    def beat(self, now):
+        for device in self.devices():
+            if not device.connection.is_connected:
+                continue
+            silence = now - device.last_seen
+            answers = device.answers_heartbeats()
+            if silence > self.timeout and answers:
+                device.connection.close()
+                with self._lock:
+                    self.evicted += 1
+                    self.eviction_silence_max = max(self.eviction_silence_max, silence)
+                if self.on_evict:
+                    self.on_evict(device, silence)
+                continue
+            device.send_ping()
+            with self._lock:
+                self.sent += 1
+                if answers:
+                    self.longest_silence = max(self.longest_silence, silence)
+
+    def report(self):
+        with self._lock:
+            summary = (f"[HEARTBEAT] every {self.interval * 1000:.0f}ms, timeout {self.timeout * 1000:.0f}ms: "
+                       f"{self.sent} sent, longest silence of a live device {self.longest_silence * 1000:.0f}ms, "
+                       f"{self.evicted} evicted")
+            if self.evicted:
+                summary += f" (after up to {self.eviction_silence_max * 1000:.0f}ms of silence)"
+            self.reset()
+        return summary
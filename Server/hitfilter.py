@@ -0,0 +1,62 @@
+import threading
+from collections import OrderedDict
+
+class HitFilter:
+    """Drops repeated CAR_SEEN reports of the same shooter seeing the same target.
+
+    One shot is usually decoded several times, and a car keeps seeing the
+    same broadcast for a moment, so each (shooter, target) pair only lets
+    one report through per window; the rest never reach the event queue.
+    The window starts at the accepted report, so a steady stream of
+    reports still gets one through every window. At most max_pairs pairs
+    are remembered: expired ones are evicted as new reports arrive, and the
+    oldest ones if the table is still full. Device threads call accept()
+    concurrently.
+    """
+
+    def __init__(self, window, max_pairs):
+        self.window = window # seconds; 0 lets every report through
+        self.max_pairs = max_pairs
+        self._lock = threading.Lock()
+        self._accepted_at = OrderedDict() # (shooter id, target id) -> monotonic time, oldest first
+        self.raw = 0
+        self.accepted = 0
+        self.evicted = 0 # pairs dropped from a full table before their window ran out
+        self._interval_raw = 0
+        self._interval_accepted = 0
+
+    def accept(self, shooter_id, target_id, now):
+        # True if this report should go to the game loop.
+        key = (shooter_id, target_id)
+        with self._lock:
+            self.raw += 1
+            self._interval_raw += 1
+            if self.window > 0:
+                self._expire(now)
+                if key in self._accepted_at:
+                    return False
+                self._accepted_at[key] = now
+                if len(self._accepted_at) > self.max_pairs:
+                    self._accepted_at.popitem(last=False)
+                    self.evicted += 1
+            self.accepted += 1
+            self._interval_accepted += 1
+            return True
+
+    def _expire(self, now):
+        # Entries are in the order they were accepted, so the expired ones are all at the front.
+        cutoff = now - self.window
+        while self._accepted_at:
+            key, accepted_at = next(iter(self._accepted_at.items()))
+            if accepted_at > cutoff:
+                break
+            del self._accepted_at[key]
+
+    def report(self):
+        with self._lock:
+            raw, accepted = self._interval_raw, self._interval_accepted
+            self._interval_raw = self._interval_accepted = 0
+            pairs = len(self._accepted_at)
+        suppressed = (raw - accepted) / raw * 100 if raw else 0.0
+        return (f"[HIT FILTER] {raw} CAR_SEEN reports, {accepted} passed to the game loop ({suppressed:.0f}% duplicates "
+                f"within {self.window * 1000:.0f}ms), {pairs} pairs tracked, {self.evicted} evicted early")
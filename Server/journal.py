@@ -0,0 +1,292 @@
+import atexit
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+
+JOURNAL_MAGIC = b'OMCJ'
+JOURNAL_VERSION = 1
+JOURNAL_FLUSH_INTERVAL = 0.2 # seconds between writes of the buffered records
+JOURNAL_FSYNC_INTERVAL = 1.0 # seconds between fsyncs; a power cut loses at most this much of the match
+
+# Every record is a type byte, a payload length byte and the payload. Times are the game clock
+# (time.time() as the game logic saw it) stored as doubles, so a replay computes exactly the same deadlines.
+REC_SESSION = 0x01 # <d: server started; a replay starts again from an empty game state
+REC_TICK = 0x02 # <dQ: game loop pass at this game time, and monotonic ns since the session started
+REC_CONNECT = 0x03 # <BHBH + ip: device kind, id, team, port
+REC_DISCONNECT = 0x04 # <BHH + ip: device kind, id, port
+REC_CAR_SEEN = 0x05 # <HH: shooter car id, target car id
+REC_BS_SEEN = 0x06 # <HH: base station id, car id
+REC_WEB_COMMAND = 0x07 # <dH + action: time the command was applied, car id
+REC_CHECKPOINT = 0x08 # <d + 16-byte digest of GameState.describe() after the pass at this game time
+REC_RESUME = 0x09 # <d: server restarted and recovered its state; a replay carries on with the devices detached
+REC_ZONE_ENTER = 0x0A # <HH: zone (the base stations' team id), car id
+REC_ZONE_LEAVE = 0x0B # <HH: zone, car id
+REC_SET_TEAM = 0x0C # <BHB: device kind, id, new team id (a reloaded roster moved the device)
+
+HEADER = struct.Struct('<BB')
+SESSION = struct.Struct('<d') # also the payload of REC_RESUME
+TICK = struct.Struct('<dQ')
+CONNECT = struct.Struct('<BHBH')
+DISCONNECT = struct.Struct('<BHH')
+SIGHTING = struct.Struct('<HH')
+SET_TEAM = struct.Struct('<BHB')
+WEB_COMMAND = struct.Struct('<dH')
+CHECKPOINT = struct.Struct('<d')
+
+DEVICE_KINDS = {'car': 0, 'base_station': 1}
+DEVICE_KIND_NAMES = {value: name for name, value in DEVICE_KINDS.items()}
+
+def digest_state(description):
+    # description is GameState.describe(); json keeps float reprs exact, so equal states hash equally.
+    encoded = json.dumps(description, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return hashlib.blake2b(encoded, digest_size=16).digest()
+
+def encode_record(record_type, payload):
+    return HEADER.pack(record_type, len(payload)) + payload
+
+class EventJournal:
+    """Append-only binary log of every input to the game logic.
+
+    The game loop records a tick (its current time) before each pass that
+    has events or due timers, then each event it handles; web threads
+    record the commands they apply. Records are packed on the calling
+    thread and appended to an in-memory buffer, and a background thread
+    writes the buffer every JOURNAL_FLUSH_INTERVAL and fsyncs every
+    JOURNAL_FSYNC_INTERVAL, so the hot path never touches the disk.
+    Nothing is ever dropped: a stalled disk only grows the buffer.
+
+    lock orders the journal against the state changes it describes. The
+    game loop holds it for a whole pass and a web thread while it records
+    and applies a command, so a replay of the records in file order makes
+    the same changes in the same order.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path = None
+        self._file = None
+        self.offset = 0 # file offset just past the last record appended, written or not
+        self._synced_offset = 0
+        self._synced = threading.Condition()
+        self._buffer = bytearray()
+        self._buffer_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._writer = None
+        self._closing = False
+        self._session_started = 0
+        self.records = 0
+        self.bytes_written = 0
+        self.fsyncs = 0
+        self.fsync_time_max = 0.0
+
+    @property
+    def enabled(self):
+        return self._file is not None
+
+    def open(self, path, resumed=False, started_at=None):
+        # resumed: the game state was recovered from a snapshot (and this journal) rather than starting empty.
+        # started_at: the time recorded for the session, which a replay of a resumed one detaches the devices at.
+        self.path = path
+        if os.path.exists(path):
+            # A crash can leave half a record at the end; new records must start on a record boundary.
+            reader = JournalReader(path)
+            for _ in reader:
+                pass
+            if reader.truncated_bytes:
+                os.truncate(path, reader.end_offset)
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(JOURNAL_MAGIC + bytes([JOURNAL_VERSION]))
+        self.offset = self._synced_offset = self._file.tell()
+        self._session_started = time.monotonic_ns()
+        self._append(REC_RESUME if resumed else REC_SESSION, SESSION.pack(time.time() if started_at is None else started_at))
+        self._writer = threading.Thread(target=self._run, name="journal-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def close(self):
+        if not self.enabled or self._closing: return
+        self._closing = True
+        self._wake.set()
+        self._writer.join()
+        self._file.close()
+        self._file = None
+
+    def tick(self, current_time):
+        self._append(REC_TICK, TICK.pack(current_time, time.monotonic_ns() - self._session_started))
+
+    def event(self, event):
+        # One game event from message_queue. WAKE events change nothing and are not recorded.
+        event_type = event[0]
+        if event_type == 'DEVICE_CONNECT':
+            device = event[1]
+            ip, port = device.connection.addr[:2]
+            self._append(REC_CONNECT, CONNECT.pack(DEVICE_KINDS[device.device_type], device.id, device.team_id, port) + ip.encode('ascii'))
+        elif event_type == 'DEVICE_DISCONNECT':
+            device = event[1]
+            ip, port = device.connection.addr[:2]
+            self._append(REC_DISCONNECT, DISCONNECT.pack(DEVICE_KINDS[device.device_type], device.id, port) + ip.encode('ascii'))
+        elif event_type == 'CAR_SEEN':
+            self._append(REC_CAR_SEEN, SIGHTING.pack(event[1], event[2]))
+        elif event_type == 'BS_SEEN':
+            self._append(REC_BS_SEEN, SIGHTING.pack(event[1], event[2]))
+        elif event_type == 'ZONE_ENTER':
+            self._append(REC_ZONE_ENTER, SIGHTING.pack(event[1], event[2]))
+        elif event_type == 'ZONE_LEAVE':
+            self._append(REC_ZONE_LEAVE, SIGHTING.pack(event[1], event[2]))
+        elif event_type == 'SET_TEAM':
+            self._append(REC_SET_TEAM, SET_TEAM.pack(DEVICE_KINDS[event[1]], event[2], event[3]))
+
+    def web_command(self, car_id, action, current_time):
+        self._append(REC_WEB_COMMAND, WEB_COMMAND.pack(current_time, car_id) + action.encode('ascii'))
+
+    def checkpoint(self, current_time, digest):
+        self._append(REC_CHECKPOINT, CHECKPOINT.pack(current_time) + digest)
+
+    def sync(self, offset, timeout):
+        """Wait until everything before offset is fsynced. Returns False on timeout or if the journal is closed."""
+        deadline = time.monotonic() + timeout
+        with self._synced:
+            while self._synced_offset < offset:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.enabled:
+                    return False
+                self._wake.set()
+                self._synced.wait(remaining)
+        return True
+
+    def report(self):
+        with self._buffer_lock:
+            summary = (f"[JOURNAL] {self.records} records, {self.bytes_written} bytes written, {self.fsyncs} fsyncs "
+                       f"(max {self.fsync_time_max * 1000:.1f}ms), {len(self._buffer)} bytes buffered")
+            self.records = 0
+            self.bytes_written = 0
+            self.fsyncs = 0
+            self.fsync_time_max = 0.0
+        return summary
+
+    def _append(self, record_type, payload):
+        if self._file is None: return
+        record = encode_record(record_type, payload)
+        with self._buffer_lock:
+            self._buffer += record
+            self.offset += len(record)
+            self.records += 1
+
+    def _run(self):
+        last_fsync = time.monotonic()
+        unsynced = False
+        while True:
+            closing = self._closing
+            # Someone waiting in sync() set the event: fsync now rather than on the usual cadence.
+            sync_requested = self._wake.is_set()
+            self._wake.clear()
+            with self._buffer_lock:
+                data = bytes(self._buffer)
+                self._buffer.clear()
+                written_offset = self.offset
+                self.bytes_written += len(data)
+            if data:
+                self._file.write(data)
+                self._file.flush()
+                unsynced = True
+            now = time.monotonic()
+            if unsynced and (closing or sync_requested or now - last_fsync >= JOURNAL_FSYNC_INTERVAL):
+                os.fsync(self._file.fileno())
+                last_fsync = time.monotonic()
+                unsynced = False
+                with self._buffer_lock:
+                    self.fsyncs += 1
+                    self.fsync_time_max = max(self.fsync_time_max, last_fsync - now)
+            if not unsynced:
+                with self._synced:
+                    self._synced_offset = written_offset
+                    self._synced.notify_all()
+            if closing:
+                return
+            self._wake.wait(JOURNAL_FLUSH_INTERVAL)
+
+class JournalReader:
+    """Iterates over the records of a journal file as tuples.
+
+        ('SESSION', started_at)
+        ('TICK', game_time, monotonic_ns)
+        ('DEVICE_CONNECT', device_type, device_id, team_id, (ip, port))
+        ('DEVICE_DISCONNECT', device_type, device_id, (ip, port))
+        ('CAR_SEEN', shooter_id, target_id)
+        ('BS_SEEN', bs_id, car_id)
+        ('ZONE_ENTER', zone, car_id)
+        ('ZONE_LEAVE', zone, car_id)
+        ('SET_TEAM', device_type, device_id, team_id)
+        ('WEB_COMMAND', game_time, car_id, action)
+        ('CHECKPOINT', game_time, digest)
+        ('RESUME', started_at)
+
+    Iteration begins after the file header, or at start (a record
+    boundary, such as a snapshot's journal offset). A record cut short by
+    a crash ends it; end_offset is where the last complete record ended
+    and truncated_bytes how much of the file was left over.
+    """
+
+    def __init__(self, path, start=None):
+        self.path = path
+        self.start = start
+        self.end_offset = None
+        self.truncated_bytes = 0
+
+    def __iter__(self):
+        with open(self.path, 'rb') as journal:
+            data = journal.read()
+        if data[:len(JOURNAL_MAGIC)] != JOURNAL_MAGIC:
+            raise ValueError(f"{self.path} is not an event journal")
+        if data[len(JOURNAL_MAGIC)] != JOURNAL_VERSION:
+            raise ValueError(f"{self.path} is journal version {data[len(JOURNAL_MAGIC)]}, expected {JOURNAL_VERSION}")
+        offset = len(JOURNAL_MAGIC) + 1 if self.start is None else self.start
+        while offset < len(data):
+            if offset + HEADER.size > len(data):
+                break
+            record_type, length = HEADER.unpack_from(data, offset)
+            start = offset + HEADER.size
+            if start + length > len(data):
+                break
+            offset = self.end_offset = start + length
+            yield decode_record(record_type, data[start:offset])
+        self.end_offset = offset
+        self.truncated_bytes = len(data) - offset
+
+def decode_record(record_type, payload):
+    if record_type == REC_SESSION:
+        return ('SESSION',) + SESSION.unpack(payload)
+    if record_type == REC_TICK:
+        return ('TICK',) + TICK.unpack(payload)
+    if record_type == REC_CONNECT:
+        kind, device_id, team_id, port = CONNECT.unpack_from(payload)
+        ip = payload[CONNECT.size:].decode('ascii')
+        return ('DEVICE_CONNECT', DEVICE_KIND_NAMES[kind], device_id, team_id, (ip, port))
+    if record_type == REC_DISCONNECT:
+        kind, device_id, port = DISCONNECT.unpack_from(payload)
+        ip = payload[DISCONNECT.size:].decode('ascii')
+        return ('DEVICE_DISCONNECT', DEVICE_KIND_NAMES[kind], device_id, (ip, port))
+    if record_type == REC_CAR_SEEN:
+        return ('CAR_SEEN',) + SIGHTING.unpack(payload)
+    if record_type == REC_BS_SEEN:
+        return ('BS_SEEN',) + SIGHTING.unpack(payload)
+    if record_type == REC_ZONE_ENTER:
+        return ('ZONE_ENTER',) + SIGHTING.unpack(payload)
+    if record_type == REC_ZONE_LEAVE:
+        return ('ZONE_LEAVE',) + SIGHTING.unpack(payload)
+    if record_type == REC_SET_TEAM:
+        kind, device_id, team_id = SET_TEAM.unpack(payload)
+        return ('SET_TEAM', DEVICE_KIND_NAMES[kind], device_id, team_id)
+    if record_type == REC_WEB_COMMAND:
+        game_time, car_id = WEB_COMMAND.unpack_from(payload)
+        return ('WEB_COMMAND', game_time, car_id, payload[WEB_COMMAND.size:].decode('ascii'))
+    if record_type == REC_CHECKPOINT:
+        (game_time,) = CHECKPOINT.unpack_from(payload)
+        return ('CHECKPOINT', game_time, payload[CHECKPOINT.size:])
+    if record_type == REC_RESUME:
+        return ('RESUME',) + SESSION.unpack(payload)
+    raise ValueError(f"unknown journal record type 0x{record_type:02X}")
@@ -0,0 +1,87 @@
+import threading
+from collections import deque
+
+# Upper bucket edges for the RTT histogram, in milliseconds. The last bucket catches everything slower.
+RTT_BUCKETS_MS = [2, 5, 10, 20, 50, 100, 200, 500, 1000]
+RTT_WINDOW = 120 # Most recent probes kept for the rolling histogram and loss rate.
+
+class LinkMonitor:
+    """Ping/pong bookkeeping for one device.
+
+    The server calls start_probe() when it sends a ping and record_pong()
+    when the echo comes back. A probe that has not been answered within
+    the timeout counts as lost the next time a probe is started.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._outstanding = {}
+        self._rtts = deque(maxlen=RTT_WINDOW)
+        self._outcomes = deque(maxlen=RTT_WINDOW) # True = answered, False = lost
+        self._sequence = 0
+        self.jitter = 0.0
+        self.last_rtt = None
+        self.sent = 0
+        self.received = 0
+        self.lost = 0
+
+    def start_probe(self, now, sequence_mask):
+        with self._lock:
+            for sequence, sent_at in list(self._outstanding.items()):
+                if now - sent_at > self.timeout:
+                    del self._outstanding[sequence]
+                    self._outcomes.append(False)
+                    self.lost += 1
+            self._sequence = (self._sequence + 1) & sequence_mask
+            self._outstanding[self._sequence] = now
+            self.sent += 1
+            return self._sequence
+
+    def record_pong(self, sequence, now):
+        with self._lock:
+            sent_at = self._outstanding.pop(sequence, None)
+            if sent_at is None:
+                return None # Late (already counted as lost) or unsolicited.
+            rtt = now - sent_at
+            if self.last_rtt is not None:
+                # Interarrival jitter estimate from RFC 3550.
+                self.jitter += (abs(rtt - self.last_rtt) - self.jitter) / 16
+            self.last_rtt = rtt
+            self._rtts.append(rtt)
+            self._outcomes.append(True)
+            self.received += 1
+            return rtt
+
+    def summary(self):
+        with self._lock:
+            rtts_ms = sorted(rtt * 1000 for rtt in self._rtts)
+            outcomes = list(self._outcomes)
+            histogram = {f"le_{edge}ms": 0 for edge in RTT_BUCKETS_MS}
+            histogram["gt_{}ms".format(RTT_BUCKETS_MS[-1])] = 0
+            for rtt in rtts_ms:
+                for edge in RTT_BUCKETS_MS:
+                    if rtt <= edge:
+                        histogram[f"le_{edge}ms"] += 1
+                        break
+                else:
+                    histogram["gt_{}ms".format(RTT_BUCKETS_MS[-1])] += 1
+
+            def percentile(fraction):
+                return round(rtts_ms[min(int(len(rtts_ms) * fraction), len(rtts_ms) - 1)], 3) if rtts_ms else None
+
+            return {
+                "probes_sent": self.sent,
+                "pongs_received": self.received,
+                "probes_lost": self.lost,
+                "loss_rate": round(outcomes.count(False) / len(outcomes), 4) if outcomes else None,
+                "rtt_ms": {
+                    "last": round(self.last_rtt * 1000, 3) if self.last_rtt is not None else None,
+                    "min": round(rtts_ms[0], 3) if rtts_ms else None,
+                    "p50": percentile(0.50),
+                    "p95": percentile(0.95),
+                    "max": round(rtts_ms[-1], 3) if rtts_ms else None,
+                },
+                "jitter_ms": round(self.jitter * 1000, 3),
+                "histogram": histogram,
+            }
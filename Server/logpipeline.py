@@ -0,0 +1,99 @@
+import atexit
+import json
+import sys
+import threading
+import time
+from datetime import datetime
+from queue import Queue, Full, Empty
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+
+LOG_QUEUE_SIZE = 10000 # records waiting for the writer. When full, new records are dropped and counted.
+LOG_BATCH_SIZE = 256 # most records formatted and written per flush
+
+class LogPipeline:
+    """Logging that never blocks the thread doing the logging.
+
+    log() only checks the level and puts a tuple on a bounded queue; the
+    timestamp is formatted and the line written by a background thread,
+    one flush per batch. If the writer falls behind (a slow terminal or
+    journald) records are dropped and counted rather than slowing the game
+    down. Output is either the classic "[timestamp] message" text or one
+    JSON object per line.
+    """
+
+    def __init__(self, stream=None, level=INFO, fmt='text', maxsize=LOG_QUEUE_SIZE):
+        self.stream = stream if stream is not None else sys.stdout
+        self.level = level
+        self.fmt = fmt
+        self._queue = Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._writer = None
+        self.written = 0
+        self.dropped = 0
+
+    def enabled_for(self, level):
+        return level >= self.level
+
+    def log(self, level, message, **fields):
+        if level < self.level: return
+        if self._writer is None:
+            self.start()
+        try:
+            self._queue.put_nowait((time.time(), level, message, fields))
+        except Full:
+            with self._lock:
+                self.dropped += 1
+
+    def start(self):
+        with self._lock:
+            if self._writer is not None: return
+            self._writer = threading.Thread(target=self._run, name="log-writer", daemon=True)
+            self._writer.start()
+        atexit.register(self.flush)
+
+    def flush(self, timeout=1.0):
+        # Wait (briefly) for everything already queued to be written, e.g. before the process exits.
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def report(self):
+        with self._lock:
+            summary = f"[LOG STATS] {self.written} records written, {self.dropped} dropped, {self._queue.qsize()} queued"
+            self.written = 0
+            self.dropped = 0
+        return summary
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                self.stream.write(''.join(self._format(record) for record in batch))
+                self.stream.flush()
+            except Exception:
+                pass # Nowhere left to report a broken log stream.
+            with self._lock:
+                self.written += len(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _format(self, record):
+        created, level, message, fields = record
+        if self.fmt == 'json':
+            entry = {'ts': datetime.fromtimestamp(created).isoformat(timespec='milliseconds'),
+                     'level': LEVEL_NAMES.get(level, str(level)), 'msg': message}
+            entry.update(fields)
+            return json.dumps(entry, default=str) + '\n'
+        timestamp = datetime.fromtimestamp(created).strftime("[%Y-%m-%d %H:%M:%S]")
+        return f"{timestamp} {message}\n"
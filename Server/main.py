@@ -1,56 +1,96 @@
 import socket
 import threading
 import sys
+import os
 import time
-from queue import Queue
-from flask import Flask, render_template_string, jsonify
-from datetime import datetime
+import signal
+from queue import Empty
+from flask import Flask, Response, jsonify, abort
+try:
+    from flask_sock import Sock
+    from simple_websocket import ConnectionClosed
+except ImportError:
+    # Optional: without flask-sock the control page falls back to one HTTP request per command.
+    Sock = None
 import json
+import asyncio
+import argparse
+import functools
+from timers import TimerHeap
+from framing import StreamFramer, framing_stats
+from outbound import OutboundQueue, outbound_stats, send_batch
+from linkquality import LinkMonitor
+from asgi import ControlApp, create_web_server, uvicorn
+from webcache import CachedPage, PageCache
+from metrics import registry, TimedQueue, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from statestream import StateStream, KEEPALIVE, KEEPALIVE_INTERVAL
+from logpipeline import LogPipeline, LEVELS, DEBUG, INFO, ERROR
+from journal import EventJournal, JournalReader, digest_state
+from snapshot import SnapshotWriter, load_snapshot
+from devices import DeviceRegistry, STATE_DISABLED
+from hitfilter import HitFilter
+from presence import ZonePresence
+from roster import load_roster
+from heartbeat import HeartbeatMonitor
+from udpdrive import UdpDriveChannel
+from arenas import load_arenas, receive_handoff
+from protocol import (CommandFrames, HELLO_PREFIX, BINARY_PROTOCOL_NAME, PROTOCOL_VERSION, FRAME_SIZE, SEQUENCE_MASK,
+                      DEVICE_OPCODE_EVENTS, OP_PONG, UDP_DRIVE_OPTION, parse_hello, decode_frame)
 
 # --- Helper function for consistent logging ---
-def log_with_timestamp(message):
-    timestamp = datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
-    print(f"{timestamp} {message}")
+# Records are queued and written by a background thread, so logging never blocks a sender or the game loop.
+log_pipeline = LogPipeline(level=DEBUG)
+
+def log_with_timestamp(message, level=INFO, **fields):
+    log_pipeline.log(level, message, **fields)
 
 # --- Configuration ---
 HOST = '0.0.0.0'
 PORT = 5000
-TEAMS = {1: "Team Alpha", 2: "Team Beta"}
-
-# Mappings of IP addresses to their IR addresses (for CARS ONLY) and IDs
-IP_TO_CAR = {
-    '192.168.77.51': {'id': 1, 'ir_address': 0x01},
-    '192.168.77.52': {'id': 2, 'ir_address': 0x02},
-    '192.168.77.53': {'id': 3, 'ir_address': 0x03},
-    '192.168.77.54': {'id': 4, 'ir_address': 0x04},
-    '192.168.77.55': {'id': 5, 'ir_address': 0x05},
-}
-
-# Mappings of IP addresses to their IDs (for BASE STATIONS ONLY)
-IP_TO_BASE_STATION = {
-    '192.168.77.11': {'id': 1},
-    '192.168.77.12': {'id': 2},
-}
-
-# Derived mappings from the primary configuration
-IR_ADDRESS_TO_CAR_ID = {car['ir_address']: car['id'] for car in IP_TO_CAR.values()}
-CAR_IR_ADDRESSES = list(IR_ADDRESS_TO_CAR_ID.keys())
-
-CAR_TEAM_MAPPING = {
-    1: 1, # Car 1 is on Team Alpha
-    2: 1, # Car 2 is on Team Alpha
-    3: 2, # Car 3 is on Team Beta
-    4: 2, # Car 4 is on Team Beta
-}
-BASE_STATION_TEAM_MAPPING = {
-    1: 1, # Base Station 1 is for Team Alpha
-    2: 2, # Base Station 2 is for Team Beta
-}
+IDENTITY_MODE = 'ip' # 'ip' (devices are known by address, see ROSTER_PATH) or 'hello' (devices name themselves in their HELLO line)
+DEVICE_SERVER_MODE = 'asyncio' # 'asyncio' (one event loop for all devices) or 'threads' (one thread per device)
+WEB_PORT = 8000
+WEB_SERVER_MODE = 'dev' # 'dev' (Flask's development server in its own thread) or 'asgi' (uvicorn, sharing the device event loop)
+ARENA_NAME = None # set when this process is one arena of a multi-arena server (arenas.py)
+ARENA_CONFIG_PATH = None # the arenas.py config this arena's roster is read from
+DEVICE_HANDOFF_FD = None # Unix socket the arena supervisor passes accepted device sockets over, instead of listening on PORT
+OUTBOUND_WRITE_BUFFER_HIGH = 256 # bytes buffered in the asyncio transport before a device's writer pauses
+ROSTER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'roster.json') # teams, cars and base stations; see roster.py
+ROSTER_WATCH_INTERVAL = 2.0 # seconds between checks of ROSTER_PATH for changes, which reload it as SIGHUP does. 0 turns watching off.
 
 # Game Constants
 PENALTY_DURATION = 10 # seconds
 SAFE_ZONE_TIMEOUT = 2 # seconds
+ZONE_PRESENCE_TTL = SAFE_ZONE_TIMEOUT # seconds without a BS_SEEN report before a car has left a zone. 0 passes every report to the game loop.
 COMMAND_TIMEOUT = 2 # seconds. If no command received in this time, assume disconnect.
+RECONNECT_GRACE = 30 # seconds a disconnected car's game state is kept for it to reconnect. 0 forgets it straight away.
+HIT_DEDUP_WINDOW = 0.25 # seconds. Repeats of a CAR_SEEN report (same shooter, same target) within this time are dropped. 0 keeps them all.
+HIT_DEDUP_MAX_PAIRS = 4096 # (shooter, target) pairs the filter remembers at once
+
+# Link Quality Probing
+PING_ADDRESS = 0x81 # ASCII ping is "81XX" where XX is the probe sequence; the device answers "PONG:XX"
+PING_INTERVAL = 1.0 # seconds between RTT probes to each device. 0 disables probing.
+PING_TIMEOUT = 1.0 # seconds. A probe not answered within this time counts as lost.
+HEARTBEAT_INTERVAL = 0.1 # seconds between heartbeat pings to each device, which then also serve as the RTT probes. 0 turns heartbeats off.
+HEARTBEAT_TIMEOUT = 0.5 # seconds. A device silent for longer has lost power or left the network, and its connection is closed.
+
+# UDP Drive Commands
+UDP_DRIVE = False # send drive commands as UDP datagrams to cars that offer a UDP port in their HELLO line; see udpdrive.py
+UDP_DRIVE_REPEAT_INTERVAL = 0.05 # seconds between repeats of a car's latest drive frame, in case a datagram was lost
+UDP_DRIVE_REPEATS = 4 # times the latest drive frame is repeated. 0 sends each one once.
+
+# Game Loop Constants
+LOOP_MAX_WAIT = 1.0 # seconds. Longest the game loop blocks when no timer is due.
+LOOP_STATS_INTERVAL = 10 # seconds between game loop statistics reports.
+
+# Event Journal
+JOURNAL_PATH = None # file every game input is appended to, for replay.py. None disables the journal.
+JOURNAL_CHECKPOINT_INTERVAL = 10 # seconds between state digests in the journal, which a replay checks itself against
+
+# Snapshots and Crash Recovery
+SNAPSHOT_PATH = None # file the game state is saved to and recovered from on startup. None disables snapshots.
+SNAPSHOT_INTERVAL = 1.0 # seconds between snapshots
+SNAPSHOT_MAX_AGE = 300 # seconds. An older snapshot is from an earlier game and is not recovered.
 
 WEB_COMMANDS = {
     'forward':  {'address': 0x02, 'command': 0x01},
@@ -60,24 +100,182 @@ WEB_COMMANDS = {
     'stop':     {'address': 0x02, 'command': 0x05},
     'shoot':    {'address': 0x03, 'command': 0x01},
 }
+
+# Car attributes that make up its game state: saved in snapshots, digested in the journal, and kept by a car that
+# reconnects after a server restart.
+CAR_GAME_FIELDS = ('is_disabled', 'disabled_until_time', 'has_flag', 'is_safe', 'last_seen_safe_time', 'is_moving', 'last_command_time')
+
+# Drive commands only matter until the next one, so a device's outbound queue keeps just the latest.
+MOVEMENT_COMMAND_ADDRESS = 0x02
+
+# Commands that get pre-built binary frames for every device: web controls plus disable/enable.
+GAME_COMMANDS = [(0x80, 0x01), (0x80, 0x02)]
+PREBUILT_COMMANDS = [(c['address'], c['command']) for c in WEB_COMMANDS.values()] + GAME_COMMANDS
 # --- End Configuration ---
 
 # Thread-safe data structures
 active_clients = {}
 active_clients_lock = threading.Lock()
-message_queue = Queue()
+
+# --- Metrics, scraped at /metrics ---
+EVENT_QUEUE_WAIT = registry.histogram('omc_event_queue_wait_seconds', "Time an event waits in message_queue before the game loop takes it.")
+EVENT_QUEUE_DEPTH = registry.gauge('omc_event_queue_depth', "Events waiting in message_queue.")
+EVENTS_PROCESSED = registry.counter('omc_events_processed_total', "Game events handled by the game loop, by type.", ['type'])
+LOOP_TICK_SECONDS = registry.histogram('omc_loop_tick_seconds', "Time for one game loop pass: due timers, the event batch and publishing state.")
+WEB_COMMAND_SECONDS = registry.histogram('omc_web_command_seconds', "Time to handle one web command until it is queued for the car.", ['channel'])
+SESSION_RESUME_SECONDS = registry.histogram('omc_session_resume_seconds', "Time from a car's new connection being accepted to its kept game state being back in play.")
+HEARTBEAT_EVICTIONS = registry.counter('omc_heartbeat_evictions_total', "Device connections closed because the device stopped answering heartbeats.")
+SEND_DATA_SECONDS = registry.histogram('omc_send_data_seconds', "Time a send_data call takes to queue one message for a device.")
+ACTIVE_CONNECTIONS = registry.gauge('omc_active_connections', "Identified device connections.")
+CAR_SEEN_REPORTS = registry.counter('omc_car_seen_reports_total', "CAR_SEEN reports from cars, by whether the hit filter passed them to the game loop.", ['result'])
+BS_SEEN_REPORTS = registry.counter('omc_bs_seen_reports_total', "BS_SEEN reports from base stations, by whether they were passed to the game loop as a zone entry.", ['result'])
+CONNECTED_DEVICES = registry.gauge('omc_connected_devices', "Devices registered in the game state, by type.", ['type'])
+
+message_queue = TimedQueue(EVENT_QUEUE_WAIT)
+EVENT_QUEUE_DEPTH.set_function(message_queue.qsize)
+ACTIVE_CONNECTIONS.set_function(lambda: len(active_clients))
+
+class LoopStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.wakeups = 0
+        self.batches = 0
+        self.events = 0
+        self.max_batch_size = 0
+        self.batch_time_total = 0.0
+        self.batch_time_max = 0.0
+
+    def record_wakeup(self):
+        with self.lock:
+            self.wakeups += 1
+
+    def record_batch(self, batch_size, batch_time):
+        with self.lock:
+            self.batches += 1
+            self.events += batch_size
+            self.max_batch_size = max(self.max_batch_size, batch_size)
+            self.batch_time_total += batch_time
+            self.batch_time_max = max(self.batch_time_max, batch_time)
+
+    def report(self, interval, cpu_time):
+        with self.lock:
+            avg_batch_ms = (self.batch_time_total / self.batches * 1000) if self.batches else 0.0
+            summary = (f"[LOOP STATS] {self.wakeups / interval:.1f} wakeups/s, {self.events} events in {self.batches} batches "
+                       f"(max {self.max_batch_size}/batch), batch time avg {avg_batch_ms:.3f}ms max {self.batch_time_max * 1000:.3f}ms, "
+                       f"process CPU {cpu_time / interval * 100:.1f}%")
+            self.reset()
+        return summary
+
+loop_stats = LoopStats()
+hit_filter = HitFilter(HIT_DEDUP_WINDOW, HIT_DEDUP_MAX_PAIRS)
+zone_presence = ZonePresence(ZONE_PRESENCE_TTL)
+drive_channel = UdpDriveChannel(UDP_DRIVE_REPEAT_INTERVAL, UDP_DRIVE_REPEATS)
+roster = load_roster(ROSTER_PATH) # never changed in place: use_roster() swaps in a new one
+event_journal = EventJournal()
+snapshot_writer = SnapshotWriter()
 
 class GameState:
     def __init__(self):
-        self.cars = {}
-        self.base_stations = {}
+        self.devices = DeviceRegistry()
+        self.cars = self.devices.cars # id -> Car; the registry keeps its indexes in step through add_car/remove_car
+        self.base_stations = self.devices.base_stations
         self.flags = {1: None, 2: None}
+        self.zones = set() # (zone, car id) between each ZONE_ENTER and its ZONE_LEAVE, i.e. the zone presence table as the game saw it
+        self.timers = TimerHeap()
+        self.loop_thread_id = None
+        self.cars_version = 0 # bumped whenever a car joins or leaves, so cached pages listing cars can tell they are stale
+        self.changed_cars = set() # ids of cars whose streamed fields (statestream.CAR_FIELDS) changed or that joined or left
+        self.flags_changed = False # since the game loop last published to the state stream
+
+    def schedule_timer(self, key, deadline, callback):
+        if self.timers.schedule(key, deadline, callback) and threading.get_ident() != self.loop_thread_id:
+            # The game loop may be asleep waiting on a later deadline; make it recompute.
+            message_queue.put(('WAKE',))
+
+    def cancel_car_timers(self, car_id):
+        self.timers.cancel_matching(lambda key: key[1] == car_id)
+
+    def schedule_probe(self, device, current_time):
+        # With heartbeats on, the heartbeat pings measure the links and these probes are not needed.
+        if PING_INTERVAL <= 0 or HEARTBEAT_INTERVAL > 0 or not device.connection.is_connected: return
+        def probe(now):
+            device.send_ping()
+            self.schedule_probe(device, now)
+        self.schedule_timer(('ping', device.device_type, device.id), current_time + PING_INTERVAL, probe)
+
+    def cancel_probe(self, device_type, device_id):
+        self.timers.cancel(('ping', device_type, device_id))
+
+    def run_due_timers(self, current_time):
+        for _, callback in self.timers.pop_due(current_time):
+            callback(current_time)
+
+    def car_timer(self, kind, car_id):
+        # The callback for each kind of per-car timer, so timers can be rebuilt from a snapshot.
+        if kind == 'reenable':
+            return lambda now: self.reenable_car(car_id)
+        if kind == 'safe_expiry':
+            return lambda now: self.update_car_safety(car_id, False)
+        if kind == 'command_timeout':
+            return lambda now: self.command_timed_out(car_id, now)
+        if kind == 'grace':
+            return lambda now: self.end_grace(car_id)
+        raise ValueError(f"unknown car timer {kind}")
+
+    def describe(self):
+        # The game state as plain data: what snapshots save, journal checkpoints digest and a replay must reproduce.
+        return {
+            'cars': {car.id: dict(describe_device(car), **{field: getattr(car, field) for field in CAR_GAME_FIELDS})
+                     for car in self.cars.values()},
+            'base_stations': {bs.id: describe_device(bs) for bs in self.base_stations.values()},
+            'flags': dict(self.flags),
+            # Link probes are not game state, and a replay does not send them.
+            'timers': sorted([list(key), deadline] for key, deadline in self.timers.items() if key[0] != 'ping'),
+        }
 
     def add_car(self, car_obj):
-        self.cars[car_obj.id] = car_obj
-    
+        self.devices.add(car_obj)
+        self.cars_version += 1
+        self.changed_cars.add(car_obj.id)
+
+    def remove_car(self, car_obj):
+        # Returns False if car_obj has already been replaced by a newer connection with the same id.
+        if not self.devices.remove(car_obj):
+            return False
+        self.cars_version += 1
+        self.changed_cars.add(car_obj.id)
+        return True
+
     def add_base_station(self, bs_obj):
-        self.base_stations[bs_obj.id] = bs_obj
+        self.devices.add(bs_obj)
+
+    def remove_base_station(self, bs_obj):
+        return self.devices.remove(bs_obj)
+
+    def detach_car(self, car, current_time):
+        # The connection dropped: keep the car and its timers for RECONNECT_GRACE in case it comes straight back.
+        car.restored = True
+        self.cars_version += 1
+        self.cancel_probe('car', car.id)
+        self.schedule_timer(('grace', car.id), current_time + RECONNECT_GRACE, self.car_timer('grace', car.id))
+
+    def end_grace(self, car_id):
+        car = self.get_car_by_id(car_id)
+        if car and car.restored and self.remove_car(car):
+            self.cancel_car_timers(car_id)
+            log_with_timestamp(f"[GAME LOGIC] CAR {car_id} did not reconnect within {RECONNECT_GRACE}s. Its game state is gone.")
+
+    def set_team(self, device, team_id):
+        # Through the registry, so its team index moves the device too.
+        self.devices.remove(device)
+        device.team_id = team_id
+        self.devices.add(device)
+        if device.device_type == 'car':
+            self.cars_version += 1
+            self.changed_cars.add(device.id)
 
     def get_car_by_id(self, car_id):
         return self.cars.get(car_id)
@@ -86,125 +284,397 @@ class GameState:
         return self.base_stations.get(bs_id)
 
     def get_device_by_ip(self, ip):
-        for car in self.cars.values():
-            if car.ip == ip: return car
-        for bs in self.base_stations.values():
-            if bs.ip == ip: return bs
-        return None
+        devices = self.devices.devices_at(ip)
+        return devices[0] if devices else None
 
     def update_car_safety(self, car_id, is_safe):
         car = self.get_car_by_id(car_id)
         if car:
             if car.is_safe != is_safe:
                 car.is_safe = is_safe
+                self.changed_cars.add(car_id)
                 if is_safe:
-                    log_with_timestamp(f"[GAME STATE] Car {car_id} ({TEAMS[car.team_id]}) is now in a safe zone.")
+                    log_with_timestamp(f"[GAME STATE] Car {car_id} ({roster.team_name(car.team_id)}) is now in a safe zone.")
                 else:
-                    log_with_timestamp(f"[GAME STATE] Car {car_id} ({TEAMS[car.team_id]}) has left the safe zone.")
+                    log_with_timestamp(f"[GAME STATE] Car {car_id} ({roster.team_name(car.team_id)}) has left the safe zone.")
+            if not is_safe:
+                self.timers.cancel(('safe_expiry', car_id))
+
+    def disable_car(self, car, current_time):
+        car.is_disabled = True
+        car.disabled_until_time = current_time + PENALTY_DURATION
+        self.changed_cars.add(car.id)
+        self.schedule_timer(('reenable', car.id), car.disabled_until_time, self.car_timer('reenable', car.id))
+        car.send_command(0x80, 0x01)
+
+    def reenable_car(self, car_id):
+        car = self.get_car_by_id(car_id)
+        if car and car.is_disabled:
+            car.is_disabled = False
+            car.disabled_until_time = 0
+            self.changed_cars.add(car_id)
+            log_with_timestamp(f"[GAME LOGIC] CAR {car.id} is no longer disabled and can now resume playing.")
+            car.send_command(0x80, 0x02)
+
+    def mark_car_safe(self, car, current_time):
+        car.last_seen_safe_time = current_time
+        self.schedule_timer(('safe_expiry', car.id), current_time + SAFE_ZONE_TIMEOUT, self.car_timer('safe_expiry', car.id))
+
+    def record_web_command(self, car, action, current_time):
+        car.last_command_time = current_time
+        car.is_moving = (action not in ['stop', 'shoot'])
+        if car.is_moving:
+            self.schedule_timer(('command_timeout', car.id), current_time + COMMAND_TIMEOUT, self.car_timer('command_timeout', car.id))
+        else:
+            self.timers.cancel(('command_timeout', car.id))
+
+    def command_timed_out(self, car_id, current_time):
+        car = self.get_car_by_id(car_id)
+        # A command may have landed between the timer popping and this callback running.
+        if car and car.is_moving and (current_time - car.last_command_time) >= COMMAND_TIMEOUT:
+            log_with_timestamp(f"[GAME LOGIC] Car {car.id} web control timed out. Sending STOP command.")
+            command_data = WEB_COMMANDS.get('stop')
+            car.send_command(command_data['address'], command_data['command'])
+            car.is_moving = False
 
 class Device:
-    def __init__(self, device_id, ip, client_thread):
+    # Slotted: a large simulated arena holds hundreds of these, and every attribute is known up front.
+    __slots__ = ('id', 'ip', 'connection', 'status', 'last_seen', 'command_frames', 'link', 'restored')
+
+    def __init__(self, device_id, ip, connection):
         self.id = device_id
         self.ip = ip
-        self.client_thread = client_thread
+        self.connection = connection
         self.status = "connected"
         self.last_seen = time.time()
+        self.command_frames = CommandFrames(device_id, PREBUILT_COMMANDS)
+        self.link = LinkMonitor(PING_TIMEOUT)
+        self.restored = False # waiting to reconnect: from before a server restart, or a car within its RECONNECT_GRACE
 
     def send_command(self, address, command):
-        self.client_thread.send_data(f"{address:02X}{command:02X}\n")
+        coalesce = (address == MOVEMENT_COMMAND_ADDRESS)
+        connection = self.connection
+        with connection.protocol_lock:
+            if connection.binary:
+                connection.send_data(self.command_frames.build(address, command), coalesce)
+            else:
+                connection.send_data(f"{address:02X}{command:02X}\n", coalesce)
+
+    def answers_heartbeats(self):
+        # Firmware on the binary protocol always answers pings; older firmware must have answered one already.
+        return self.connection.binary or self.link.received > 0
+
+    def send_ping(self):
+        connection = self.connection
+        with connection.protocol_lock:
+            if connection.binary:
+                sequence = self.link.start_probe(time.monotonic(), SEQUENCE_MASK)
+                connection.send_data(self.command_frames.ping(sequence))
+            else:
+                sequence = self.link.start_probe(time.monotonic(), 0xFF)
+                connection.send_data(f"{PING_ADDRESS:02X}{sequence:02X}\n")
+
+def describe_device(device):
+    return {'addr': list(device.connection.addr[:2]), 'team_id': device.team_id, 'restored': device.restored}
+
+def default_ir_address(car_id):
+    # A simulated car's IR address is its id; real cars use the address in the roster.
+    if IDENTITY_MODE == 'hello':
+        return car_id
+    return roster.ir_address_by_car_id.get(car_id, car_id)
+
+def default_team(team_mapping, device_id):
+    # Devices missing from the roster (e.g. simulated ones) take turns between its teams.
+    return team_mapping.get(device_id) or roster.team_ids[(device_id - 1) % len(roster.team_ids)]
 
 class Car(Device):
-    def __init__(self, car_id, ip, client_thread):
-        super().__init__(car_id, ip, client_thread)
+    __slots__ = ('device_type', 'team_id', 'ir_address', 'is_disabled', 'disabled_until_time', 'has_flag', 'is_safe',
+                 'last_seen_safe_time', 'control_url', 'last_command_time', 'is_moving', 'drive_link')
+
+    def __init__(self, car_id, ip, connection, team_id=None, ir_address=None):
+        super().__init__(car_id, ip, connection)
         self.device_type = "car"
-        self.team_id = CAR_TEAM_MAPPING.get(car_id)
+        self.team_id = team_id or default_team(roster.car_teams, car_id)
+        self.ir_address = ir_address if ir_address is not None else default_ir_address(car_id)
         self.is_disabled = False
         self.disabled_until_time = 0
         self.has_flag = False
         self.is_safe = False
         self.last_seen_safe_time = 0.0
-        self.control_url = f"http://{socket.gethostbyname(socket.gethostname())}:8000/control/{self.id}"
-        self.last_command_time = time.time()
+        self.control_url = f"http://{server_address()}:{WEB_PORT}/control/{self.id}"
+        self.last_command_time = 0.0 # only read while is_moving, which the first web command sets
         self.is_moving = False
+        self.drive_link = None # set when drive commands go over UDP
+
+    def send_command(self, address, command):
+        if address == MOVEMENT_COMMAND_ADDRESS and self.drive_link is not None:
+            drive_channel.send(self.drive_link, command)
+        else:
+            super().send_command(address, command)
 
 class BaseStation(Device):
-    def __init__(self, bs_id, ip, client_thread):
-        super().__init__(bs_id, ip, client_thread)
+    __slots__ = ('device_type', 'team_id')
+
+    def __init__(self, bs_id, ip, connection, team_id=None):
+        super().__init__(bs_id, ip, connection)
         self.device_type = "base_station"
-        self.team_id = BASE_STATION_TEAM_MAPPING.get(bs_id)
+        self.team_id = team_id or default_team(roster.base_station_teams, bs_id)
+
+@functools.lru_cache(maxsize=1)
+def server_address():
+    return socket.gethostbyname(socket.gethostname())
+
+def identify_device(ip, connection):
+    current = roster
+    car_entry = current.cars_by_ip.get(ip)
+    if car_entry:
+        return Car(car_entry.id, ip, connection, car_entry.team, car_entry.ir_address)
+    bs_entry = current.base_stations_by_ip.get(ip)
+    if bs_entry:
+        return BaseStation(bs_entry.id, ip, connection, bs_entry.team)
+    return None
+
+def identify_from_hello(options, ip, connection):
+    # HELLO:role=car,id=7,team=1 -> Car 7 on Team Alpha. Used in 'hello' identity mode, where the IP address means nothing.
+    try:
+        device_id = int(options.get('id', ''))
+    except ValueError:
+        return None
+    team_id = options.get('team', '')
+    team_id = int(team_id) if team_id.isdigit() and int(team_id) in roster.teams else None
+    role = options.get('role')
+    if role == 'car' and 0 < device_id <= 0xFF: # a car's id doubles as its one-byte IR address
+        return Car(device_id, ip, connection, team_id)
+    if role == 'base_station' and 0 < device_id <= 0xFFFF: # the journal records device ids as 16 bits
+        return BaseStation(device_id, ip, connection, team_id)
+    return None
+
+def car_id_for_ir_address(ir_address):
+    car = game_state.devices.car_by_ir_address(ir_address)
+    if car is not None:
+        return car.id
+    # Not registered (yet): the game loop decides what a sighting of an unknown car means.
+    if IDENTITY_MODE == 'hello':
+        return ir_address
+    return roster.car_id_by_ir_address.get(ir_address)
+
+def report_ir_sighting(device, event_type, seen_ir_address):
+    if event_type == "CAR_SEEN" and device.device_type != "car": return
+    if event_type == "BS_SEEN" and device.device_type != "base_station": return
+    seen_car_id = car_id_for_ir_address(seen_ir_address)
+    if seen_car_id is None:
+        return
+    if event_type == "CAR_SEEN":
+        # Filtered here, on the device's thread, so a burst of decodes of one shot costs the game loop one event.
+        if not hit_filter.accept(device.id, seen_car_id, time.monotonic()):
+            CAR_SEEN_REPORTS.labels('duplicate').inc()
+            return
+        CAR_SEEN_REPORTS.labels('accepted').inc()
+    elif zone_presence.enabled:
+        # A parked car is reported on every broadcast; only its arrival in the zone goes to the game loop.
+        if not zone_presence.seen(device.team_id, seen_car_id, time.time()):
+            BS_SEEN_REPORTS.labels('coalesced').inc()
+            return
+        BS_SEEN_REPORTS.labels('entry').inc()
+        message_queue.put(('ZONE_ENTER', device.team_id, seen_car_id))
+        return
+    message_queue.put((event_type, device.id, seen_car_id))
+
+def handle_device_message(device, frame):
+    # frame is one complete line as bytes, e.g. b"CAR_SEEN:03". Returns False if it could not be parsed.
+    try:
+        event_type, separator, payload = frame.partition(b':')
+        if not separator: raise ValueError
+
+        if event_type == b"CAR_SEEN":
+            report_ir_sighting(device, "CAR_SEEN", int(payload, 16))
+        elif event_type == b"BS_SEEN":
+            report_ir_sighting(device, "BS_SEEN", int(payload, 16))
+        elif event_type == b"PONG":
+            device.link.record_pong(int(payload, 16), time.monotonic())
+        return True
+    except (ValueError, IndexError):
+        log_with_timestamp(f"[{device.ip}] [ERROR] Invalid message format: {frame.decode('utf-8', 'replace')}.", level=ERROR)
+        return False
+
+def handle_device_binary_frame(device, frame):
+    try:
+        opcode, _, payload, sequence = decode_frame(frame)
+    except ValueError as e:
+        log_with_timestamp(f"[{device.ip}] [ERROR] Invalid binary frame {frame.hex()}: {e}.", level=ERROR)
+        return False
+    if opcode == OP_PONG:
+        device.link.record_pong(sequence, time.monotonic())
+        return True
+    event_type = DEVICE_OPCODE_EVENTS.get(opcode)
+    if event_type is None:
+        log_with_timestamp(f"[{device.ip}] [ERROR] Unknown binary opcode 0x{opcode:02X}.", level=ERROR)
+        return False
+    report_ir_sighting(device, event_type, payload)
+    return True
+
+def negotiate_protocol(connection, frame):
+    options = parse_hello(frame)
+    if options.get('proto') == BINARY_PROTOCOL_NAME:
+        # The acknowledgement is the first binary frame; everything after it in both directions is binary.
+        # Queued under protocol_lock, so a ping or web command from another thread goes either before it in
+        # ASCII or after it in binary.
+        with connection.protocol_lock:
+            connection.send_data(connection.device.command_frames.hello_ack(HEARTBEAT_INTERVAL))
+            connection.binary = True
+            connection.framer.use_fixed_frames(FRAME_SIZE, PROTOCOL_VERSION)
+        log_with_timestamp(f"[{connection.addr}] Switched to binary protocol ({BINARY_PROTOCOL_NAME}).")
+        open_drive_link(connection, options.get(UDP_DRIVE_OPTION, ''))
+    return True
+
+def open_drive_link(connection, port):
+    # Drive frames are binary, so only a car on the binary protocol can take them over UDP.
+    device = connection.device
+    if not drive_channel.enabled or device.device_type != 'car' or device.drive_link is not None:
+        return
+    if not port.isdigit() or not 0 < int(port) <= 0xFFFF:
+        return
+    device.drive_link = drive_channel.link(device.id, (connection.addr[0], int(port)))
+    log_with_timestamp(f"[{connection.addr}] Drive commands for car {device.id} go over UDP to port {port}.")
+
+def identify_connection(connection, frame):
+    # First frame on a connection in 'hello' identity mode: it must say which device this is.
+    device = identify_from_hello(parse_hello(frame), connection.addr[0], connection) if frame.startswith(HELLO_PREFIX) else None
+    if device is None:
+        log_with_timestamp(f"[{connection.addr}] [ERROR] Expected HELLO with role and id, got: {frame.decode('utf-8', 'replace')}.", level=ERROR)
+        return False
+    connection.device = device
+    # Acknowledge the protocol before registering: every command and heartbeat after that is in the protocol agreed on.
+    negotiate_protocol(connection, frame)
+    register_device(connection.addr, device)
+    return True
+
+def handle_device_frames(connection, frames):
+    if connection.device is None and IDENTITY_MODE != 'hello':
+        return
+    if frames and connection.device:
+        connection.device.last_seen = time.time()
+    for frame in frames:
+        if connection.device is None:
+            parsed = identify_connection(connection, frame)
+        elif connection.binary:
+            parsed = handle_device_binary_frame(connection.device, frame)
+        elif frame.startswith(HELLO_PREFIX):
+            parsed = negotiate_protocol(connection, frame)
+        else:
+            parsed = handle_device_message(connection.device, frame)
+        if not parsed:
+            connection.framer.record_parse_error()
+
+def describe_sent(data):
+    # ASCII protocol messages are logged as text, binary frames (which start with 0xB1) as hex.
+    return data.decode('ascii').strip() if data.isascii() else data.hex()
+
+def is_ping(data):
+    if data[:1] == bytes([PROTOCOL_VERSION]):
+        return data[1:2] == bytes([PING_ADDRESS])
+    return data.startswith(b"%02X" % PING_ADDRESS)
+
+def log_sent(addr, batch):
+    # Per-message lines are debug level so they can be switched off during a match. Heartbeat pings, ten a second
+    # per device, would drown out everything else; /api/links and the [HEARTBEAT] line cover them.
+    if not log_pipeline.enabled_for(DEBUG): return
+    for data in batch:
+        if is_ping(data):
+            continue
+        sent = describe_sent(data)
+        log_with_timestamp(f"[{addr}] Sent: {sent}", level=DEBUG, device=addr[0], sent=sent)
+
+def encode_outbound(data):
+    return data.encode('utf-8') if isinstance(data, str) else data
+
+def register_device(addr, device):
+    # Keyed by (ip, port): in 'hello' identity mode many devices can share one address.
+    with active_clients_lock:
+        active_clients[addr] = device
+    message_queue.put(('DEVICE_CONNECT', device))
+    if device.device_type == 'car':
+        zone_presence.forget_car(device.id)
+
+def unregister_device(addr, device):
+    if device:
+        log_with_timestamp(f"[CLEANUP] Device {device.id} at {addr} is disconnecting.")
+        message_queue.put(('DEVICE_DISCONNECT', device))
+        if getattr(device, 'drive_link', None) is not None:
+            drive_channel.close(device.drive_link)
+    with active_clients_lock:
+        if active_clients.get(addr) is device: del active_clients[addr]
 
 class ClientThread(threading.Thread):
-    def __init__(self, conn, addr):
+    def __init__(self, conn, addr, initial=b''):
         threading.Thread.__init__(self)
         self.conn = conn
         self.addr = addr
+        self.initial = initial # bytes the arena supervisor read before handing the socket over
+        self.connected_at = time.monotonic()
         self.is_connected = True
         self.device = None
+        self.framer = StreamFramer()
+        self.binary = False
+        self.protocol_lock = threading.Lock() # held to pick the wire format of an outgoing message and queue it
+        self.outbound = OutboundQueue()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
         log_with_timestamp(f"[NEW CONNECTION] {self.addr} connected. Starting new thread.")
 
     def run(self):
         try:
             ip = self.addr[0]
             
-            car_config = IP_TO_CAR.get(ip)
-            if car_config:
-                self.device = Car(car_config['id'], ip, self)
-            else:
-                bs_config = IP_TO_BASE_STATION.get(ip)
-                if bs_config:
-                    self.device = BaseStation(bs_config['id'], ip, self)
-                else:
-                    log_with_timestamp(f"[{ip}] [ERROR] Unknown IP address. Closing connection.")
+            if IDENTITY_MODE == 'ip':
+                self.device = identify_device(ip, self)
+                if not self.device:
+                    log_with_timestamp(f"[{ip}] [ERROR] Unknown IP address. Closing connection.", level=ERROR)
                     return
             
-            with active_clients_lock:
-                active_clients[ip] = self.device
-            
-            message_queue.put(('DEVICE_CONNECT', self.device))
+            self.writer.start()
+            if self.device:
+                register_device(self.addr, self.device)
+            if self.initial:
+                handle_device_frames(self, self.framer.feed(self.initial))
 
             while self.is_connected:
-                data = self.conn.recv(1024)
-                if not data: break
+                nbytes, frames = self.framer.recv_into(self.conn)
+                if not nbytes: break
                 
-                received_message = data.decode('utf-8').strip()
-                try:
-                    event_type, payload = received_message.split(':', 1)
-                    
-                    if self.device.device_type == "car":
-                        if event_type == "CAR_SEEN":
-                            seen_ir_address = int(payload, 16)
-                            if seen_ir_address in CAR_IR_ADDRESSES:
-                                seen_car_id = IR_ADDRESS_TO_CAR_ID[seen_ir_address]
-                                message_queue.put(('CAR_SEEN', self.device.id, seen_car_id))
-                    
-                    elif self.device.device_type == "base_station":
-                        if event_type == "BS_SEEN":
-                            seen_ir_address = int(payload, 16)
-                            if seen_ir_address in CAR_IR_ADDRESSES:
-                                seen_car_id = IR_ADDRESS_TO_CAR_ID[seen_ir_address]
-                                message_queue.put(('BS_SEEN', self.device.id, seen_car_id))
-                except (ValueError, IndexError):
-                    log_with_timestamp(f"[{ip}] [ERROR] Invalid message format: {received_message}.")
+                handle_device_frames(self, frames)
 
         except (ConnectionResetError, ConnectionAbortedError):
             log_with_timestamp(f"[ABRUPT DISCONNECTION] {self.addr} unplugged.")
         finally:
-            if self.device:
-                log_with_timestamp(f"[CLEANUP] Device {self.device.id} at {self.addr} is disconnecting.")
-                message_queue.put(('DEVICE_DISCONNECT', self.device.id, self.addr[0]))
-            self.conn.close()
             self.is_connected = False
-            with active_clients_lock:
-                if self.addr[0] in active_clients: del active_clients[self.addr[0]]
+            self.outbound.close()
+            self.conn.close()
+            unregister_device(self.addr, self.device)
             log_with_timestamp(f"[STATUS] {self.addr} thread finished. Active connections: {len(active_clients)}")
 
-    def send_data(self, data):
+    def close(self):
+        # From any thread. The reader's recv and the writer's sendall both return once the socket is shut down.
+        self.is_connected = False
         try:
-            if self.is_connected:
-                self.conn.sendall(data.encode('utf-8'))
-                log_with_timestamp(f"[{self.addr}] Sent: {data.strip()}")
-        except Exception as e:
-            log_with_timestamp(f"[{self.addr}] [ERROR] Failed to send data: {e}")
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def send_data(self, data, coalesce=False):
+        # Never blocks the caller: the message is queued for this device's writer thread.
+        if self.is_connected:
+            with SEND_DATA_SECONDS.time():
+                self.outbound.put(encode_outbound(data), coalesce)
+
+    def write_loop(self):
+        while True:
+            batch = self.outbound.wait_and_drain()
+            if not batch: break
+            try:
+                send_batch(self.conn.sendall, batch)
+                log_sent(self.addr, batch)
+            except Exception as e:
+                log_with_timestamp(f"[{self.addr}] [ERROR] Failed to send data: {e}", level=ERROR)
 
 class ServerThread(threading.Thread):
     def __init__(self):
@@ -212,6 +682,9 @@ class ServerThread(threading.Thread):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.is_running = True
     def run(self):
+        if DEVICE_HANDOFF_FD is not None:
+            log_with_timestamp("Device connections are handed over by the arena supervisor (one thread per device).")
+            return
         try:
             self.socket.bind((HOST, PORT))
         except OSError as e:
@@ -234,8 +707,168 @@ class ServerThread(threading.Thread):
     def stop(self):
         self.is_running = False
         self.socket.close()
+    def adopt(self, conn, initial):
+        client_thread = ClientThread(conn, conn.getpeername()[:2], initial)
+        client_thread.daemon = True
+        client_thread.start()
+
+class AsyncDeviceConnection(asyncio.BufferedProtocol):
+    def __init__(self, server, initial=b''):
+        self.server = server
+        self.initial = initial # bytes the arena supervisor read before handing the socket over
+        self.transport = None
+        self.addr = None
+        self.device = None
+        self.is_connected = False
+        self.framer = StreamFramer()
+        self.binary = False
+        self.protocol_lock = threading.Lock() # held to pick the wire format of an outgoing message and queue it
+        self.outbound = OutboundQueue(on_ready=self._schedule_flush)
+        self.write_paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # Keep the kernel-side backlog small so unsent movement commands wait in the coalescing queue instead.
+        transport.set_write_buffer_limits(high=OUTBOUND_WRITE_BUFFER_HIGH)
+        self.addr = transport.get_extra_info('peername')[:2]
+        self.connected_at = time.monotonic()
+        self.is_connected = True
+        log_with_timestamp(f"[NEW CONNECTION] {self.addr} connected.")
+        # In 'hello' identity mode the device names itself in its first line.
+        if IDENTITY_MODE == 'ip':
+            self.device = identify_device(self.addr[0], self)
+            if not self.device:
+                log_with_timestamp(f"[{self.addr[0]}] [ERROR] Unknown IP address. Closing connection.", level=ERROR)
+                transport.close()
+                return
+            register_device(self.addr, self.device)
+        if self.initial:
+            handle_device_frames(self, self.framer.feed(self.initial))
+
+    def get_buffer(self, sizehint):
+        return self.framer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        frames = self.framer.buffer_updated(nbytes)
+        handle_device_frames(self, frames)
+
+    def connection_lost(self, exc):
+        self.is_connected = False
+        self.outbound.close()
+        if exc is not None:
+            log_with_timestamp(f"[ABRUPT DISCONNECTION] {self.addr} unplugged.")
+        unregister_device(self.addr, self.device)
+        log_with_timestamp(f"[STATUS] {self.addr} connection closed. Active connections: {len(active_clients)}")
+
+    def close(self):
+        # From any thread; connection_lost then unregisters the device as usual.
+        self.is_connected = False
+        self.server.loop.call_soon_threadsafe(self.transport.abort)
+
+    def send_data(self, data, coalesce=False):
+        # Called from the game loop and web threads; the transport may only be touched on the event loop.
+        if self.is_connected:
+            with SEND_DATA_SECONDS.time():
+                self.outbound.put(encode_outbound(data), coalesce)
+
+    def _schedule_flush(self):
+        self.server.loop.call_soon_threadsafe(self._flush)
+
+    def _flush(self):
+        if not self.is_connected or self.write_paused: return
+        batch = self.outbound.drain()
+        if not batch: return
+        try:
+            send_batch(self.transport.write, batch)
+            log_sent(self.addr, batch)
+        except Exception as e:
+            log_with_timestamp(f"[{self.addr}] [ERROR] Failed to send data: {e}", level=ERROR)
+
+    def pause_writing(self):
+        self.write_paused = True
+
+    def resume_writing(self):
+        self.write_paused = False
+        self._flush()
+
+class AsyncDeviceServer(threading.Thread):
+    # Serves every device connection from a single asyncio event loop running in this thread.
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.loop = None
+        self.stop_event = None
+        self.is_running = True
+        self.ready = threading.Event()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        if DEVICE_HANDOFF_FD is None:
+            try:
+                server = await self.loop.create_server(lambda: AsyncDeviceConnection(self), HOST, PORT)
+            except OSError as e:
+                log_with_timestamp(f"Error binding to port {PORT}: {e}")
+                self.is_running = False
+                return
+            log_with_timestamp(f"Server is listening on {HOST}:{PORT} (asyncio).")
+        else:
+            # Nothing to listen on; a server object that is never started keeps the shutdown path below the same.
+            server = await self.loop.create_unix_server(lambda: AsyncDeviceConnection(self), sock=socket.socket(socket.AF_UNIX), start_serving=False)
+            log_with_timestamp("Device connections are handed over by the arena supervisor (asyncio).")
+        self.ready.set()
+        web_server = web_task = None
+        if web_shares_device_loop():
+            web_server = create_asgi_server()
+            web_task = asyncio.create_task(web_server.serve())
+            log_with_timestamp(f"Web server is listening on {HOST}:{WEB_PORT} (asgi, same event loop as the devices).")
+        async with server:
+            await self.stop_event.wait()
+            if web_server:
+                web_server.should_exit = True
+                await web_task
+        self.is_running = False
+
+    def stop(self):
+        self.is_running = False
+        if self.loop and self.stop_event:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+    def adopt(self, conn, initial):
+        # Called from the handoff thread with a socket the arena supervisor accepted.
+        self.ready.wait()
+        conn.setblocking(False)
+        asyncio.run_coroutine_threadsafe(
+            self.loop.connect_accepted_socket(lambda: AsyncDeviceConnection(self, initial), sock=conn), self.loop)
+
+class HandoffReceiver(threading.Thread):
+    # In an arena process: takes device sockets from the supervisor and gives them to the device server.
+    def __init__(self, fd, server):
+        threading.Thread.__init__(self, daemon=True)
+        self.channel = socket.socket(fileno=fd)
+        self.server = server
+
+    def run(self):
+        while True:
+            conn, initial = receive_handoff(self.channel)
+            if conn is None:
+                break
+            self.server.adopt(conn, initial)
+        # The supervisor is gone, so no device can reach this arena any more.
+        log_with_timestamp("[ARENA] Lost the connection to the arena supervisor. Shutting down.", level=ERROR)
+        os.kill(os.getpid(), signal.SIGINT)
+
+def create_device_server():
+    if DEVICE_SERVER_MODE == 'threads':
+        return ServerThread()
+    return AsyncDeviceServer()
 
 game_state = GameState()
+CONNECTED_DEVICES.labels('car').set_function(lambda: len(game_state.cars))
+CONNECTED_DEVICES.labels('base_station').set_function(lambda: len(game_state.base_stations))
+state_stream = StateStream()
 app = Flask(__name__)
 
 INDEX_TEMPLATE = """
@@ -244,22 +877,14 @@ INDEX_TEMPLATE = """
 <head>
     <title>Game Server Controls</title>
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <style>
-        body { font-family: Arial, sans-serif; text-align: center; background-color: #f0f0f0; }
-        .container { max-width: 600px; margin: 50px auto; padding: 20px; border: 1px solid #ccc; background-color: #fff; border-radius: 10px; }
-        h1 { color: #333; }
-        ul { list-style-type: none; padding: 0; }
-        li { margin: 10px 0; }
-        a { text-decoration: none; color: #2196F3; font-size: 1.2em; border: 1px solid #2196F3; padding: 10px 20px; border-radius: 5px; display: inline-block; width: 80%; }
-        a:hover { background-color: #2196F3; color: #fff; }
-    </style>
+    <link rel="stylesheet" href="/assets/index.css?v={{ asset_versions['index.css'] }}">
 </head>
 <body>
     <div class="container">
-        <h1>Select a Car to Control</h1>
+        <h1>Select a Car to Control{% if arena %} in {{ arena }}{% endif %}</h1>
         <ul>
             {% for car in cars.values() %}
-            <li><a href="{{ url_for('control_page', car_id=car.id) }}">Car {{ car.id }} ({{ TEAMS[car.team_id] }})</a></li>
+            <li><a href="{{ url_for('control_page', car_id=car.id) }}">Car {{ car.id }} ({{ team_name(car.team_id) }}){% if car.restored %} - reconnecting{% endif %}</a></li>
             {% else %}
             <li>No cars are currently connected.</li>
             {% endfor %}
@@ -276,233 +901,827 @@ CONTROL_TEMPLATE = """
 <head>
     <title>Car {{ car_id }} Controls</title>
     <meta name="viewport" content="width=device-width, initial-scale=1.0, user-scalable=no">
-    <style>
-        body { font-family: Arial, sans-serif; text-align: center; background-color: #f0f0f0; margin: 0; padding: 0; }
-        .controls-container {
-            display: flex;
-            flex-direction: column;
-            justify-content: center;
-            align-items: center;
-            height: 100vh;
-            width: 100%;
-        }
-        h1 { color: #333; margin: 20px; font-size: 1.5em; }
-        
-        .d-pad-container {
-            display: grid;
-            grid-template-areas:
-                ". forward ."
-                "left . right"
-                ". backward .";
-            grid-gap: 10px;
-            width: 300px;
-            height: 300px;
-            margin: 20px;
-        }
-
-        .control-button {
-            width: 100%;
-            height: 100%;
-            padding: 0;
-            font-size: 1.5em;
-            border: none;
-            border-radius: 5px;
-            cursor: pointer;
-            color: #fff;
-            box-sizing: border-box;
-            user-select: none; /* Prevent text selection */
-            -webkit-user-select: none;
-            -moz-user-select: none;
-            -ms-user-select: none;
-        }
-        
-        .forward-btn { background-color: #4CAF50; grid-area: forward; }
-        .backward-btn { background-color: #f44336; grid-area: backward; }
-        .left-btn { background-color: #2196F3; grid-area: left; }
-        .right-btn { background-color: #2196F3; grid-area: right; }
-        
-        .shoot-button-container {
-            display: flex;
-            justify-content: center;
-            align-items: center;
-            width: 300px;
-            height: 300px;
-            margin: 20px;
-        }
-        .shoot-btn {
-            background-color: #ff9800;
-            font-size: 2em;
-            border: none;
-            border-radius: 50%; /* Make it a circular button */
-            width: 150px;
-            height: 150px;
-            cursor: pointer;
-            color: #fff;
-            user-select: none;
-            -webkit-user-select: none;
-            -moz-user-select: none;
-            -ms-user-select: none;
-        }
-
-        /* --- Media Query for Landscape Mode --- */
-        @media (orientation: landscape) {
-            .controls-container {
-                flex-direction: row;
-                justify-content: space-around;
-            }
-        }
-    </style>
+    <link rel="stylesheet" href="/assets/control.css?v={{ asset_versions['control.css'] }}">
 </head>
-<body>
+<body data-car-id="{{ car_id }}">
     <div class="controls-container">
         <div class="shoot-button-container">
-            <button class="shoot-btn" onmousedown="sendCommand('shoot')" ontouchstart="sendCommand(event, 'shoot')">SHOOT</button>
+            <button class="shoot-btn" onmousedown="sendCommand(event, 'shoot')" ontouchstart="sendCommand(event, 'shoot')">SHOOT</button>
         </div>
 
         <div class="d-pad-container">
-            <button class="control-button forward-btn" onmousedown="startContinuousCommand('forward')" onmouseup="stopContinuousCommand()" ontouchstart="startContinuousCommand(event, 'forward')" ontouchend="stopContinuousCommand()">Forward</button>
-            <button class="control-button left-btn" onmousedown="startContinuousCommand('left')" onmouseup="stopContinuousCommand()" ontouchstart="startContinuousCommand(event, 'left')" ontouchend="stopContinuousCommand()">Left</button>
-            <button class="control-button right-btn" onmousedown="startContinuousCommand('right')" onmouseup="stopContinuousCommand()" ontouchstart="startContinuousCommand(event, 'right')" ontouchend="stopContinuousCommand()">Right</button>
-            <button class="control-button backward-btn" onmousedown="startContinuousCommand('backward')" onmouseup="stopContinuousCommand()" ontouchstart="startContinuousCommand(event, 'backward')" ontouchend="stopContinuousCommand()">Backward</button>
+            <button class="control-button forward-btn" onmousedown="startContinuousCommand(event, 'forward')" onmouseup="stopContinuousCommand()" ontouchstart="startContinuousCommand(event, 'forward')" ontouchend="stopContinuousCommand()">Forward</button>
+            <button class="control-button left-btn" onmousedown="startContinuousCommand(event, 'left')" onmouseup="stopContinuousCommand()" ontouchstart="startContinuousCommand(event, 'left')" ontouchend="stopContinuousCommand()">Left</button>
+            <button class="control-button right-btn" onmousedown="startContinuousCommand(event, 'right')" onmouseup="stopContinuousCommand()" ontouchstart="startContinuousCommand(event, 'right')" ontouchend="stopContinuousCommand()">Right</button>
+            <button class="control-button backward-btn" onmousedown="startContinuousCommand(event, 'backward')" onmouseup="stopContinuousCommand()" ontouchstart="startContinuousCommand(event, 'backward')" ontouchend="stopContinuousCommand()">Backward</button>
         </div>
     </div>
-    <script>
-        let commandInterval = null;
-
-        function sendCommand(event, action) {
-            if (event) event.preventDefault();
-            fetch(`/command/{{ car_id }}/` + action)
-                .then(response => response.json())
-                .then(data => console.log('Command sent:', data))
-                .catch(error => console.error('Error:', error));
-        }
+    <div class="car-status" id="car-status"></div>
+    <div class="link-status" id="link-status">HTTP</div>
+    <script src="/assets/control.js?v={{ asset_versions['control.js'] }}"></script>
+</body>
+</html>
+"""
 
-        function startContinuousCommand(event, action) {
-            if (event) event.preventDefault();
-            if (commandInterval) {
-                clearInterval(commandInterval);
-            }
-            sendCommand(null, action);
-            commandInterval = setInterval(() => sendCommand(null, action), 1000);
-        }
+# Stylesheets and scripts are served once from /assets with long-lived caching; the pages only link to them.
+INDEX_CSS = """
+body { font-family: Arial, sans-serif; text-align: center; background-color: #f0f0f0; }
+.container { max-width: 600px; margin: 50px auto; padding: 20px; border: 1px solid #ccc; background-color: #fff; border-radius: 10px; }
+h1 { color: #333; }
+ul { list-style-type: none; padding: 0; }
+li { margin: 10px 0; }
+a { text-decoration: none; color: #2196F3; font-size: 1.2em; border: 1px solid #2196F3; padding: 10px 20px; border-radius: 5px; display: inline-block; width: 80%; }
+a:hover { background-color: #2196F3; color: #fff; }
+"""
 
-        function stopContinuousCommand() {
-            if (commandInterval) {
-                clearInterval(commandInterval);
-                commandInterval = null;
-                sendCommand(null, 'stop');
-            }
+CONTROL_CSS = """
+body { font-family: Arial, sans-serif; text-align: center; background-color: #f0f0f0; margin: 0; padding: 0; }
+.controls-container {
+    display: flex;
+    flex-direction: column;
+    justify-content: center;
+    align-items: center;
+    height: 100vh;
+    width: 100%;
+}
+h1 { color: #333; margin: 20px; font-size: 1.5em; }
+
+.d-pad-container {
+    display: grid;
+    grid-template-areas:
+        ". forward ."
+        "left . right"
+        ". backward .";
+    grid-gap: 10px;
+    width: 300px;
+    height: 300px;
+    margin: 20px;
+}
+
+.control-button {
+    width: 100%;
+    height: 100%;
+    padding: 0;
+    font-size: 1.5em;
+    border: none;
+    border-radius: 5px;
+    cursor: pointer;
+    color: #fff;
+    box-sizing: border-box;
+    user-select: none; /* Prevent text selection */
+    -webkit-user-select: none;
+    -moz-user-select: none;
+    -ms-user-select: none;
+}
+
+.forward-btn { background-color: #4CAF50; grid-area: forward; }
+.backward-btn { background-color: #f44336; grid-area: backward; }
+.left-btn { background-color: #2196F3; grid-area: left; }
+.right-btn { background-color: #2196F3; grid-area: right; }
+
+.shoot-button-container {
+    display: flex;
+    justify-content: center;
+    align-items: center;
+    width: 300px;
+    height: 300px;
+    margin: 20px;
+}
+.shoot-btn {
+    background-color: #ff9800;
+    font-size: 2em;
+    border: none;
+    border-radius: 50%; /* Make it a circular button */
+    width: 150px;
+    height: 150px;
+    cursor: pointer;
+    color: #fff;
+    user-select: none;
+    -webkit-user-select: none;
+    -moz-user-select: none;
+    -ms-user-select: none;
+}
+
+.link-status { position: fixed; bottom: 5px; width: 100%; color: #888; font-size: 0.8em; }
+.car-status { position: fixed; top: 5px; width: 100%; font-weight: bold; color: #333; }
+
+/* --- Media Query for Landscape Mode --- */
+@media (orientation: landscape) {
+    .controls-container {
+        flex-direction: row;
+        justify-content: space-around;
+    }
+}
+"""
+
+CONTROL_JS = """
+const carId = Number(document.body.dataset.carId);
+let commandInterval = null;
+let heldAction = null;
+
+// Commands go over a WebSocket when the server offers one, and fall back to HTTP requests otherwise.
+let socket = null;
+let socketEverOpened = false;
+let nextSeq = 1;
+const pendingAcks = {};
+const latency = { ws: null, http: null };
+
+function connectSocket() {
+    if (!('WebSocket' in window)) return;
+    const scheme = location.protocol === 'https:' ? 'wss:' : 'ws:';
+    const ws = new WebSocket(`${scheme}//${location.host}/ws/control/${carId}`);
+    ws.onopen = () => { socket = ws; socketEverOpened = true; showLinkStatus(); };
+    ws.onmessage = (message) => {
+        const data = JSON.parse(message.data);
+        const sentAt = pendingAcks[data.seq];
+        if (sentAt !== undefined) {
+            delete pendingAcks[data.seq];
+            recordLatency('ws', performance.now() - sentAt);
         }
-    </script>
-</body>
-</html>
+    };
+    ws.onclose = () => {
+        socket = null;
+        for (const seq in pendingAcks) delete pendingAcks[seq];
+        showLinkStatus();
+        if (socketEverOpened) setTimeout(connectSocket, 2000);
+    };
+}
+
+function recordLatency(channel, ms) {
+    latency[channel] = latency[channel] === null ? ms : latency[channel] * 0.8 + ms * 0.2;
+    showLinkStatus();
+}
+
+function showLinkStatus() {
+    const parts = [socket ? 'WebSocket' : 'HTTP'];
+    if (latency.ws !== null) parts.push(`ws ${latency.ws.toFixed(1)} ms`);
+    if (latency.http !== null) parts.push(`http ${latency.http.toFixed(1)} ms`);
+    document.getElementById('link-status').textContent = parts.join(' | ');
+}
+
+function sendEvent(type, action) {
+    if (socket && socket.readyState === WebSocket.OPEN) {
+        const seq = nextSeq++;
+        pendingAcks[seq] = performance.now();
+        socket.send(JSON.stringify({ type: type, action: action, seq: seq }));
+        return;
+    }
+    const startedAt = performance.now();
+    fetch(`/command/${carId}/` + (type === 'release' ? 'stop' : action))
+        .then(response => response.json())
+        .then(data => { recordLatency('http', performance.now() - startedAt); console.log('Command sent:', data); })
+        .catch(error => console.error('Error:', error));
+}
+
+function sendCommand(event, action) {
+    if (event) event.preventDefault();
+    sendEvent('press', action);
+}
+
+function startContinuousCommand(event, action) {
+    if (event) event.preventDefault();
+    if (commandInterval) {
+        clearInterval(commandInterval);
+    }
+    heldAction = action;
+    sendEvent('press', action);
+    // Repeat while held so the server's command timeout knows this controller is still alive.
+    commandInterval = setInterval(() => sendEvent('press', action), 1000);
+}
+
+function stopContinuousCommand() {
+    if (commandInterval) {
+        clearInterval(commandInterval);
+        commandInterval = null;
+        sendEvent('release', heldAction);
+        heldAction = null;
+    }
+}
+
+// The server pushes car state; keep this car's fields and show them above the controls.
+const carState = {};
+function applyState(cars, replace) {
+    const mine = cars[carId];
+    if (replace) for (const key in carState) delete carState[key];
+    if (mine) Object.assign(carState, mine);
+    const parts = [];
+    if (carState.d) parts.push('DISABLED');
+    if (carState.f) parts.push('You have the flag');
+    if (carState.s) parts.push('Safe');
+    document.getElementById('car-status').textContent = parts.join(' | ');
+}
+
+function connectStateStream() {
+    if (!('EventSource' in window)) return;
+    const events = new EventSource('/events');
+    events.addEventListener('snapshot', (message) => applyState(JSON.parse(message.data).c || {}, true));
+    events.addEventListener('delta', (message) => {
+        const delta = JSON.parse(message.data);
+        if (delta.x && delta.x.includes(carId)) applyState({}, true);
+        if (delta.c) applyState(delta.c, false);
+    });
+}
+
+connectSocket();
+connectStateStream();
 """
 
+ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable' # asset URLs carry their ETag, so a change gets a new URL
+PAGE_CACHE_CONTROL = 'no-cache' # pages may be reused, but only after revalidating the ETag
+
+ASSETS = {
+    'index.css': CachedPage(INDEX_CSS, 'text/css; charset=utf-8', ASSET_CACHE_CONTROL),
+    'control.css': CachedPage(CONTROL_CSS, 'text/css; charset=utf-8', ASSET_CACHE_CONTROL),
+    'control.js': CachedPage(CONTROL_JS, 'application/javascript; charset=utf-8', ASSET_CACHE_CONTROL),
+}
+ASSET_VERSIONS = {name: asset.etag for name, asset in ASSETS.items()}
+
+# Compiled once at startup instead of on every request.
+index_template = app.jinja_env.from_string(INDEX_TEMPLATE)
+control_template = app.jinja_env.from_string(CONTROL_TEMPLATE)
+page_cache = PageCache()
+
+def render_page(template, **context):
+    return CachedPage(template.render(asset_versions=ASSET_VERSIONS, **context), 'text/html; charset=utf-8', PAGE_CACHE_CONTROL)
+
 @app.route('/')
 def index():
-    return render_template_string(INDEX_TEMPLATE, cars=game_state.cars, TEAMS=TEAMS)
+    # Only rendered again after a car connects or disconnects.
+    page = page_cache.get('index', lambda: render_page(index_template, cars=dict(game_state.cars), team_name=roster.team_name, arena=ARENA_NAME),
+                          version=game_state.cars_version)
+    return page.response()
 
 @app.route('/control/<int:car_id>')
 def control_page(car_id):
-    return render_template_string(CONTROL_TEMPLATE, car_id=car_id)
+    if car_id not in roster.car_teams:
+        # Not a configured car: render without caching so arbitrary IDs cannot grow the cache.
+        return render_page(control_template, car_id=car_id).response()
+    return page_cache.get(('control', car_id), lambda: render_page(control_template, car_id=car_id)).response()
 
-@app.route('/command/<int:car_id>/<string:action>')
-def handle_web_command(car_id, action):
+@app.route('/assets/<name>')
+def asset(name):
+    asset = ASSETS.get(name)
+    if asset is None:
+        abort(404)
+    return asset.response()
+
+def apply_web_command(car_id, action):
+    # Shared by the HTTP route and the WebSocket channel. Returns (response body, HTTP status).
     car = game_state.get_car_by_id(car_id)
     if not car:
-        return jsonify({"status": "error", "message": "Car not found"}), 404
+        return {"status": "error", "message": "Car not found"}, 404
+    if car.restored:
+        # Detached, within its reconnect grace period: a command would go nowhere.
+        return {"status": "error", "message": "Car is not connected"}, 503
     
     if car.is_disabled:
-        return jsonify({"status": "disabled", "message": "Car is disabled"}), 200
+        return {"status": "disabled", "message": "Car is disabled"}, 200
 
     command_data = WEB_COMMANDS.get(action)
     if command_data:
-        car.last_command_time = time.time()
-        car.is_moving = (action not in ['stop', 'shoot'])
+        with event_journal.lock:
+            current_time = time.time()
+            event_journal.web_command(car.id, action, current_time)
+            game_state.record_web_command(car, action, current_time)
         
         car.send_command(command_data['address'], command_data['command'])
-        log_with_timestamp(f"[WEB COMMAND] Car {car_id} received command: {action}")
-        return jsonify({"status": "success", "command": action})
+        log_with_timestamp(f"[WEB COMMAND] Car {car_id} received command: {action}", car=car_id, action=action)
+        return {"status": "success", "command": action}, 200
     else:
-        return jsonify({"status": "error", "message": "Invalid command"}), 400
+        return {"status": "error", "message": "Invalid command"}, 400
+
+@app.route('/command/<int:car_id>/<string:action>')
+def handle_web_command(car_id, action):
+    with WEB_COMMAND_SECONDS.labels('http').time():
+        result, status = apply_web_command(car_id, action)
+    return jsonify(result), status
+
+@app.route('/api/links')
+def link_quality():
+    now = time.time()
+    def describe(device):
+        summary = device.link.summary()
+        summary['last_seen_age_s'] = round(now - device.last_seen, 3)
+        return summary
+    return jsonify({
+        "ping_interval_s": PING_INTERVAL,
+        "cars": {str(car.id): describe(car) for car in list(game_state.cars.values())},
+        "base_stations": {str(bs.id): describe(bs) for bs in list(game_state.base_stations.values())},
+    })
+
+def handle_control_message(car_id, message):
+    # One WebSocket message: {"type": "press"|"release", "action": "forward", "seq": 12}. Returns the ack as JSON.
+    started = time.perf_counter()
+    try:
+        event = json.loads(message)
+        event_type = event.get('type', 'press')
+        action = event.get('action')
+        seq = event.get('seq')
+    except (ValueError, AttributeError):
+        return json.dumps({"type": "ack", "status": "error", "message": "Invalid message"})
+
+    if event_type == 'release':
+        # Letting go of a drive button stops the car; releasing shoot has nothing to undo.
+        action = 'stop' if action in WEB_COMMANDS and action not in ['stop', 'shoot'] else None
+
+    if action is None:
+        result = {"status": "ignored"}
+    else:
+        result, _ = apply_web_command(car_id, action)
+    elapsed = time.perf_counter() - started
+    WEB_COMMAND_SECONDS.labels('ws').observe(elapsed)
+    result.update(type="ack", seq=seq, server_ms=round(elapsed * 1000, 3))
+    return json.dumps(result)
+
+@app.route('/metrics')
+def metrics():
+    return Response(registry.expose(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/events')
+def state_events():
+    # Server-sent events: one snapshot of the cars and flags, then a delta whenever they change.
+    def stream():
+        subscriber = state_stream.subscribe()
+        try:
+            while True:
+                messages = subscriber.wait_and_drain(KEEPALIVE_INTERVAL)
+                yield b''.join(messages) if messages else KEEPALIVE
+        finally:
+            state_stream.unsubscribe(subscriber)
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def control_socket_opened(car_id):
+    log_with_timestamp(f"[WEB SOCKET] Controller connected for car {car_id}.")
+
+def control_socket_closed(car_id):
+    # A controller that vanishes mid-press must not leave its car driving.
+    car = game_state.get_car_by_id(car_id)
+    if car and car.is_moving:
+        apply_web_command(car_id, 'stop')
+    log_with_timestamp(f"[WEB SOCKET] Controller for car {car_id} disconnected.")
+
+if Sock is not None:
+    sock = Sock(app)
+
+    @sock.route('/ws/control/<int:car_id>')
+    def control_socket(ws, car_id):
+        control_socket_opened(car_id)
+        try:
+            while True:
+                ws.send(handle_control_message(car_id, ws.receive()))
+        except ConnectionClosed:
+            pass
+        finally:
+            control_socket_closed(car_id)
+
+def create_asgi_server():
+    # Control WebSockets run as coroutines; the Flask routes run on the ASGI app's thread pool.
+    control_app = ControlApp(app, handle_control_message, control_socket_opened, control_socket_closed, state_stream)
+    return create_web_server(control_app, HOST, WEB_PORT)
+
+def web_shares_device_loop():
+    return WEB_SERVER_MODE == 'asgi' and DEVICE_SERVER_MODE == 'asyncio'
 
 def start_web_server():
-    app.run(host='0.0.0.0', port=8000, debug=False)
+    if WEB_SERVER_MODE == 'asgi':
+        # Device sockets are on threads, so the web layer gets an event loop of its own in this thread.
+        log_with_timestamp(f"Web server is listening on {HOST}:{WEB_PORT} (asgi).")
+        asyncio.run(create_asgi_server().serve())
+    else:
+        app.run(host=HOST, port=WEB_PORT, debug=False)
+
+def handle_game_event(event, current_time):
+    event_type = event[0]
+
+    if event_type == 'DEVICE_CONNECT':
+        _, device_obj = event
+        if device_obj.device_type == 'car':
+            previous = game_state.get_car_by_id(device_obj.id)
+            if previous:
+                # Back after a dropped connection or a server restart, or on a new connection before the server has noticed
+                # the old one is dead: either way the car keeps its penalty, flag and safe zone state.
+                for field in CAR_GAME_FIELDS:
+                    setattr(device_obj, field, getattr(previous, field))
+                game_state.timers.cancel(('grace', device_obj.id))
+                if not previous.restored:
+                    # The old connection is half-open; its disconnect is ignored once this car has replaced it.
+                    previous.connection.close()
+                # The car may have missed the command that ended its penalty, or may have rebooted and forgotten it.
+                device_obj.send_command(0x80, 0x01 if device_obj.is_disabled else 0x02)
+            # Zone presence forgets a car that connects, without ZONE_LEAVE events.
+            game_state.zones.difference_update([key for key in game_state.zones if key[1] == device_obj.id])
+            game_state.add_car(device_obj)
+            log_with_timestamp(f"[DEVICE] Identified CAR {device_obj.id} on {roster.team_name(device_obj.team_id)} at {device_obj.ip}. Control at: {device_obj.control_url}")
+            if previous and device_obj.connection.connected_at is not None:
+                resumed_in = time.monotonic() - device_obj.connection.connected_at
+                SESSION_RESUME_SECONDS.observe(resumed_in)
+                log_with_timestamp(f"[DEVICE] CAR {device_obj.id} resumed its session"
+                                   f"{' (disabled)' if device_obj.is_disabled else ''}, back in play {resumed_in * 1000:.1f}ms after connecting.")
+        elif device_obj.device_type == 'base_station':
+            game_state.add_base_station(device_obj)
+            log_with_timestamp(f"[DEVICE] Identified BASE STATION {device_obj.id} for {roster.team_name(device_obj.team_id)} at {device_obj.ip}")
+        game_state.schedule_probe(device_obj, current_time)
+
+    elif event_type == 'CAR_SEEN':
+        _, shooter_id, target_id = event
+        shooter = game_state.get_car_by_id(shooter_id)
+        target = game_state.get_car_by_id(target_id)
+        if shooter and target and shooter.team_id != target.team_id and not target.is_safe and not target.is_disabled and not shooter.is_disabled:
+            log_with_timestamp(f"[GAME LOGIC] CAR {shooter.id} ({roster.team_name(shooter.team_id)}) shot CAR {target.id} ({roster.team_name(target.team_id)}). It is now disabled for {PENALTY_DURATION}s.")
+            game_state.disable_car(target, current_time)
+
+    elif event_type == 'BS_SEEN':
+        _, bs_id, car_id = event
+        base_station = game_state.get_base_station_by_id(bs_id)
+        car = game_state.get_car_by_id(car_id)
+        if base_station and car:
+            # A single sighting: the car is safe in its own zone for SAFE_ZONE_TIMEOUT.
+            car_in_zone(car, base_station.team_id, current_time, until_left=False)
+
+    elif event_type == 'ZONE_ENTER':
+        _, zone, car_id = event
+        car = game_state.get_car_by_id(car_id)
+        if car:
+            # Only registered cars: an id no car has would otherwise sit in zones for good.
+            game_state.zones.add((zone, car_id))
+            # From the zone presence table: the car stays in the zone until its ZONE_LEAVE.
+            car_in_zone(car, zone, current_time, until_left=True)
+            # Seen by the other team's base station while still parked at home: it is back to safe straight away, as
+            # it used to be with the next report from its own zone.
+            still_in_own_zone(car, current_time)
+
+    elif event_type == 'ZONE_LEAVE':
+        _, zone, car_id = event
+        game_state.zones.discard((zone, car_id))
+        car = game_state.get_car_by_id(car_id)
+        if car and car.team_id == zone:
+            game_state.update_car_safety(car_id, False)
+        elif car:
+            still_in_own_zone(car, current_time)
+
+    elif event_type == 'DEVICE_DISCONNECT':
+        _, device_obj = event
+        device_id = device_obj.id
+        log_with_timestamp(f"[GAME LOGIC] Device {device_id} at {device_obj.ip} disconnected.")
+        # Only forget the device if it has not already been replaced by a newer connection with the same id.
+        if device_obj.device_type == 'car':
+            if RECONNECT_GRACE > 0 and game_state.get_car_by_id(device_id) is device_obj:
+                game_state.detach_car(device_obj, current_time)
+            elif game_state.remove_car(device_obj):
+                game_state.cancel_car_timers(device_id)
+                game_state.cancel_probe('car', device_id)
+        elif game_state.remove_base_station(device_obj):
+            game_state.cancel_probe('base_station', device_id)
+
+    elif event_type == 'SET_TEAM':
+        _, device_type, device_id, team_id = event
+        device = (game_state.cars if device_type == 'car' else game_state.base_stations).get(device_id)
+        if device and device.team_id != team_id:
+            log_with_timestamp(f"[GAME STATE] {device_type.replace('_', ' ').upper()} {device_id} moved from "
+                               f"{roster.team_name(device.team_id)} to {roster.team_name(team_id)}.")
+            game_state.set_team(device, team_id)
+
+    elif event_type == 'ROSTER':
+        _, new_roster = event
+        use_roster(new_roster)
+
+    # 'WAKE' events carry no data; they only make the loop recompute its next deadline.
+
+def read_roster():
+    if ARENA_NAME:
+        arenas, _ = load_arenas(ARENA_CONFIG_PATH)
+        if ARENA_NAME not in arenas:
+            raise ValueError(f"no arena named {ARENA_NAME} in {ARENA_CONFIG_PATH}")
+        return arenas[ARENA_NAME].roster
+    return load_roster(ROSTER_PATH)
+
+def reload_roster():
+    # On SIGHUP or a change to the roster file. The file is read and checked here; the game loop swaps it in between two passes.
+    try:
+        new_roster = read_roster()
+    except (OSError, ValueError) as e:
+        log_with_timestamp(f"[ROSTER] [ERROR] Keeping the current roster: {e}", level=ERROR)
+        return
+    message_queue.put(('ROSTER', new_roster))
+
+def roster_file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def watch_roster(path, interval):
+    # Own thread. Reloads the roster when its file changes, so no signal is needed (and Windows has no SIGHUP).
+    stamp = roster_file_stamp(path)
+    while True:
+        time.sleep(interval)
+        current = roster_file_stamp(path)
+        if current != stamp:
+            stamp = current
+            reload_roster()
+
+def use_roster(new_roster):
+    # Game loop only. Connected devices keep their connection; the ones the roster moved to another team are moved
+    # by SET_TEAM events, which the journal records like any other game input.
+    global roster
+    roster = new_roster
+    game_state.cars_version += 1 # team names on the index page may have changed
+    log_with_timestamp(f"[ROSTER] Loaded {new_roster.describe()} from {new_roster.source}.")
+    for car in list(game_state.cars.values()):
+        entry = new_roster.cars_by_ip.get(car.ip)
+        if not entry or entry.id != car.id:
+            continue # not identified by this roster entry; a new IP or id takes effect when the car reconnects
+        if entry.ir_address != car.ir_address:
+            game_state.devices.remove(car)
+            car.ir_address = entry.ir_address
+            game_state.devices.add(car)
+        if entry.team != car.team_id:
+            message_queue.put(('SET_TEAM', 'car', car.id, entry.team))
+    for base_station in list(game_state.base_stations.values()):
+        entry = new_roster.base_stations_by_ip.get(base_station.ip)
+        if entry and entry.id == base_station.id and entry.team != base_station.team_id:
+            message_queue.put(('SET_TEAM', 'base_station', base_station.id, entry.team))
+
+def car_in_zone(car, zone, current_time, until_left):
+    is_safe = (zone == car.team_id)
+
+    if is_safe and until_left:
+        car.last_seen_safe_time = current_time
+        game_state.timers.cancel(('safe_expiry', car.id))
+    elif is_safe:
+        game_state.mark_car_safe(car, current_time)
+
+    game_state.update_car_safety(car.id, is_safe)
+
+    if not is_safe and car.has_flag and not car.is_disabled:
+        log_with_timestamp(f"[GAME LOGIC] CAR {car.id} ({roster.team_name(car.team_id)}) captured the flag!")
+        game_state.flags[car.team_id] = None
+        car.has_flag = False
+        game_state.changed_cars.add(car.id)
+        game_state.flags_changed = True
+
+def still_in_own_zone(car, current_time):
+    # A car the game made unsafe while its own zone's base stations still report it is safe again.
+    if not car.is_safe and (car.team_id, car.id) in game_state.zones:
+        car_in_zone(car, car.team_id, current_time, until_left=True)
+
+class DetachedConnection:
+    # Stands in for the socket of a device known only from a snapshot or the journal. Commands to it go nowhere.
+    binary = False
+    is_connected = False
+    connected_at = None
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.protocol_lock = threading.Lock()
+
+    def send_data(self, data, coalesce=False):
+        pass
+
+    def close(self):
+        pass
+
+def reset_game_state():
+    global game_state
+    game_state = GameState()
+    game_state.loop_thread_id = threading.get_ident()
+    return game_state
+
+def detach_devices(current_time):
+    # Every device in the game state is from before a restart: they all have to reconnect.
+    for device in list(game_state.cars.values()) + list(game_state.base_stations.values()):
+        device.restored = True
+    # A car that never comes back is forgotten like one that dropped out; cars already in their grace period keep theirs.
+    if RECONNECT_GRACE > 0:
+        for car in list(game_state.cars.values()):
+            if ('grace', car.id) not in game_state.timers:
+                game_state.schedule_timer(('grace', car.id), current_time + RECONNECT_GRACE, game_state.car_timer('grace', car.id))
+    # Zone presence is not saved, so no car is in a zone until a base station reports it again.
+    game_state.zones.clear()
+    for car in list(game_state.cars.values()):
+        game_state.update_car_safety(car.id, False)
+
+class JournalPlayback:
+    """Applies journal records to the game state in order.
+
+    Used by replay.py for whole journals, and on startup for the part of
+    the journal written after the snapshot being recovered. Devices are
+    built with a DetachedConnection; connections maps each recorded
+    address to the device that connected from it, so a disconnect record
+    finds the right one. CHECKPOINT records are left to the caller.
+    """
+
+    def __init__(self):
+        self.current_time = None
+        self.connections = {}
+
+    def apply(self, record):
+        kind = record[0]
+        if kind == 'SESSION':
+            # The server started with an empty game.
+            reset_game_state()
+            self.connections.clear()
+        elif kind == 'RESUME':
+            # The server restarted and recovered the state; nothing that was connected is any more.
+            detach_devices(record[1])
+            self.connections.clear()
+        elif kind == 'TICK':
+            self.current_time = record[1]
+            game_state.run_due_timers(self.current_time)
+        elif kind == 'DEVICE_CONNECT':
+            _, device_type, device_id, team_id, addr = record
+            device_class = Car if device_type == 'car' else BaseStation
+            device = device_class(device_id, addr[0], DetachedConnection(addr), team_id)
+            self.connections[addr] = device
+            handle_game_event(('DEVICE_CONNECT', device), self.current_time)
+        elif kind == 'DEVICE_DISCONNECT':
+            device = self.connections.pop(record[3], None)
+            if device is not None:
+                handle_game_event(('DEVICE_DISCONNECT', device), self.current_time)
+        elif kind in ('CAR_SEEN', 'BS_SEEN', 'ZONE_ENTER', 'ZONE_LEAVE', 'SET_TEAM'):
+            handle_game_event(record, self.current_time)
+        elif kind == 'WEB_COMMAND':
+            _, command_time, car_id, action = record
+            car = game_state.get_car_by_id(car_id)
+            if car:
+                game_state.record_web_command(car, action, command_time)
+                command_data = WEB_COMMANDS[action]
+                car.send_command(command_data['address'], command_data['command'])
+
+def restore_game_state(state, playback):
+    # Rebuilds the game from a snapshot's GameState.describe(); devices come back detached until they reconnect.
+    for car_id, fields in state['cars'].items():
+        addr = tuple(fields['addr'])
+        car = Car(int(car_id), addr[0], DetachedConnection(addr), fields['team_id'])
+        car.restored = fields['restored']
+        for field in CAR_GAME_FIELDS:
+            setattr(car, field, fields[field])
+        game_state.add_car(car)
+        playback.connections[addr] = car
+    for bs_id, fields in state['base_stations'].items():
+        addr = tuple(fields['addr'])
+        base_station = BaseStation(int(bs_id), addr[0], DetachedConnection(addr), fields['team_id'])
+        base_station.restored = fields['restored']
+        game_state.add_base_station(base_station)
+        playback.connections[addr] = base_station
+    game_state.flags = {int(team): holder for team, holder in state['flags'].items()}
+    game_state.flags_changed = True
+    for (kind, car_id), deadline in state['timers']:
+        game_state.timers.schedule((kind, car_id), deadline, game_state.car_timer(kind, car_id))
+
+def recover_game_state(current_time):
+    # On startup: load the latest snapshot and the journal written after it. Returns True if a game was recovered.
+    # current_time is also the journal's RESUME time, so a replay starts the same grace periods.
+    try:
+        snapshot = load_snapshot(SNAPSHOT_PATH)
+    except ValueError as e:
+        log_with_timestamp(f"[RECOVERY] [ERROR] Cannot use snapshot: {e}. Starting a new game.", level=ERROR)
+        return False
+    if snapshot is None:
+        return False
+    age = time.time() - snapshot['saved_at']
+    if age > SNAPSHOT_MAX_AGE:
+        log_with_timestamp(f"[RECOVERY] Snapshot {SNAPSHOT_PATH} is {age:.0f}s old. Starting a new game.")
+        return False
+
+    started = time.perf_counter()
+    playback = JournalPlayback()
+    reset_game_state()
+    restore_game_state(snapshot['state'], playback)
+    replayed = 0
+    if JOURNAL_PATH:
+        offset = snapshot.get('journal_offset')
+        if (offset is not None and snapshot.get('journal') == os.path.abspath(JOURNAL_PATH)
+                and os.path.exists(JOURNAL_PATH) and offset <= os.path.getsize(JOURNAL_PATH)):
+            for record in JournalReader(JOURNAL_PATH, start=offset):
+                playback.apply(record)
+                replayed += 1
+        else:
+            log_with_timestamp(f"[RECOVERY] [ERROR] Snapshot was not taken against {JOURNAL_PATH}; recovering from the snapshot alone.", level=ERROR)
+    detach_devices(current_time)
+    elapsed = time.perf_counter() - started
+    log_with_timestamp(f"[RECOVERY] Restored {len(game_state.cars)} cars, {len(game_state.base_stations)} base stations and "
+                       f"{len(game_state.timers)} timers from a snapshot taken {age:.1f}s ago plus {replayed} journal records, "
+                       f"in {elapsed * 1000:.1f}ms.")
+    return True
+
+def describe_arena():
+    # One pass over the cars into columns, then per-team counts from the columns.
+    columns = game_state.devices.columns()
+    teams = ", ".join(f"{name} {columns.count(team_id)} ({columns.count(team_id, all_of=STATE_DISABLED)} disabled)"
+                      for team_id, name in roster.teams.items())
+    return f"[ARENA] {len(columns)} cars: {teams}; {len(game_state.base_stations)} base stations"
+
+def heartbeat_devices():
+    with active_clients_lock:
+        return list(active_clients.values())
+
+def heartbeat_evicted(device, silence):
+    HEARTBEAT_EVICTIONS.inc()
+    log_with_timestamp(f"[HEARTBEAT] {device.device_type.replace('_', ' ').upper()} {device.id} at {device.ip} has been silent "
+                       f"for {silence * 1000:.0f}ms. Closing its connection.", level=ERROR)
 
 def main_game_loop():
     log_with_timestamp("Main program thread is free and running the game loop.")
-    server = ServerThread()
+    game_state.loop_thread_id = threading.get_ident()
+    server = create_device_server()
     server.daemon = True
     server.start()
+    if DEVICE_HANDOFF_FD is not None:
+        HandoffReceiver(DEVICE_HANDOFF_FD, server).start()
+    if UDP_DRIVE:
+        # Next to the TCP port; an arena process has none of its own, so any free port will do.
+        try:
+            address = drive_channel.open(HOST, PORT if DEVICE_HANDOFF_FD is None else 0)
+            log_with_timestamp(f"Drive commands go over UDP from {address[0]}:{address[1]} to cars that offer it.")
+        except OSError as e:
+            log_with_timestamp(f"Error binding UDP port {PORT}: {e}. Drive commands stay on TCP.", level=ERROR)
+    heartbeat = None
+    if HEARTBEAT_INTERVAL > 0:
+        heartbeat = HeartbeatMonitor(HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, heartbeat_devices, heartbeat_evicted)
+        heartbeat.start()
     
     last_print_time = time.time()
+    last_cpu_time = time.process_time()
+    last_checkpoint_time = last_snapshot_time = last_print_time
     
     try:
         while True:
-            current_time = time.time()
-            
-            for car in game_state.cars.values():
-                if car.is_disabled and current_time >= car.disabled_until_time:
-                    car.is_disabled = False
-                    car.disabled_until_time = 0
-                    log_with_timestamp(f"[GAME LOGIC] CAR {car.id} is no longer disabled and can now resume playing.")
-                    car.send_command(0x80, 0x02)
-
-                if car.is_safe and (current_time - car.last_seen_safe_time) > SAFE_ZONE_TIMEOUT:
-                    game_state.update_car_safety(car.id, False)
-
-                if car.is_moving and (current_time - car.last_command_time) > COMMAND_TIMEOUT:
-                    log_with_timestamp(f"[GAME LOGIC] Car {car.id} web control timed out. Sending STOP command.")
-                    command_data = WEB_COMMANDS.get('stop')
-                    car.send_command(command_data['address'], command_data['command'])
-                    car.is_moving = False
-
-
-            if not message_queue.empty():
-                event = message_queue.get()
-                event_type = event[0]
-                
-                if event_type == 'DEVICE_CONNECT':
-                    _, device_obj = event
-                    if device_obj.device_type == 'car':
-                        game_state.add_car(device_obj)
-                        log_with_timestamp(f"[DEVICE] Identified CAR {device_obj.id} on {TEAMS[device_obj.team_id]} at {device_obj.ip}. Control at: {device_obj.control_url}")
-                    elif device_obj.device_type == 'base_station':
-                        game_state.add_base_station(device_obj)
-                        log_with_timestamp(f"[DEVICE] Identified BASE STATION {device_obj.id} for {TEAMS[device_obj.team_id]} at {device_obj.ip}")
-                
-                elif event_type == 'CAR_SEEN':
-                    _, shooter_id, target_id = event
-                    shooter = game_state.get_car_by_id(shooter_id)
-                    target = game_state.get_car_by_id(target_id)
-                    if shooter and target and shooter.team_id != target.team_id and not target.is_safe and not target.is_disabled and not shooter.is_disabled:
-                        target.is_disabled = True
-                        target.disabled_until_time = current_time + PENALTY_DURATION
-                        log_with_timestamp(f"[GAME LOGIC] CAR {shooter.id} ({TEAMS[shooter.team_id]}) shot CAR {target.id} ({TEAMS[target.team_id]}). It is now disabled for {PENALTY_DURATION}s.")
-                        target.send_command(0x80, 0x01)
-
-                elif event_type == 'BS_SEEN':
-                    _, bs_id, car_id = event
-                    base_station = game_state.get_base_station_by_id(bs_id)
-                    car = game_state.get_car_by_id(car_id)
-                    if base_station and car:
-                        is_safe = (base_station.team_id == car.team_id)
-                        
-                        if is_safe:
-                            car.last_seen_safe_time = current_time
-                        
-                        game_state.update_car_safety(car_id, is_safe)
-                        
-                        if not is_safe and car.has_flag and not car.is_disabled:
-                            log_with_timestamp(f"[GAME LOGIC] CAR {car.id} ({TEAMS[car.team_id]}) captured the flag!")
-                            game_state.flags[car.team_id] = None
-                            car.has_flag = False
-                
-                elif event_type == 'DEVICE_DISCONNECT':
-                    _, device_id, ip = event
-                    log_with_timestamp(f"[GAME LOGIC] Device {device_id} at {ip} disconnected.")
-                    if device_id in game_state.cars: del game_state.cars[device_id]
-                    if device_id in game_state.base_stations: del game_state.base_stations[device_id]
+            # Block until either an event arrives or the next car timer is due.
+            deadline = game_state.timers.next_deadline()
+            zone_expiry = zone_presence.next_expiry()
+            if zone_expiry is not None and (deadline is None or zone_expiry < deadline):
+                deadline = zone_expiry
+            timeout = LOOP_MAX_WAIT
+            if deadline is not None:
+                timeout = min(max(deadline - time.time(), 0.0), LOOP_MAX_WAIT)
+
+            events = []
+            try:
+                events.append(message_queue.get(timeout=timeout))
+            except Empty:
+                pass
+            loop_stats.record_wakeup()
+
+            # Drain everything that queued up while we were asleep in a single batch.
+            while True:
+                try:
+                    events.append(message_queue.get_nowait())
+                except Empty:
+                    break
+
+            batch_start = time.perf_counter()
+            with event_journal.lock:
+                current_time = time.time()
+                # Cars no longer reported in a zone have left it; these are game events like any other.
+                events.extend(('ZONE_LEAVE', zone, car_id) for zone, car_id in zone_presence.expire(current_time))
+                if event_journal.enabled:
+                    due = game_state.timers.next_deadline()
+                    if events or (due is not None and due <= current_time):
+                        event_journal.tick(current_time)
+                game_state.run_due_timers(current_time)
+                for event in events:
+                    event_journal.event(event)
+                    handle_game_event(event, current_time)
+                    EVENTS_PROCESSED.labels(event[0]).inc()
+                if event_journal.enabled and current_time - last_checkpoint_time >= JOURNAL_CHECKPOINT_INTERVAL:
+                    event_journal.checkpoint(current_time, digest_state(game_state.describe()))
+                    last_checkpoint_time = current_time
+                if snapshot_writer.enabled and current_time - last_snapshot_time >= SNAPSHOT_INTERVAL:
+                    snapshot_writer.submit(game_state.describe(), current_time)
+                    last_snapshot_time = current_time
+            # Only the cars the pass changed are compared, so a pass that changed nothing costs nothing here.
+            if game_state.changed_cars or game_state.flags_changed:
+                state_stream.publish(game_state.cars, game_state.flags, game_state.changed_cars)
+                game_state.changed_cars = set()
+                game_state.flags_changed = False
+            batch_time = time.perf_counter() - batch_start
+            LOOP_TICK_SECONDS.observe(batch_time)
+            if events:
+                loop_stats.record_batch(len(events), batch_time)
+
+            if current_time - last_print_time >= LOOP_STATS_INTERVAL:
+                cpu_time = time.process_time()
+                log_with_timestamp(loop_stats.report(current_time - last_print_time, cpu_time - last_cpu_time))
+                log_with_timestamp(describe_arena())
+                log_with_timestamp(framing_stats.report())
+                log_with_timestamp(hit_filter.report())
+                if heartbeat:
+                    log_with_timestamp(heartbeat.report())
+                if zone_presence.enabled:
+                    log_with_timestamp(zone_presence.report())
+                if drive_channel.enabled:
+                    log_with_timestamp(drive_channel.report())
+                log_with_timestamp(outbound_stats.report())
+                log_with_timestamp(state_stream.report())
+                log_with_timestamp(log_pipeline.report())
+                if event_journal.enabled:
+                    log_with_timestamp(event_journal.report())
+                if snapshot_writer.enabled:
+                    log_with_timestamp(snapshot_writer.report())
+                last_print_time = current_time
+                last_cpu_time = cpu_time
             
     except KeyboardInterrupt:
         log_with_timestamp("\nShutting down main program and server.")
@@ -511,18 +1730,123 @@ def main_game_loop():
         log_with_timestamp("Server thread stopped.")
         sys.exit(0)
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="OpenMicroCar game server")
+    parser.add_argument('--port', type=int, default=PORT, help="TCP port cars and base stations connect to.")
+    parser.add_argument('--web-port', type=int, default=WEB_PORT, help="Port for the web controls and API.")
+    parser.add_argument('--device-server', choices=['asyncio', 'threads'], default=DEVICE_SERVER_MODE,
+                        help="How device sockets are served: one asyncio event loop, or one thread per device.")
+    parser.add_argument('--identity', choices=['ip', 'hello'], default=IDENTITY_MODE,
+                        help="Identify devices by IP address, or by the role and id in their HELLO line (for the simulator).")
+    parser.add_argument('--web-server', choices=['dev', 'asgi'], default=WEB_SERVER_MODE,
+                        help="Flask's development server, or uvicorn in-process on the device event loop (needs uvicorn).")
+    parser.add_argument('--hit-window', type=float, default=HIT_DEDUP_WINDOW,
+                        help="Seconds in which repeated CAR_SEEN reports of the same target by the same car count as one (0 keeps them all).")
+    parser.add_argument('--zone-ttl', type=float, default=ZONE_PRESENCE_TTL,
+                        help="Seconds without a BS_SEEN report before a car has left a zone (0 passes every report to the game loop).")
+    parser.add_argument('--reconnect-grace', type=float, default=RECONNECT_GRACE,
+                        help="Seconds a disconnected car's game state is kept for it to reconnect (0 forgets it straight away).")
+    parser.add_argument('--ping-interval', type=float, default=PING_INTERVAL,
+                        help="Seconds between RTT probes to each device when heartbeats are off (0 disables probing).")
+    parser.add_argument('--heartbeat-interval', type=float, default=HEARTBEAT_INTERVAL,
+                        help="Seconds between heartbeat pings to each device (0 turns heartbeats off).")
+    parser.add_argument('--heartbeat-timeout', type=float, default=HEARTBEAT_TIMEOUT,
+                        help="Seconds of silence after which a device's connection is closed.")
+    parser.add_argument('--udp-drive', action='store_true', default=UDP_DRIVE,
+                        help="Send drive commands as UDP datagrams to cars that offer a UDP port; everything else stays on TCP.")
+    parser.add_argument('--udp-drive-repeats', type=int, default=UDP_DRIVE_REPEATS,
+                        help=f"Times each car's latest drive frame is sent again, {UDP_DRIVE_REPEAT_INTERVAL * 1000:.0f}ms apart, in case one was lost.")
+    parser.add_argument('--log-level', choices=list(LEVELS), default='debug',
+                        help="Lowest level written to the log. Per-message 'Sent:' lines are debug; use info during matches.")
+    parser.add_argument('--log-format', choices=['text', 'json'], default='text',
+                        help="Log as timestamped text lines or as one JSON object per line.")
+    parser.add_argument('--journal', default=JOURNAL_PATH, metavar='PATH',
+                        help="Append every game input to this file, for replay.py and crash recovery.")
+    parser.add_argument('--snapshot', default=SNAPSHOT_PATH, metavar='PATH',
+                        help="Save the game state to this file every second, and recover it from there on startup.")
+    parser.add_argument('--roster', default=ROSTER_PATH, metavar='PATH',
+                        help="JSON file with the teams, cars and base stations. Send the server SIGHUP, or save the file, to load it again.")
+    parser.add_argument('--roster-watch-interval', type=float, default=ROSTER_WATCH_INTERVAL, metavar='SECONDS',
+                        help="Seconds between checks of --roster for changes (0 turns watching off).")
+    parser.add_argument('--arena', help="Run this arena from --arena-config (arenas.py starts these processes).")
+    parser.add_argument('--arena-config', metavar='PATH', help="Arena config file, as read by arenas.py.")
+    parser.add_argument('--handoff-fd', type=int, metavar='FD',
+                        help="Take device sockets from the arena supervisor on this descriptor instead of listening on --port.")
+    args = parser.parse_args()
+    if args.web_server == 'asgi' and uvicorn is None:
+        parser.error("--web-server asgi needs uvicorn (pip install uvicorn websockets)")
+    if args.heartbeat_interval > 0 and args.heartbeat_timeout <= args.heartbeat_interval:
+        parser.error("--heartbeat-timeout must be longer than --heartbeat-interval")
+    if args.udp_drive_repeats < 0:
+        parser.error("--udp-drive-repeats cannot be negative")
+    if args.arena:
+        try:
+            arenas, _ = load_arenas(args.arena_config)
+        except (TypeError, OSError, ValueError) as e:
+            parser.error(f"cannot load --arena-config: {e}")
+        if args.arena not in arenas:
+            parser.error(f"no arena named {args.arena} in {args.arena_config}")
+        args.arena = arenas[args.arena]
+    else:
+        try:
+            args.roster = load_roster(args.roster)
+        except (OSError, ValueError) as e:
+            parser.error(f"cannot load --roster {args.roster}: {e}")
+    return args
+
 if __name__ == "__main__":
+    args = parse_args()
+    PORT = args.port
+    WEB_PORT = args.web_port
+    DEVICE_SERVER_MODE = args.device_server
+    IDENTITY_MODE = args.identity
+    WEB_SERVER_MODE = args.web_server
+    PING_INTERVAL = args.ping_interval
+    HEARTBEAT_INTERVAL = args.heartbeat_interval
+    HEARTBEAT_TIMEOUT = args.heartbeat_timeout
+    RECONNECT_GRACE = args.reconnect_grace
+    UDP_DRIVE = args.udp_drive
+    drive_channel.repeats = args.udp_drive_repeats
+    hit_filter.window = args.hit_window
+    zone_presence.ttl = args.zone_ttl
+    log_pipeline.level = LEVELS[args.log_level]
+    log_pipeline.fmt = args.log_format
+    JOURNAL_PATH = args.journal
+    SNAPSHOT_PATH = args.snapshot
+    DEVICE_HANDOFF_FD = args.handoff_fd
+    if args.arena:
+        ARENA_NAME = args.arena.name
+        ARENA_CONFIG_PATH = args.arena_config
+        roster = args.arena.roster
+    else:
+        ROSTER_PATH = args.roster.source
+        roster = args.roster
+        ROSTER_WATCH_INTERVAL = args.roster_watch_interval
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: reload_roster())
+    # An arena's roster is in the arenas.py config, and the supervisor passes its SIGHUP on to each arena.
+    if not ARENA_NAME and ROSTER_WATCH_INTERVAL > 0:
+        threading.Thread(target=watch_roster, args=(ROSTER_PATH, ROSTER_WATCH_INTERVAL), name="roster-watch", daemon=True).start()
+    started_at = time.time()
+    recovered = recover_game_state(started_at) if SNAPSHOT_PATH else False
+    if JOURNAL_PATH:
+        event_journal.open(JOURNAL_PATH, resumed=recovered, started_at=started_at)
+    if SNAPSHOT_PATH:
+        snapshot_writer.open(SNAPSHOT_PATH, event_journal)
+
     game_loop_thread = threading.Thread(target=main_game_loop)
     game_loop_thread.daemon = True
     game_loop_thread.start()
     
-    web_server_thread = threading.Thread(target=start_web_server)
-    web_server_thread.daemon = True
-    web_server_thread.start()
+    if not web_shares_device_loop():
+        web_server_thread = threading.Thread(target=start_web_server)
+        web_server_thread.daemon = True
+        web_server_thread.start()
     
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
         log_with_timestamp("\nMain thread received interrupt, shutting down.")
+        event_journal.close()
         sys.exit(0)
\ No newline at end of file
@@ -0,0 +1,210 @@
+import threading
+import time
+from bisect import bisect_left
+from queue import Queue
+
+# Default histogram buckets in seconds: 50us to 2.5s, dense around the few-millisecond range the command path lives in.
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    # A named family. Unlabelled metrics are used directly; labelled ones through labels(...).
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(child.expose(self.name, self.labelnames, values))
+        return lines
+
+    def _new_child(self):
+        raise NotImplementedError
+
+class _CounterChild:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def expose(self, name, labelnames, values):
+        return [f"{name}{format_labels(labelnames, values)} {format_value(self.value)}"]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        # Sampled at scrape time, so keeping the gauge current costs nothing on the hot path.
+        self.function = function
+
+    def expose(self, name, labelnames, values):
+        value = self.function() if self.function else self.value
+        return [f"{name}{format_labels(labelnames, values)} {format_value(value)}"]
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._children[()].set(value)
+
+    def set_function(self, function):
+        self._children[()].set_function(function)
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def expose(self, name, labelnames, values):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for edge, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{format_labels(labelnames, values, [('le', format_value(edge))])} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labelnames, values)} {format_value(total)}")
+        lines.append(f"{name}_count{format_labels(labelnames, values)} {cumulative}")
+        return lines
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(float(edge) for edge in buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+    def time(self):
+        return self._children[()].time()
+
+class _Timer:
+    # with histogram.time(): ...  observes the elapsed wall time of the block.
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.perf_counter() - self.started)
+
+class Registry:
+    """Every metric in the process, exposed together in Prometheus text format.
+
+    Recording is an increment or a bisect under a per-child lock, so the
+    metrics stay on during matches; all formatting happens when /metrics
+    is scraped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def expose(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class TimedQueue(Queue):
+    # A Queue that records how long each item waited between put() and get().
+    def __init__(self, wait_histogram, maxsize=0):
+        super().__init__(maxsize)
+        self.wait_histogram = wait_histogram
+
+    def _put(self, item):
+        self.queue.append((time.perf_counter(), item))
+
+    def _get(self):
+        queued_at, item = self.queue.popleft()
+        self.wait_histogram.observe(time.perf_counter() - queued_at)
+        return item
@@ -0,0 +1,128 @@
+import threading
+import time
+from collections import deque
+from metrics import registry
+
+OUTBOUND_WAIT_SECONDS = registry.histogram('omc_outbound_wait_seconds', "Time a message waits in a device's outbound queue before it is written.")
+DEVICE_WRITE_SECONDS = registry.histogram('omc_device_write_seconds', "Time for one batched write to a device socket.")
+
+class OutboundStats:
+    # Totals across every device connection, reported periodically by the game loop.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.enqueued = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.writes = 0
+        self.max_depth = 0
+        self.send_time_total = 0.0
+        self.send_time_max = 0.0
+
+    def record_enqueue(self, depth, coalesced):
+        with self.lock:
+            self.enqueued += 1
+            if coalesced:
+                self.coalesced += 1
+            if depth > self.max_depth:
+                self.max_depth = depth
+
+    def record_write(self, messages, send_time):
+        with self.lock:
+            self.writes += 1
+            self.sent += messages
+            self.send_time_total += send_time
+            if send_time > self.send_time_max:
+                self.send_time_max = send_time
+
+    def report(self):
+        with self.lock:
+            avg_send_ms = (self.send_time_total / self.writes * 1000) if self.writes else 0.0
+            summary = (f"[OUTBOUND STATS] {self.enqueued} queued, {self.coalesced} movement commands coalesced, "
+                       f"{self.sent} sent in {self.writes} writes, max queue depth {self.max_depth}, "
+                       f"send time avg {avg_send_ms:.3f}ms max {self.send_time_max * 1000:.3f}ms")
+            self.reset()
+        return summary
+
+outbound_stats = OutboundStats()
+
+class OutboundQueue:
+    """Pending messages for one device, drained by that device's writer.
+
+    Critical messages (disable, enable, shoot, ...) are always delivered in
+    order. A movement message replaces the movement message waiting at the
+    tail of the queue, so a slow link only ever sends the latest direction.
+    Once anything else is queued behind a movement message it is no longer
+    replaced: the new one goes behind, so it cannot overtake a shoot or
+    enable that was sent after the direction it replaces.
+    """
+
+    def __init__(self, on_ready=None):
+        self._lock = threading.Condition()
+        self._pending = deque()
+        self._pending_movement = None
+        self._on_ready = on_ready
+        self.closed = False
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def put(self, data, coalesce=False):
+        with self._lock:
+            if self.closed:
+                return False
+            coalesced = coalesce and self._pending_movement is not None
+            now = time.perf_counter()
+            if coalesced:
+                # The replacement is what gets delivered, so its wait is timed from now.
+                self._pending_movement[0] = data
+                self._pending_movement[1] = now
+            else:
+                entry = [data, now]
+                self._pending.append(entry)
+                self._pending_movement = entry if coalesce else None
+            depth = len(self._pending)
+            became_ready = depth == 1 and not coalesced
+            self._lock.notify()
+        outbound_stats.record_enqueue(depth, coalesced)
+        if became_ready and self._on_ready:
+            self._on_ready()
+        return True
+
+    def drain(self):
+        with self._lock:
+            return self._take()
+
+    def wait_and_drain(self):
+        # Blocks the writer thread until there is something to send. An empty batch means the queue was closed.
+        with self._lock:
+            while not self._pending and not self.closed:
+                self._lock.wait()
+            return self._take()
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            self._pending.clear()
+            self._pending_movement = None
+            self._lock.notify_all()
+
+    def _take(self):
+        now = time.perf_counter()
+        for entry in self._pending:
+            OUTBOUND_WAIT_SECONDS.observe(now - entry[1])
+        batch = [entry[0] for entry in self._pending]
+        self._pending.clear()
+        self._pending_movement = None
+        return batch
+
+def send_batch(write, batch):
+    # One write per batch: on the car end every queued frame arrives in the same TCP segment.
+    started = time.perf_counter()
+    write(b''.join(batch))
+    elapsed = time.perf_counter() - started
+    DEVICE_WRITE_SECONDS.observe(elapsed)
+    outbound_stats.record_write(len(batch), elapsed)
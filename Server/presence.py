@@ -0,0 +1,72 @@
+import threading
+from collections import OrderedDict
+
+class ZonePresence:
+    """Which cars are in which zone, from the stream of BS_SEEN reports.
+
+    A zone is the area covered by one team's base stations. A car parked in
+    a zone is reported on every IR broadcast, but only the first report
+    after it arrives is a change, so seen() says whether a report is an
+    entry and just refreshes the table otherwise. A car has left once no
+    base station of the zone has reported it for ttl seconds; expire()
+    finds those and the game loop turns them into ZONE_LEAVE events.
+    Device threads call seen() concurrently; only the game loop expires.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl # seconds; 0 forwards every report as it comes
+        self._lock = threading.Lock()
+        self._last_seen = OrderedDict() # (zone, car id) -> time.time() of the last report, least recently seen first
+        self.reports = 0
+        self.entries = 0
+        self.exits = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def seen(self, zone, car_id, now):
+        # True if the car has just entered the zone.
+        key = (zone, car_id)
+        with self._lock:
+            self.reports += 1
+            entered = key not in self._last_seen
+            if entered:
+                self.entries += 1
+            else:
+                self._last_seen.move_to_end(key)
+            self._last_seen[key] = now
+            return entered
+
+    def forget_car(self, car_id):
+        # A car that connects again starts outside every zone, so its next report is an entry.
+        with self._lock:
+            for key in [key for key in self._last_seen if key[1] == car_id]:
+                del self._last_seen[key]
+
+    def next_expiry(self):
+        with self._lock:
+            if not self._last_seen:
+                return None
+            return next(iter(self._last_seen.values())) + self.ttl
+
+    def expire(self, now):
+        # (zone, car id) of every car not reported in its zone for ttl seconds, which are now out of it.
+        left = []
+        with self._lock:
+            while self._last_seen:
+                key, last_seen = next(iter(self._last_seen.items()))
+                if last_seen + self.ttl > now:
+                    break
+                del self._last_seen[key]
+                left.append(key)
+            self.exits += len(left)
+        return left
+
+    def report(self):
+        with self._lock:
+            reports, entries, exits = self.reports, self.entries, self.exits
+            self.reports = self.entries = self.exits = 0
+            present = len(self._last_seen)
+        return (f"[ZONES] {reports} BS_SEEN reports became {entries} entries and {exits} exits; "
+                f"{present} cars in zones")
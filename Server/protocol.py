@@ -0,0 +1,90 @@
+import itertools
+import struct
+
+# --- Binary wire protocol ---
+# Every frame is the same six bytes in both directions:
+#   version (0xB1), opcode, device id, payload, sequence number (uint16, little endian)
+# A connection starts in the ASCII protocol. A device that sends "HELLO:proto=bin1" and receives an
+# OP_HELLO_ACK frame back switches to binary frames for the rest of the connection.
+PROTOCOL_VERSION = 0xB1
+FRAME = struct.Struct('<BBBBH')
+FRAME_SIZE = FRAME.size
+SEQUENCE_MASK = 0xFFFF
+
+HELLO_PREFIX = b"HELLO"
+BINARY_PROTOCOL_NAME = 'bin1'
+# "HELLO:proto=bin1,udp=5001": the car also listens for OP_DRIVE frames as UDP datagrams on that port. Their sequence
+# numbers count drive frames only, and the car applies a datagram only if it is newer than the last one it applied.
+UDP_DRIVE_OPTION = 'udp'
+
+# Server -> device opcodes reuse the ASCII command address byte, so the payload is the command byte.
+OP_DRIVE = 0x02
+OP_SHOOT = 0x03
+OP_GAME = 0x80
+OP_PING = 0x81 # payload: low byte of the sequence number; the device echoes it back in an OP_PONG frame
+OP_HELLO_ACK = 0x01 # payload: the server's heartbeat interval in HEARTBEAT_UNITs, 0 when it sends no heartbeats
+HEARTBEAT_UNIT = 0.01 # seconds
+
+# Device -> server opcodes. The payload is the IR address that was decoded.
+OP_CAR_SEEN = 0x10
+OP_BS_SEEN = 0x11
+OP_PONG = 0x12 # payload and sequence number copied from the OP_PING being answered
+
+DEVICE_OPCODE_EVENTS = {
+    OP_CAR_SEEN: 'CAR_SEEN',
+    OP_BS_SEEN: 'BS_SEEN',
+}
+
+def parse_hello(frame):
+    # b"HELLO:proto=bin1,role=car" -> {'proto': 'bin1', 'role': 'car'}
+    _, _, payload = frame.partition(b':')
+    options = {}
+    for item in payload.decode('ascii', 'replace').split(','):
+        key, _, value = item.partition('=')
+        if key:
+            options[key.strip()] = value.strip()
+    return options
+
+def encode_frame(opcode, device_id, payload, sequence):
+    return FRAME.pack(PROTOCOL_VERSION, opcode, device_id & 0xFF, payload & 0xFF, sequence & SEQUENCE_MASK)
+
+def sequence_is_newer(sequence, last):
+    # Sequence numbers wrap at 16 bits; up to half the range ahead of last counts as newer.
+    return 0 < (sequence - last) & SEQUENCE_MASK < 0x8000
+
+def decode_frame(frame):
+    # Returns (opcode, device_id, payload, sequence); raises ValueError on a bad version byte.
+    version, opcode, device_id, payload, sequence = FRAME.unpack(frame)
+    if version != PROTOCOL_VERSION:
+        raise ValueError(f"unsupported protocol version 0x{version:02X}")
+    return opcode, device_id, payload, sequence
+
+class CommandFrames:
+    # Pre-built frames for one device. Sending only has to copy a template and stamp the sequence number.
+    def __init__(self, device_id, commands):
+        self.device_id = device_id
+        self._sequence = itertools.count(1)
+        self._templates = {
+            (address, command): encode_frame(address, device_id, command, 0)
+            for address, command in commands
+        }
+
+    def next_sequence(self):
+        return next(self._sequence) & SEQUENCE_MASK
+
+    def build(self, address, command):
+        template = self._templates.get((address, command))
+        if template is None:
+            return encode_frame(address, self.device_id, command, self.next_sequence())
+        frame = bytearray(template)
+        struct.pack_into('<H', frame, 4, self.next_sequence())
+        return bytes(frame)
+
+    def ping(self, sequence):
+        return encode_frame(OP_PING, self.device_id, sequence, sequence)
+
+    def hello_ack(self, heartbeat_interval):
+        # The device times its failsafe from the advertised interval. One too long to fit in a byte is advertised as 0,
+        # which turns the failsafe off rather than have it fire between heartbeats.
+        units = max(1, round(heartbeat_interval / HEARTBEAT_UNIT)) if heartbeat_interval > 0 else 0
+        return encode_frame(OP_HELLO_ACK, self.device_id, units if units <= 0xFF else 0, self.next_sequence())
@@ -0,0 +1,113 @@
+"""How long snapshots and crash recovery take, for arenas of different sizes.
+
+`python recovery_benchmark.py --cars 10,100,255` builds a game state with
+that many cars (a third of them disabled, some safe, moving or holding
+a flag, each with its timers) and times the three parts of the cycle.
+Capture is GameState.describe() on the game loop. Write is the
+background thread's JSON encode, fsync and rename. Restore is what a
+restarted server does before it is back in play: load the snapshot,
+rebuild the state and replay one snapshot interval of journal.
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+import main
+from journal import EventJournal, JournalReader
+from logpipeline import ERROR
+from snapshot import write_snapshot, load_snapshot
+
+BASE_STATIONS = 4
+REPEATS = 20
+JOURNAL_RECORDS_PER_CAR_SECOND = 6 # ticks, sightings and web commands a busy car adds to the journal each second
+
+def build_game_state(cars, rng):
+    game_state = main.reset_game_state()
+    now = time.time()
+    for car_id in range(1, cars + 1):
+        car = main.Car(car_id, '127.0.0.1', main.DetachedConnection(('127.0.0.1', 20000 + car_id)))
+        game_state.add_car(car)
+        if rng.random() < 0.3:
+            game_state.disable_car(car, now - rng.uniform(0, main.PENALTY_DURATION))
+        if rng.random() < 0.2:
+            game_state.mark_car_safe(car, now)
+            car.is_safe = True
+        if rng.random() < 0.5:
+            game_state.record_web_command(car, 'forward', now)
+        car.has_flag = rng.random() < 0.02
+    for bs_id in range(1, BASE_STATIONS + 1):
+        game_state.add_base_station(main.BaseStation(bs_id, '127.0.0.1', main.DetachedConnection(('127.0.0.1', 10000 + bs_id))))
+    return game_state
+
+def write_journal_tail(path, cars, rng):
+    # One snapshot interval of a busy match, recorded the way the game loop would.
+    journal = EventJournal()
+    journal.open(path)
+    offset = journal.offset
+    now = time.time()
+    records = int(cars * JOURNAL_RECORDS_PER_CAR_SECOND * main.SNAPSHOT_INTERVAL)
+    for index in range(records):
+        if index % 3 == 0:
+            journal.tick(now + index / records)
+        elif index % 3 == 1:
+            journal.event(('CAR_SEEN', rng.randint(1, cars), rng.randint(1, cars)))
+        else:
+            journal.web_command(rng.randint(1, cars), rng.choice(['forward', 'left', 'stop']), now + index / records)
+    journal.close()
+    return offset, records
+
+def milliseconds(samples):
+    return {'median': statistics.median(samples) * 1000, 'max': max(samples) * 1000}
+
+def benchmark(cars, directory, rng):
+    snapshot_path = os.path.join(directory, f'snapshot-{cars}.json')
+    journal_path = os.path.join(directory, f'journal-{cars}.omcj')
+    build_game_state(cars, rng)
+    capture, write, restore = [], [], []
+    size = 0
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        state = main.game_state.describe()
+        capture.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        size = write_snapshot(snapshot_path, {'version': 1, 'saved_at': time.time(), 'state': state})
+        write.append(time.perf_counter() - started)
+
+    offset, records = write_journal_tail(journal_path, cars, rng)
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        snapshot = load_snapshot(snapshot_path)
+        main.reset_game_state()
+        playback = main.JournalPlayback()
+        main.restore_game_state(snapshot['state'], playback)
+        for record in JournalReader(journal_path, start=offset):
+            playback.apply(record)
+        main.detach_devices(time.time())
+        restore.append(time.perf_counter() - started)
+    return {'cars': cars, 'snapshot_bytes': size, 'journal_records': records, 'capture_ms': milliseconds(capture),
+            'write_ms': milliseconds(write), 'restore_ms': milliseconds(restore)}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Time OpenMicroCar snapshots and crash recovery")
+    parser.add_argument('--cars', default='10,100,255', help="Comma-separated arena sizes.")
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    main.log_pipeline.level = ERROR
+    main.PING_INTERVAL = 0
+    rng = random.Random(args.seed)
+    print(f"{'cars':>5} {'snapshot':>10} {'capture ms':>14} {'write ms':>14} {'journal':>8} {'restore ms':>14}")
+    with tempfile.TemporaryDirectory() as directory:
+        for cars in (int(count) for count in args.cars.split(',')):
+            result = benchmark(cars, directory, rng)
+            print(f"{cars:>5} {result['snapshot_bytes']:>9}B "
+                  f"{result['capture_ms']['median']:>6.2f} ({result['capture_ms']['max']:>5.2f}) "
+                  f"{result['write_ms']['median']:>6.2f} ({result['write_ms']['max']:>5.2f}) "
+                  f"{result['journal_records']:>8} "
+                  f"{result['restore_ms']['median']:>6.2f} ({result['restore_ms']['max']:>5.2f})")
+    print("Medians, with the worst of each in brackets. Capture runs on the game loop; write runs on the snapshot thread.")
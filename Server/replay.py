@@ -0,0 +1,108 @@
+"""Replay an event journal through the game logic, as fast as it will go.
+
+Record a match with `python main.py --journal match.omcj`, then run
+`python replay.py match.omcj`. Every recorded tick, device event and web
+command is fed to a fresh GameState with the current rules in main.py,
+and each checkpoint digest in the journal is compared with the replayed
+state. With unchanged rules every checkpoint matches; after a rule change
+the report shows how the same match would have gone. --trace logs every
+record with its game time, which is how a disputed shot gets settled.
+"""
+import argparse
+import json
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+import main
+from journal import JournalReader, digest_state
+from logpipeline import INFO, ERROR
+
+class ReplayResult:
+    def __init__(self):
+        self.records = Counter()
+        self.sessions = 0 # server starts, including ones that recovered a snapshot
+        self.checkpoints_matched = 0
+        self.mismatches = [] # game times of checkpoints the replayed state did not match
+        self.journal_seconds = 0.0 # game time covered by the ticks, summed over sessions
+        self.elapsed = 0.0
+        self.truncated_bytes = 0
+        self.final_state = None
+
+    def summary(self):
+        speedup = self.journal_seconds / self.elapsed if self.elapsed else 0.0
+        lines = [f"Replayed {sum(self.records.values())} records from {self.sessions} session(s) covering "
+                 f"{self.journal_seconds:.1f}s of play in {self.elapsed:.3f}s ({speedup:.0f}x real time)."]
+        lines.append("Records: " + ", ".join(f"{kind} {count}" for kind, count in sorted(self.records.items())))
+        if self.truncated_bytes:
+            lines.append(f"Ignored {self.truncated_bytes} bytes of a record cut short at the end of the journal.")
+        lines.append(f"Checkpoints: {self.checkpoints_matched} matched, {len(self.mismatches)} differed.")
+        if self.mismatches:
+            lines.append(f"First difference at game time {format_game_time(self.mismatches[0])}.")
+        return '\n'.join(lines)
+
+def replay(path, trace=False):
+    main.PING_INTERVAL = 0 # probes are not game state
+    main.reset_game_state()
+    playback = main.JournalPlayback()
+    result = ReplayResult()
+    session_start = None
+    reader = JournalReader(path)
+    started = time.perf_counter()
+    for record in reader:
+        kind = record[0]
+        result.records[kind] += 1
+        if trace and kind != 'TICK':
+            main.log_with_timestamp(f"[REPLAY {format_game_time(playback.current_time)}] {record}")
+
+        if kind in ('SESSION', 'RESUME'):
+            if playback.current_time is not None and session_start is not None:
+                result.journal_seconds += playback.current_time - session_start
+            result.sessions += 1
+            session_start = None
+        elif kind == 'TICK' and session_start is None:
+            session_start = record[1]
+
+        if kind == 'CHECKPOINT':
+            _, checkpoint_time, digest = record
+            if digest_state(main.game_state.describe()) == digest:
+                result.checkpoints_matched += 1
+            else:
+                result.mismatches.append(checkpoint_time)
+        else:
+            playback.apply(record)
+    if playback.current_time is not None and session_start is not None:
+        result.journal_seconds += playback.current_time - session_start
+    result.elapsed = time.perf_counter() - started
+    result.truncated_bytes = reader.truncated_bytes
+    result.final_state = main.game_state.describe()
+    return result
+
+def format_game_time(game_time):
+    if game_time is None:
+        return '-'
+    return datetime.fromtimestamp(game_time).strftime('%H:%M:%S.%f')[:-3]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay an OpenMicroCar event journal through the game logic")
+    parser.add_argument('journal', help="Journal written by main.py --journal.")
+    parser.add_argument('--trace', action='store_true', help="Log every record and the game log lines it causes.")
+    parser.add_argument('--state', metavar='PATH', help="Write the final game state to this file as JSON.")
+    parser.add_argument('--verify', action='store_true',
+                        help="Exit with status 1 unless every checkpoint matched (and there was at least one).")
+    parser.add_argument('--reconnect-grace', type=float, default=main.RECONNECT_GRACE,
+                        help="The --reconnect-grace the match was played with, since it decides when a dropped car is forgotten.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    main.log_pipeline.level = INFO if args.trace else ERROR
+    main.RECONNECT_GRACE = args.reconnect_grace
+    result = replay(args.journal, trace=args.trace)
+    main.log_pipeline.flush()
+    print(result.summary())
+    if args.state:
+        with open(args.state, 'w') as state_file:
+            json.dump(result.final_state, state_file, indent=2, sort_keys=True)
+    if args.verify and (result.mismatches or not result.checkpoints_matched):
+        sys.exit(1)
@@ -0,0 +1,126 @@
+"""The roster: teams, and which car or base station is at which IP address.
+
+It is loaded from a JSON file (roster.json next to main.py, or --roster),
+in the same format as one arena of an arenas.py config:
+
+    {
+      "teams": {"1": "Team Alpha", "2": "Team Beta"},
+      "cars": {"192.168.77.51": {"id": 1, "ir_address": 1, "team": 1}},
+      "base_stations": {"192.168.77.11": {"id": 1, "team": 1}}
+    }
+
+A car's ir_address defaults to its id. Roster.from_config() checks the
+whole file and builds every lookup table up front. A Roster never
+changes after that; a new file becomes a new Roster that replaces the old
+one in a single assignment, so readers on any thread need no lock.
+"""
+import json
+from collections import namedtuple
+from types import MappingProxyType
+
+CarEntry = namedtuple('CarEntry', ['id', 'ir_address', 'team'])
+BaseStationEntry = namedtuple('BaseStationEntry', ['id', 'team'])
+
+class Roster:
+    def __init__(self, teams, cars_by_ip, base_stations_by_ip, source=None):
+        self.source = source
+        self.teams = MappingProxyType(dict(teams)) # team id -> name
+        self.team_ids = tuple(sorted(teams))
+        self.cars_by_ip = MappingProxyType(dict(cars_by_ip)) # ip -> CarEntry
+        self.base_stations_by_ip = MappingProxyType(dict(base_stations_by_ip)) # ip -> BaseStationEntry
+        self.car_id_by_ir_address = MappingProxyType({car.ir_address: car.id for car in cars_by_ip.values()})
+        self.ir_address_by_car_id = MappingProxyType({car.id: car.ir_address for car in cars_by_ip.values()})
+        self.car_teams = MappingProxyType({car.id: car.team for car in cars_by_ip.values()})
+        self.base_station_teams = MappingProxyType({bs.id: bs.team for bs in base_stations_by_ip.values()})
+
+    @classmethod
+    def from_config(cls, config, source=None):
+        # Raises ValueError listing every problem in the config, so one edit can fix them all.
+        if not isinstance(config, dict):
+            raise ValueError(f"the roster must be a JSON object, not {type(config).__name__}")
+        problems = []
+        teams = {}
+        for team_id, name in _section(config, 'teams', problems).items():
+            if not str(team_id).isdigit() or not 0 < int(team_id) <= 0xFF:
+                problems.append(f"team id {team_id!r} is not a number from 1 to 255")
+            else:
+                teams[int(team_id)] = str(name)
+        if not teams:
+            problems.append("no teams")
+
+        cars_by_ip = {}
+        for ip, entry in _section(config, 'cars', problems).items():
+            if not _is_entry(entry, f"car at {ip}", problems):
+                continue
+            car_id = _integer(entry, 'id', f"car at {ip}", problems, 1, 0xFF)
+            ir_address = _integer(entry, 'ir_address', f"car at {ip}", problems, 0, 0xFF, default=car_id or 0)
+            team = _team(entry, f"car at {ip}", teams, problems)
+            if None not in (car_id, ir_address, team):
+                cars_by_ip[ip] = CarEntry(car_id, ir_address, team)
+        base_stations_by_ip = {}
+        for ip, entry in _section(config, 'base_stations', problems).items():
+            if not _is_entry(entry, f"base station at {ip}", problems):
+                continue
+            bs_id = _integer(entry, 'id', f"base station at {ip}", problems, 1, 0xFFFF)
+            team = _team(entry, f"base station at {ip}", teams, problems)
+            if None not in (bs_id, team):
+                base_stations_by_ip[ip] = BaseStationEntry(bs_id, team)
+
+        _unique([car.id for car in cars_by_ip.values()], "car id", problems)
+        _unique([car.ir_address for car in cars_by_ip.values()], "IR address", problems)
+        _unique([bs.id for bs in base_stations_by_ip.values()], "base station id", problems)
+        for ip in set(cars_by_ip) & set(base_stations_by_ip):
+            problems.append(f"{ip} is both a car and a base station")
+        if problems:
+            raise ValueError("; ".join(problems))
+        return cls(teams, cars_by_ip, base_stations_by_ip, source)
+
+    def team_name(self, team_id):
+        return self.teams.get(team_id, f"Team {team_id}")
+
+    def describe(self):
+        return (f"{len(self.cars_by_ip)} cars and {len(self.base_stations_by_ip)} base stations on "
+                f"{len(self.teams)} teams ({', '.join(self.teams.values())})")
+
+def load_roster(path):
+    with open(path) as roster_file:
+        try:
+            config = json.load(roster_file)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"not valid JSON: {e}") from None
+    return Roster.from_config(config, source=path)
+
+def _section(config, name, problems):
+    section = config.get(name, {})
+    if not isinstance(section, dict):
+        problems.append(f"{name} must be a JSON object, not {type(section).__name__}")
+        return {}
+    return section
+
+def _is_entry(entry, what, problems):
+    if not isinstance(entry, dict):
+        problems.append(f"{what} must be a JSON object, not {entry!r}")
+        return False
+    return True
+
+def _integer(entry, field, what, problems, low, high, default=None):
+    value = entry.get(field, default)
+    if isinstance(value, int) and not isinstance(value, bool) and low <= value <= high:
+        return value
+    if value is not None or default is None:
+        problems.append(f"{what} needs an integer {field} from {low} to {high}, not {value!r}")
+    return None
+
+def _team(entry, what, teams, problems):
+    team = entry.get('team')
+    if isinstance(team, bool) or team not in teams: # True == 1, but is not team 1
+        problems.append(f"{what} is on team {team!r}, which is not in teams")
+        return None
+    return team
+
+def _unique(values, what, problems):
+    seen = set()
+    for value in values:
+        if value in seen:
+            problems.append(f"{what} {value} is used more than once")
+        seen.add(value)
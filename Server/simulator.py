@@ -0,0 +1,322 @@
+"""Virtual cars and base stations that speak the device protocol over loopback.
+
+Start the server with `python main.py --identity hello`, then for example
+`python simulator.py --cars 100 --base-stations 4 --binary`. Each virtual
+device names itself in its HELLO line, answers pings, obeys the game and
+movement commands, and sends CAR_SEEN/BS_SEEN reports on the same IR
+cadence as the firmware. With --udp the cars also take drive commands as
+UDP datagrams, dropping stale ones like the firmware (server --udp-drive).
+The classes are also used by the benchmarks.
+"""
+import argparse
+import asyncio
+import random
+import time
+from protocol import (PROTOCOL_VERSION, FRAME_SIZE, BINARY_PROTOCOL_NAME, UDP_DRIVE_OPTION, OP_HELLO_ACK, OP_GAME,
+                      OP_DRIVE, OP_SHOOT, OP_PING, OP_PONG, OP_CAR_SEEN, OP_BS_SEEN, encode_frame, decode_frame,
+                      sequence_is_newer)
+
+HOST = '127.0.0.1'
+PORT = 5000
+TEAMS = (1, 2)
+
+# Firmware timings
+IR_BROADCAST_INTERVAL = 0.5 # seconds between a car's IR broadcasts...
+IR_BROADCAST_JITTER = 0.1 # ...plus up to this much random jitter to avoid collisions
+HELLO_TIMEOUT = 0.5 # seconds to wait for the binary protocol acknowledgement
+_VERSION_BYTE = bytes([PROTOCOL_VERSION])
+CONNECT_CONCURRENCY = 50 # connections opened at once, so hundreds of devices do not overflow the listen backlog
+
+# World model
+CARS_IN_RANGE = 3 # other cars close enough to possibly decode each broadcast
+SIGHTING_PROBABILITY = 0.3 # chance a car in range decodes a broadcast
+MAX_BURST = 3 # a decoded code is often reported several times in a row
+ZONE_CHANGE_PROBABILITY = 0.05 # chance per broadcast that a car drives into or out of a safe zone
+
+class DriveDatagrams(asyncio.DatagramProtocol):
+    # A virtual car's UDP drive port: applies an OP_DRIVE frame only if it is newer than the last one applied.
+    def __init__(self, device):
+        self.device = device
+        self.last_sequence = None
+
+    def datagram_received(self, data, addr):
+        received_at = time.perf_counter()
+        if len(data) != FRAME_SIZE:
+            return
+        try:
+            opcode, _, payload, sequence = decode_frame(data)
+        except ValueError:
+            return
+        if opcode != OP_DRIVE:
+            return
+        if self.last_sequence is not None and not sequence_is_newer(sequence, self.last_sequence):
+            self.device.stale_datagrams += 1
+            return
+        self.last_sequence = sequence
+        self.device._handle_command(opcode, payload, sequence, received_at)
+
+class VirtualDevice:
+    role = None
+
+    def __init__(self, device_id, team_id, binary=False):
+        self.id = device_id
+        self.team_id = team_id
+        self.binary = binary
+        self.arena = None # arena to join on a multi-arena server (arenas.py --identity hello)
+        self.udp = False # offer a UDP port for drive commands (cars on the binary protocol only)
+        self.udp_transport = None
+        self.stale_datagrams = 0
+        self.reader = None
+        self.writer = None
+        self.connected = False
+        self.sequence = 0
+        self.commands_received = 0
+        self.reports_sent = 0
+        self.pings_answered = 0
+        self.resyncs = 0
+        self.listeners = [] # callables(device, opcode, payload, sequence, received_at) run for every command
+        self._reader_task = None
+
+    async def connect(self, host=HOST, port=PORT):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        hello = f"HELLO:role={self.role},id={self.id},team={self.team_id}"
+        if self.binary:
+            hello += f",proto={BINARY_PROTOCOL_NAME}"
+            if self.udp:
+                # A fresh port per connection, so no datagram numbered for an earlier connection gets through.
+                self.udp_transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                    lambda: DriveDatagrams(self), local_addr=(self.writer.get_extra_info('sockname')[0], 0))
+                hello += f",{UDP_DRIVE_OPTION}={self.udp_transport.get_extra_info('sockname')[1]}"
+        if self.arena:
+            hello += f",arena={self.arena}"
+        self.writer.write(hello.encode('ascii') + b"\n")
+        if self.binary:
+            try:
+                frame = await asyncio.wait_for(self._read_frame(), HELLO_TIMEOUT)
+                self.binary = frame[0] == PROTOCOL_VERSION and frame[1] == OP_HELLO_ACK
+            except asyncio.TimeoutError:
+                self.binary = False
+        self.connected = True
+        self._reader_task = asyncio.ensure_future(self._read_commands())
+
+    async def close(self):
+        self.connected = False
+        if self.writer:
+            self.writer.close()
+        if self.udp_transport:
+            self.udp_transport.close()
+        if self._reader_task:
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+
+    async def _read_commands(self):
+        try:
+            while True:
+                if self.binary:
+                    frame = await self._read_frame()
+                    received_at = time.perf_counter()
+                    try:
+                        opcode, _, payload, sequence = decode_frame(frame)
+                    except ValueError:
+                        continue
+                else:
+                    line = await self.reader.readline()
+                    if not line:
+                        break
+                    received_at = time.perf_counter()
+                    line = line.strip()
+                    if len(line) != 4:
+                        continue
+                    opcode, payload, sequence = int(line[:2], 16), int(line[2:], 16), None
+                self._handle_command(opcode, payload, sequence, received_at)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connected = False
+
+    async def _read_frame(self):
+        # Every binary frame starts with the version byte; whatever comes before it (ASCII sent before the switch,
+        # the tail of a torn frame) is skipped, so one bad byte costs one frame and not the rest of the connection.
+        skipped = await self.reader.readuntil(_VERSION_BYTE)
+        if len(skipped) > 1:
+            self.resyncs += 1
+        return _VERSION_BYTE + await self.reader.readexactly(FRAME_SIZE - 1)
+
+    def _handle_command(self, opcode, payload, sequence, received_at):
+        if opcode == OP_PING:
+            self._send_pong(payload, sequence)
+            return
+        self.commands_received += 1
+        self.on_command(opcode, payload)
+        for listener in self.listeners:
+            listener(self, opcode, payload, sequence, received_at)
+
+    def on_command(self, opcode, payload):
+        pass
+
+    def _send_pong(self, payload, sequence):
+        self.pings_answered += 1
+        if self.binary:
+            self.writer.write(encode_frame(OP_PONG, self.id, payload, sequence))
+        else:
+            self.writer.write(f"PONG:{payload:02X}\n".encode('ascii'))
+
+    def report(self, event_type, opcode, ir_address):
+        if not self.connected: return
+        self.reports_sent += 1
+        if self.binary:
+            self.sequence += 1
+            self.writer.write(encode_frame(opcode, self.id, ir_address, self.sequence))
+        else:
+            self.writer.write(f"{event_type}:{ir_address:02X}\n".encode('ascii'))
+
+class VirtualCar(VirtualDevice):
+    role = 'car'
+
+    def __init__(self, car_id, team_id, binary=False):
+        super().__init__(car_id, team_id, binary)
+        self.ir_address = car_id
+        self.is_disabled = False
+        self.movement = None
+        self.shots = 0
+        self.zone = None # team id of the safe zone the car is in, if any
+
+    def on_command(self, opcode, payload):
+        if opcode == OP_GAME:
+            if payload == 0x01:
+                self.is_disabled = True
+            elif payload == 0x02:
+                self.is_disabled = False
+        elif opcode == OP_DRIVE:
+            self.movement = payload
+        elif opcode == OP_SHOOT:
+            self.shots += 1
+
+    def report_car_seen(self, ir_address):
+        self.report("CAR_SEEN", OP_CAR_SEEN, ir_address)
+
+class VirtualBaseStation(VirtualDevice):
+    role = 'base_station'
+
+    def report_car_in_zone(self, ir_address):
+        self.report("BS_SEEN", OP_BS_SEEN, ir_address)
+
+class Arena:
+    """The simulated playing field.
+
+    Every connected, enabled car broadcasts its IR address every
+    IR_BROADCAST_INTERVAL plus jitter. A few other cars are in range of
+    each broadcast and may decode it, sometimes several times in a row,
+    and the base stations of whatever zone the car is in report it. Cars
+    wander in and out of the safe zones at random.
+    """
+
+    def __init__(self, cars, base_stations, seed=None):
+        self.cars = cars
+        self.base_stations = base_stations
+        self.rng = random.Random(seed)
+        self.running = False
+
+    async def connect(self, host=HOST, port=PORT):
+        limit = asyncio.Semaphore(CONNECT_CONCURRENCY)
+        async def connect_one(device):
+            async with limit:
+                await device.connect(host, port)
+        await asyncio.gather(*(connect_one(device) for device in self.cars + self.base_stations))
+
+    async def run(self, duration):
+        self.running = True
+        tasks = [asyncio.ensure_future(self._broadcast_loop(car)) for car in self.cars]
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            self.running = False
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def close(self):
+        await asyncio.gather(*(device.close() for device in self.cars + self.base_stations))
+
+    async def _broadcast_loop(self, car):
+        await asyncio.sleep(self.rng.uniform(0, IR_BROADCAST_INTERVAL)) # cars were not all switched on at once
+        while self.running:
+            await asyncio.sleep(IR_BROADCAST_INTERVAL + self.rng.uniform(0, IR_BROADCAST_JITTER))
+            if car.connected and not car.is_disabled:
+                self.broadcast(car)
+
+    def broadcast(self, car):
+        others = [other for other in self.rng.sample(self.cars, min(CARS_IN_RANGE + 1, len(self.cars))) if other is not car]
+        for observer in others[:CARS_IN_RANGE]:
+            if observer.connected and self.rng.random() < SIGHTING_PROBABILITY:
+                for _ in range(self.rng.randint(1, MAX_BURST)):
+                    observer.report_car_seen(car.ir_address)
+
+        if self.rng.random() < ZONE_CHANGE_PROBABILITY:
+            car.zone = self.rng.choice((None, None) + TEAMS)
+        if car.zone is not None:
+            for base_station in self.base_stations:
+                if base_station.team_id == car.zone:
+                    base_station.report_car_in_zone(car.ir_address)
+
+def build_devices(cars, base_stations, binary=False, arena=None, udp=False):
+    # Car ids start at 1 and double as IR addresses, so at most 255 cars. Teams alternate.
+    if cars > 0xFF:
+        raise ValueError("at most 255 cars: a car's id is its one-byte IR address")
+    virtual_cars = [VirtualCar(car_id, TEAMS[(car_id - 1) % len(TEAMS)], binary) for car_id in range(1, cars + 1)]
+    virtual_base_stations = [VirtualBaseStation(bs_id, TEAMS[(bs_id - 1) % len(TEAMS)], binary)
+                             for bs_id in range(1, base_stations + 1)]
+    for device in virtual_cars + virtual_base_stations:
+        device.arena = arena
+    for car in virtual_cars:
+        car.udp = udp
+    return virtual_cars, virtual_base_stations
+
+def summarize(cars, base_stations, elapsed):
+    devices = cars + base_stations
+    reports = sum(device.reports_sent for device in devices)
+    commands = sum(device.commands_received for device in devices)
+    pings = sum(device.pings_answered for device in devices)
+    connected = sum(1 for device in devices if device.connected)
+    disabled = sum(1 for car in cars if car.is_disabled)
+    summary = (f"{connected}/{len(devices)} devices connected, {reports} reports sent ({reports / elapsed:.0f}/s), "
+               f"{commands} commands received, {pings} pings answered, {disabled} cars disabled at the end")
+    if any(car.udp for car in cars):
+        summary += f", {sum(car.stale_datagrams for car in cars)} stale drive datagrams dropped"
+    resyncs = sum(device.resyncs for device in devices)
+    if resyncs:
+        summary += f", {resyncs} resyncs on the binary stream"
+    return summary
+
+async def simulate(args):
+    cars, base_stations = build_devices(args.cars, args.base_stations, args.binary, args.arena, args.udp)
+    arena = Arena(cars, base_stations, seed=args.seed)
+    await arena.connect(args.host, args.port)
+    print(f"Connected {len(cars)} cars and {len(base_stations)} base stations to {args.host}:{args.port}.")
+    started = time.monotonic()
+    try:
+        await arena.run(args.duration)
+    finally:
+        print(summarize(cars, base_stations, time.monotonic() - started))
+        await arena.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Simulated OpenMicroCar cars and base stations")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--cars', type=int, default=10)
+    parser.add_argument('--base-stations', type=int, default=2)
+    parser.add_argument('--binary', action='store_true', help="Negotiate the binary protocol instead of ASCII.")
+    parser.add_argument('--udp', action='store_true', help="Cars offer a UDP port for drive commands (needs --binary).")
+    parser.add_argument('--duration', type=float, default=60, help="Seconds to run before disconnecting.")
+    parser.add_argument('--seed', type=int, default=None, help="Random seed, for repeatable runs.")
+    parser.add_argument('--arena', help="Arena to join, when the server is arenas.py in hello identity mode.")
+    args = parser.parse_args()
+    if args.udp and not args.binary:
+        parser.error("--udp needs --binary: drive datagrams are binary frames")
+    return args
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(simulate(parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+import time
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_JOURNAL_SYNC_TIMEOUT = 2.0 # seconds to wait for the journal to reach a snapshot's offset before skipping it
+
+class SnapshotWriter:
+    """Keeps an up-to-date copy of the game state on disk.
+
+    The game loop calls submit() with GameState.describe() (plain data,
+    already consistent with the journal offset it was taken at) and
+    returns straight away. A background thread keeps only the newest
+    submission, waits until the journal is fsynced up to its offset, so a
+    snapshot never runs ahead of the journal, then writes it to a
+    temporary file, fsyncs it and renames it over the previous snapshot.
+    A crash at any point leaves either the old snapshot or the new one.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.journal = None
+        self._pending = None
+        self._ready = threading.Condition()
+        self._writer = None
+        self.written = 0
+        self.skipped = 0
+        self.bytes_written = 0
+        self.write_time_max = 0.0
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def open(self, path, journal=None):
+        self.path = path
+        self.journal = journal if journal is not None and journal.enabled else None
+        self._writer = threading.Thread(target=self._run, name="snapshot-writer", daemon=True)
+        self._writer.start()
+
+    def submit(self, state, saved_at):
+        snapshot = {'version': SNAPSHOT_VERSION, 'saved_at': saved_at, 'state': state}
+        if self.journal:
+            snapshot['journal'] = os.path.abspath(self.journal.path)
+            snapshot['journal_offset'] = self.journal.offset
+        with self._ready:
+            if self._pending is not None:
+                self.skipped += 1 # the writer has not caught up; the newer state replaces the unwritten one
+            self._pending = snapshot
+            self._ready.notify()
+
+    def report(self):
+        with self._ready:
+            summary = (f"[SNAPSHOT] {self.written} written ({self.bytes_written} bytes), {self.skipped} superseded before writing, "
+                       f"write time max {self.write_time_max * 1000:.1f}ms")
+            self.written = 0
+            self.skipped = 0
+            self.bytes_written = 0
+            self.write_time_max = 0.0
+        return summary
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while self._pending is None:
+                    self._ready.wait()
+                snapshot, self._pending = self._pending, None
+            started = time.perf_counter()
+            if self.journal and not self.journal.sync(snapshot['journal_offset'], SNAPSHOT_JOURNAL_SYNC_TIMEOUT):
+                with self._ready:
+                    self.skipped += 1
+                continue
+            try:
+                size = write_snapshot(self.path, snapshot)
+            except OSError:
+                with self._ready:
+                    self.skipped += 1
+                continue
+            elapsed = time.perf_counter() - started
+            with self._ready:
+                self.written += 1
+                self.bytes_written += size
+                self.write_time_max = max(self.write_time_max, elapsed)
+
+def write_snapshot(path, snapshot):
+    # Atomic replace: write and fsync a temporary file next to the target, rename it, then fsync the directory.
+    data = json.dumps(snapshot, separators=(',', ':')).encode('utf-8')
+    temporary = f"{path}.tmp"
+    with open(temporary, 'wb') as snapshot_file:
+        snapshot_file.write(data)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temporary, path)
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+    return len(data)
+
+def load_snapshot(path):
+    """The snapshot saved at path, or None if there is none. Raises ValueError if it cannot be used."""
+    try:
+        with open(path, 'rb') as snapshot_file:
+            snapshot = json.loads(snapshot_file.read())
+    except FileNotFoundError:
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+        raise ValueError(f"{path} is not a version {SNAPSHOT_VERSION} snapshot")
+    return snapshot
@@ -0,0 +1,145 @@
+import json
+import threading
+from collections import deque
+
+SUBSCRIBER_QUEUE_LIMIT = 64 # undelivered messages per subscriber before it is resynced with a fresh snapshot
+KEEPALIVE_INTERVAL = 15 # seconds of silence before an SSE comment is sent to keep proxies from closing the stream
+KEEPALIVE = b": keepalive\n\n"
+
+# Car fields pushed to subscribers, as (wire key, Car attribute). Messages are JSON with these short keys:
+#   {"c": {"3": {"d": true}}, "x": [4], "F": {"1": 3}}
+#   c = cars, by id, with only the fields that changed (all of them in a snapshot)
+#   x = ids of cars that disconnected, F = flag holder per team (null when the flag is home)
+CAR_FIELDS = (('t', 'team_id'), ('d', 'is_disabled'), ('s', 'is_safe'), ('f', 'has_flag'))
+
+def car_view(car):
+    return {key: getattr(car, attribute) for key, attribute in CAR_FIELDS}
+
+def encode_event(kind, event_id, payload):
+    data = json.dumps(payload, separators=(',', ':'))
+    return f"id: {event_id}\nevent: {kind}\ndata: {data}\n\n".encode('utf-8')
+
+class Subscriber:
+    """Messages waiting for one SSE client.
+
+    The game loop delivers; the client's web thread (wait_and_drain) or
+    event loop (drain, woken through on_ready) takes them. A client that
+    falls SUBSCRIBER_QUEUE_LIMIT messages behind has its backlog thrown
+    away and is sent a fresh snapshot instead.
+    """
+
+    def __init__(self, on_ready=None, limit=SUBSCRIBER_QUEUE_LIMIT):
+        self._lock = threading.Condition()
+        self._pending = deque()
+        self._on_ready = on_ready
+        self.limit = limit
+
+    def deliver(self, message):
+        # Returns False (and empties the backlog) when the subscriber has fallen too far behind.
+        with self._lock:
+            if len(self._pending) >= self.limit:
+                self._pending.clear()
+                return False
+            self._pending.append(message)
+            self._lock.notify()
+        if self._on_ready:
+            self._on_ready()
+        return True
+
+    def drain(self):
+        with self._lock:
+            messages = list(self._pending)
+            self._pending.clear()
+            return messages
+
+    def wait_and_drain(self, timeout):
+        with self._lock:
+            if not self._pending:
+                self._lock.wait(timeout)
+            messages = list(self._pending)
+            self._pending.clear()
+            return messages
+
+class StateStream:
+    """Pushes changes to the cars and flags to every subscriber.
+
+    publish() is called by the game loop after a batch that changed any
+    car or flag, with the ids of the cars it changed. It compares just
+    those cars' published fields with what was last sent and, if anything
+    changed, encodes one delta message and hands the same bytes to every
+    subscriber. A new subscriber starts with a full snapshot, which is
+    encoded once per state version however many clients join.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cars = {}
+        self._flags = {}
+        self._subscribers = set()
+        self._event_id = 0
+        self._snapshot = None
+        self.deltas = 0
+        self.resyncs = 0
+
+    def publish(self, cars, flags, car_ids):
+        # car_ids: the cars that may have changed, joined or left since the last publish.
+        changed_cars = {}
+        removed = []
+        for car_id in car_ids:
+            car = cars.get(car_id)
+            previous = self._cars.get(car_id)
+            if car is None:
+                if previous is not None:
+                    removed.append(car_id)
+                continue
+            view = car_view(car)
+            changed = view if previous is None else {key: value for key, value in view.items() if previous[key] != value}
+            if changed:
+                changed_cars[car_id] = changed
+        changed_flags = {team: holder for team, holder in flags.items() if team not in self._flags or self._flags[team] != holder}
+        if not (changed_cars or removed or changed_flags):
+            return False
+
+        delta = {}
+        if changed_cars: delta['c'] = changed_cars
+        if removed: delta['x'] = removed
+        if changed_flags: delta['F'] = changed_flags
+        with self._lock:
+            for car_id, changed in changed_cars.items():
+                self._cars.setdefault(car_id, {}).update(changed)
+            for car_id in removed:
+                del self._cars[car_id]
+            self._flags.update(changed_flags)
+            self._event_id += 1
+            self.deltas += 1
+            message = encode_event('delta', self._event_id, delta)
+            for subscriber in self._subscribers:
+                if not subscriber.deliver(message):
+                    self.resyncs += 1
+                    subscriber.deliver(self._snapshot_message())
+        return True
+
+    def subscribe(self, on_ready=None):
+        subscriber = Subscriber(on_ready)
+        with self._lock:
+            self._subscribers.add(subscriber)
+            subscriber.deliver(self._snapshot_message())
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def report(self):
+        with self._lock:
+            summary = f"[STATE STREAM] {self.deltas} deltas published to {len(self._subscribers)} subscribers, {self.resyncs} resyncs"
+            self.deltas = 0
+            self.resyncs = 0
+        return summary
+
+    def _snapshot_message(self):
+        # Caller holds self._lock.
+        if self._snapshot is None or self._snapshot[0] != self._event_id:
+            payload = {'c': self._cars, 'F': self._flags}
+            self._snapshot = (self._event_id, encode_event('snapshot', self._event_id, payload))
+        return self._snapshot[1]
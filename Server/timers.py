@@ -0,0 +1,102 @@
+import heapq
+import itertools
+import threading
+
+# Entry layout inside the heap: [deadline, sequence, key, callback, active]
+_DEADLINE, _SEQUENCE, _KEY, _CALLBACK, _ACTIVE = range(5)
+
+# Rebuild the heap once cancelled entries outnumber live ones (and there are enough to matter).
+COMPACT_MIN_STALE = 64
+
+class TimerHeap:
+    """Keyed one-shot deadlines backed by a binary heap.
+
+    Scheduling a key that already has a timer replaces it, so "push this
+    deadline back" is a single schedule() call. Cancelled and replaced
+    entries are dropped lazily when they reach the top of the heap, which
+    keeps schedule, cancel and expiry at O(log n) per timer.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._sequence = itertools.count()
+        self._stale = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def schedule(self, key, deadline, callback):
+        """Arm (or re-arm) the timer for key. Returns True if it is now the earliest deadline."""
+        with self._lock:
+            self._deactivate(key)
+            entry = [deadline, next(self._sequence), key, callback, True]
+            self._entries[key] = entry
+            heapq.heappush(self._heap, entry)
+            self._maybe_compact()
+            self._drop_stale_head()
+            return self._heap[0] is entry
+
+    def cancel(self, key):
+        with self._lock:
+            return self._deactivate(key)
+
+    def cancel_matching(self, predicate):
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                self._deactivate(key)
+            return len(keys)
+
+    def deadline(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[_DEADLINE] if entry else None
+
+    def items(self):
+        """(key, deadline) for every armed timer, in no particular order."""
+        with self._lock:
+            return [(key, entry[_DEADLINE]) for key, entry in self._entries.items()]
+
+    def next_deadline(self):
+        with self._lock:
+            self._drop_stale_head()
+            return self._heap[0][_DEADLINE] if self._heap else None
+
+    def pop_due(self, now):
+        """Remove and return (key, callback) for every timer due at or before now, earliest first."""
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][_DEADLINE] <= now:
+                entry = heapq.heappop(self._heap)
+                if not entry[_ACTIVE]:
+                    self._stale -= 1
+                    continue
+                del self._entries[entry[_KEY]]
+                due.append((entry[_KEY], entry[_CALLBACK]))
+        return due
+
+    def _deactivate(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        entry[_ACTIVE] = False
+        self._stale += 1
+        return True
+
+    def _drop_stale_head(self):
+        while self._heap and not self._heap[0][_ACTIVE]:
+            heapq.heappop(self._heap)
+            self._stale -= 1
+
+    def _maybe_compact(self):
+        if self._stale > COMPACT_MIN_STALE and self._stale > len(self._entries):
+            self._heap = [entry for entry in self._heap if entry[_ACTIVE]]
+            heapq.heapify(self._heap)
+            self._stale = 0
@@ -0,0 +1,127 @@
+import socket
+import threading
+import time
+from metrics import registry
+from protocol import OP_DRIVE, SEQUENCE_MASK, encode_frame
+
+UDP_DRIVE_DATAGRAMS = registry.counter('omc_udp_drive_datagrams_total', "Drive frames sent to cars over UDP, by whether they were a new command or a repeat of the latest one.", ['kind'])
+
+class DriveLink:
+    # One car's UDP drive path: where its datagrams go, and its latest frame until that has been repeated enough.
+    __slots__ = ('device_id', 'address', 'sequence', 'frame', 'repeats_left', 'next_repeat', 'closed')
+
+    def __init__(self, device_id, address):
+        self.device_id = device_id
+        self.address = address # (ip, port) the car is listening for drive frames on
+        self.sequence = 0
+        self.frame = None
+        self.repeats_left = 0
+        self.next_repeat = 0.0
+        self.closed = False
+
+class UdpDriveChannel(threading.Thread):
+    """Drive commands to cars as sequence-numbered UDP datagrams.
+
+    Only the latest drive command matters, so TCP's in-order delivery buys
+    nothing for them: one lost segment holds every later command back
+    until it is retransmitted, 200 ms or more. A car that offers a UDP port
+    in its HELLO line gets its drive commands as datagrams instead, in the
+    same six-byte OP_DRIVE frame, numbered per car so the car can ignore
+    anything older than what it has already applied. A lost datagram is
+    made up for by sending the latest frame again, unchanged, every
+    repeat_interval, up to repeats times; a car that already has it drops
+    the copy as stale. Shots and disable/enable stay on the TCP connection.
+    Any thread may call send(); this thread only does the repeats.
+    """
+
+    def __init__(self, repeat_interval, repeats):
+        threading.Thread.__init__(self, name="udp-drive", daemon=True)
+        self.repeat_interval = repeat_interval
+        self.repeats = repeats
+        self.socket = None
+        self._wakeup = threading.Condition()
+        self._repeating = set() # links with repeats left
+        self.links = 0
+        self.reset()
+
+    def reset(self):
+        self.commands = 0
+        self.repeated = 0
+        self.errors = 0
+
+    @property
+    def enabled(self):
+        return self.socket is not None
+
+    def open(self, host, port):
+        # Raises OSError if the port cannot be bound.
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((host, port))
+        sock.setblocking(False) # a full send buffer drops the datagram instead of stalling a web thread
+        self.socket = sock
+        self.start()
+        return sock.getsockname()
+
+    def link(self, device_id, address):
+        with self._wakeup:
+            self.links += 1
+        return DriveLink(device_id, address)
+
+    def close(self, link):
+        with self._wakeup:
+            if not link.closed:
+                link.closed = True
+                self.links -= 1
+                self._repeating.discard(link)
+
+    def send(self, link, command):
+        with self._wakeup:
+            if link.closed:
+                return
+            link.sequence = (link.sequence + 1) & SEQUENCE_MASK
+            link.frame = frame = encode_frame(OP_DRIVE, link.device_id, command, link.sequence)
+            link.repeats_left = self.repeats
+            link.next_repeat = time.monotonic() + self.repeat_interval
+            if self.repeats:
+                self._repeating.add(link)
+                self._wakeup.notify()
+            self.commands += 1
+        UDP_DRIVE_DATAGRAMS.labels('command').inc()
+        self._send(link.address, frame)
+
+    def run(self):
+        while True:
+            with self._wakeup:
+                due = []
+                next_repeat = None
+                now = time.monotonic()
+                for link in list(self._repeating):
+                    if link.next_repeat <= now:
+                        due.append((link.address, link.frame))
+                        link.repeats_left -= 1
+                        link.next_repeat = now + self.repeat_interval
+                        if not link.repeats_left:
+                            self._repeating.discard(link)
+                            continue
+                    if next_repeat is None or link.next_repeat < next_repeat:
+                        next_repeat = link.next_repeat
+                self.repeated += len(due)
+                if not due:
+                    self._wakeup.wait(None if next_repeat is None else next_repeat - now)
+            for address, frame in due:
+                UDP_DRIVE_DATAGRAMS.labels('repeat').inc()
+                self._send(address, frame)
+
+    def _send(self, address, frame):
+        try:
+            self.socket.sendto(frame, address)
+        except OSError:
+            with self._wakeup:
+                self.errors += 1
+
+    def report(self):
+        with self._wakeup:
+            summary = (f"[UDP DRIVE] {self.commands} drive commands to {self.links} cars over UDP, "
+                       f"{self.repeated} repeats, {self.errors} send errors")
+            self.reset()
+        return summary
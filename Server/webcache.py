@@ -0,0 +1,63 @@
+import gzip
+import hashlib
+import threading
+from flask import Response, request
+
+MIN_COMPRESS_SIZE = 512 # bytes. Smaller bodies are sent as they are; gzip would barely help.
+
+class CachedPage:
+    """A rendered body kept with its ETag and a gzipped copy.
+
+    response() answers a conditional request with 304 when the browser's
+    copy is still current, and sends the gzipped body to clients that
+    accept it, so serving a cached page costs a header check and a copy.
+    """
+
+    def __init__(self, body, content_type, cache_control):
+        self.body = body.encode('utf-8') if isinstance(body, str) else body
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.etag = hashlib.sha1(self.body).hexdigest()[:16]
+        self.gzipped = gzip.compress(self.body, 6) if len(self.body) >= MIN_COMPRESS_SIZE else None
+
+    def response(self):
+        use_gzip = self.gzipped is not None and 'gzip' in request.accept_encodings
+        # Each encoding is a different representation, so it gets its own validator.
+        etag = self.etag + '-gz' if use_gzip else self.etag
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': self.cache_control, 'Vary': 'Accept-Encoding'}
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+        if use_gzip:
+            headers['Content-Encoding'] = 'gzip'
+            return Response(self.gzipped, content_type=self.content_type, headers=headers)
+        return Response(self.body, content_type=self.content_type, headers=headers)
+
+class PageCache:
+    """Rendered pages by key.
+
+    build() only runs on a miss. A page whose content depends on changing
+    state is looked up with a version; when the caller's version moves on,
+    the old page is treated as a miss and replaced, so it never has to be
+    invalidated by hand.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pages = {}
+
+    def get(self, key, build, version=None):
+        with self._lock:
+            cached = self._pages.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        page = build()
+        with self._lock:
+            self._pages[key] = (version, page)
+        return page
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._pages.clear()
+            else:
+                self._pages.pop(key, None)